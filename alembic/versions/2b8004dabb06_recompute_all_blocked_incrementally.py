@@ -0,0 +1,99 @@
+"""
+Recompute all_blocked only for affected base packages
+
+Create Date: 2026-10-19 20:41:09.264817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b8004dabb06'
+down_revision = '8f90f860c57a'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        DROP TRIGGER update_all_blocked_trigger ON package;
+
+        -- recomputes all_blocked of given base packages
+        CREATE OR REPLACE FUNCTION update_base_all_blocked(base_ids integer[])
+            RETURNS void AS $$
+        BEGIN
+            IF cardinality(base_ids) = 0 THEN
+                RETURN;
+            END IF;
+            UPDATE base_package
+            SET all_blocked = q.all_blocked
+            FROM (SELECT base_id, BOOL_AND(blocked) AS all_blocked
+                  FROM package
+                  WHERE base_id = ANY(base_ids)
+                  GROUP BY base_id) AS q
+            WHERE id = q.base_id
+                AND base_package.all_blocked IS DISTINCT FROM q.all_blocked;
+        END $$ LANGUAGE plpgsql;
+
+        -- insert and delete triggers are statement-level, changed_rows contains the
+        -- inserted or deleted rows
+        CREATE OR REPLACE FUNCTION update_all_blocked()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM update_base_all_blocked(ARRAY(
+                SELECT DISTINCT base_id FROM changed_rows
+            ));
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        -- update trigger is row-level, transition tables cannot be used together with
+        -- column list and package is updated often, mostly without changing blocked
+        CREATE OR REPLACE FUNCTION update_all_blocked_up()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM update_base_all_blocked(ARRAY[OLD.base_id, NEW.base_id]);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_all_blocked_trigger
+            AFTER INSERT ON package
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_all_blocked();
+        CREATE TRIGGER update_all_blocked_trigger_del
+            AFTER DELETE ON package
+            REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_all_blocked();
+        CREATE TRIGGER update_all_blocked_trigger_up
+            AFTER UPDATE OF blocked, base_id ON package
+            FOR EACH ROW
+            WHEN (OLD.blocked != NEW.blocked OR OLD.base_id != NEW.base_id)
+            EXECUTE PROCEDURE update_all_blocked_up();
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DROP TRIGGER update_all_blocked_trigger ON package;
+        DROP TRIGGER update_all_blocked_trigger_del ON package;
+        DROP TRIGGER update_all_blocked_trigger_up ON package;
+        DROP FUNCTION update_all_blocked_up();
+        DROP FUNCTION update_base_all_blocked(integer[]);
+
+        CREATE OR REPLACE FUNCTION update_all_blocked()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            UPDATE base_package
+            SET all_blocked = q.all_blocked
+            FROM (SELECT base_id, BOOL_AND(blocked) AS all_blocked
+                  FROM package
+                  GROUP BY base_id) AS q
+            WHERE id = q.base_id
+                AND base_package.all_blocked IS DISTINCT FROM q.all_blocked;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_all_blocked_trigger
+            AFTER INSERT OR DELETE OR UPDATE OF blocked ON package
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_all_blocked();
+    """)
@@ -0,0 +1,26 @@
+"""
+Add collection.packages_event_id and packages_full_refresh
+
+Create Date: 2026-10-19 10:21:07.532110
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b5c8e1f0a27'
+down_revision = 'faedc93800f1'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        ALTER TABLE collection ADD COLUMN packages_event_id INTEGER;
+        ALTER TABLE collection ADD COLUMN packages_full_refresh TIMESTAMP;
+    """)
+
+
+def downgrade():
+    op.execute("""
+        ALTER TABLE collection DROP COLUMN packages_full_refresh;
+        ALTER TABLE collection DROP COLUMN packages_event_id;
+    """)
@@ -0,0 +1,209 @@
+"""
+Maintain statistics incrementally
+
+Create Date: 2026-10-19 15:37:12.804471
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52c4a7e0d913'
+down_revision = '7d2e9a4c1b60'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        ALTER TABLE resource_consumption_stats DROP COLUMN time_percentage;
+        ALTER TABLE scalar_stats ADD COLUMN total_time INTERVAL;
+
+        CREATE TABLE scalar_stats_delta (
+            id SERIAL PRIMARY KEY,
+            timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+            packages INTEGER DEFAULT '0' NOT NULL,
+            tracked_packages INTEGER DEFAULT '0' NOT NULL,
+            blocked_packages INTEGER DEFAULT '0' NOT NULL,
+            builds INTEGER DEFAULT '0' NOT NULL,
+            real_builds INTEGER DEFAULT '0' NOT NULL,
+            scratch_builds INTEGER DEFAULT '0' NOT NULL,
+            total_time INTERVAL
+        );
+
+        -- incrementally maintained statistics (ScalarStats, ResourceConsumptionStats)
+        -- counters are not updated in place, the triggers append changes to
+        -- scalar_stats_delta, which is folded in on read and by full refresh. Updating
+        -- the single scalar_stats row would serialize all writing transactions
+        -- insert and delete triggers are statement-level, changed_rows contains the
+        -- inserted or deleted rows
+        CREATE OR REPLACE FUNCTION update_package_stats()
+            RETURNS TRIGGER AS $$
+        DECLARE sign integer := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+        BEGIN
+            INSERT INTO scalar_stats_delta (packages, tracked_packages, blocked_packages)
+                SELECT sign * count(*),
+                       sign * count(*) FILTER (WHERE tracked),
+                       sign * count(*) FILTER (WHERE blocked)
+                    FROM changed_rows
+                    HAVING count(*) > 0;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_package_stats_up()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO scalar_stats_delta (tracked_packages, blocked_packages)
+                VALUES (NEW.tracked::int - OLD.tracked::int,
+                        NEW.blocked::int - OLD.blocked::int);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_build_stats()
+            RETURNS TRIGGER AS $$
+        DECLARE sign integer := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+        BEGIN
+            INSERT INTO scalar_stats_delta (builds, real_builds, scratch_builds)
+                SELECT sign * count(*),
+                       sign * count(*) FILTER (WHERE real),
+                       sign * count(*) FILTER (WHERE NOT real)
+                    FROM changed_rows
+                    HAVING count(*) > 0;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_build_stats_up()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO scalar_stats_delta (real_builds, scratch_builds)
+                VALUES (NEW.real::int - OLD.real::int, OLD.real::int - NEW.real::int);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        -- time of deleted tasks is not subtracted, it's dropped by the periodic full
+        -- refresh. Tasks are deleted only together with their builds, which are not
+        -- visible to the trigger anymore
+        -- resource_consumption_stats rows are upserted in (name, arch) order, so that
+        -- concurrent statements lock them in the same order
+        CREATE OR REPLACE FUNCTION update_resource_consumption_stats()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO resource_consumption_stats AS s (name, arch, time)
+                SELECT package.name, changed_rows.arch,
+                       sum(changed_rows.finished - changed_rows.started)
+                    FROM changed_rows
+                         JOIN build ON build.id = changed_rows.build_id
+                         JOIN package ON package.id = build.package_id
+                    GROUP BY package.name, changed_rows.arch
+                    ORDER BY package.name, changed_rows.arch
+                ON CONFLICT (name, arch) DO UPDATE
+                    SET time = COALESCE(s.time + EXCLUDED.time, s.time, EXCLUDED.time);
+            INSERT INTO scalar_stats_delta (total_time)
+                SELECT sum(finished - started)
+                    FROM changed_rows
+                    HAVING sum(finished - started) IS NOT NULL;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_resource_consumption_stats_up()
+            RETURNS TRIGGER AS $$
+        DECLARE delta interval := COALESCE(NEW.finished - NEW.started, '0') -
+                                  COALESCE(OLD.finished - OLD.started, '0');
+        BEGIN
+            IF NEW.finished IS NULL AND OLD.finished IS NULL THEN
+                RETURN NULL;
+            END IF;
+            INSERT INTO resource_consumption_stats AS s (name, arch, time)
+                SELECT package.name, NEW.arch, delta
+                    FROM build JOIN package ON package.id = build.package_id
+                    WHERE build.id = NEW.build_id
+                ON CONFLICT (name, arch) DO UPDATE
+                    SET time = COALESCE(s.time + EXCLUDED.time, EXCLUDED.time);
+            INSERT INTO scalar_stats_delta (total_time) VALUES (delta);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_package_stats_trigger_ins
+            AFTER INSERT ON package
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_package_stats();
+        CREATE TRIGGER update_package_stats_trigger_del
+            AFTER DELETE ON package
+            REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_package_stats();
+        CREATE TRIGGER update_package_stats_trigger_up
+            AFTER UPDATE OF tracked, blocked ON package
+            FOR EACH ROW
+            WHEN (OLD.tracked != NEW.tracked OR OLD.blocked != NEW.blocked)
+            EXECUTE PROCEDURE update_package_stats_up();
+        CREATE TRIGGER update_build_stats_trigger_ins
+            AFTER INSERT ON build
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_build_stats();
+        CREATE TRIGGER update_build_stats_trigger_del
+            AFTER DELETE ON build
+            REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_build_stats();
+        CREATE TRIGGER update_build_stats_trigger_up
+            AFTER UPDATE OF real ON build
+            FOR EACH ROW
+            WHEN (OLD.real != NEW.real)
+            EXECUTE PROCEDURE update_build_stats_up();
+        CREATE TRIGGER update_resource_consumption_stats_trigger
+            AFTER INSERT ON koji_task
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_resource_consumption_stats();
+        CREATE TRIGGER update_resource_consumption_stats_trigger_up
+            AFTER UPDATE OF started, finished ON koji_task
+            FOR EACH ROW
+            WHEN (OLD.started IS DISTINCT FROM NEW.started
+                  OR OLD.finished IS DISTINCT FROM NEW.finished)
+            EXECUTE PROCEDURE update_resource_consumption_stats_up();
+
+        DELETE FROM scalar_stats;
+        INSERT INTO scalar_stats
+            SELECT now(),
+                   (SELECT count(*) FROM package),
+                   (SELECT count(*) FROM package WHERE tracked),
+                   (SELECT count(*) FROM package WHERE blocked),
+                   (SELECT count(*) FROM build),
+                   (SELECT count(*) FROM build WHERE real),
+                   (SELECT count(*) FROM build WHERE NOT real),
+                   (SELECT sum(finished - started) FROM koji_task);
+        DELETE FROM resource_consumption_stats;
+        INSERT INTO resource_consumption_stats (name, arch, time)
+            SELECT package.name, koji_task.arch,
+                   sum(koji_task.finished - koji_task.started)
+                FROM package JOIN build ON package.id = build.package_id
+                     JOIN koji_task ON build.id = koji_task.build_id
+                GROUP BY package.name, koji_task.arch;
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DROP TRIGGER update_resource_consumption_stats_trigger_up ON koji_task;
+        DROP TRIGGER update_resource_consumption_stats_trigger ON koji_task;
+        DROP TRIGGER update_build_stats_trigger_up ON build;
+        DROP TRIGGER update_build_stats_trigger_del ON build;
+        DROP TRIGGER update_build_stats_trigger_ins ON build;
+        DROP TRIGGER update_package_stats_trigger_up ON package;
+        DROP TRIGGER update_package_stats_trigger_del ON package;
+        DROP TRIGGER update_package_stats_trigger_ins ON package;
+        DROP FUNCTION update_resource_consumption_stats_up();
+        DROP FUNCTION update_resource_consumption_stats();
+        DROP FUNCTION update_build_stats_up();
+        DROP FUNCTION update_build_stats();
+        DROP FUNCTION update_package_stats_up();
+        DROP FUNCTION update_package_stats();
+
+        DROP TABLE scalar_stats_delta;
+        ALTER TABLE scalar_stats DROP COLUMN total_time;
+        ALTER TABLE resource_consumption_stats ADD COLUMN time_percentage FLOAT;
+        UPDATE resource_consumption_stats
+            SET time_percentage = EXTRACT(EPOCH FROM time) /
+                (SELECT EXTRACT(EPOCH FROM sum(finished - started)) FROM koji_task);
+    """)
@@ -0,0 +1,26 @@
+"""
+Add collection.latest_builds_event_id and latest_builds_full_refresh
+
+Create Date: 2026-10-19 14:02:45.118376
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d2e9a4c1b60'
+down_revision = '3b5c8e1f0a27'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        ALTER TABLE collection ADD COLUMN latest_builds_event_id INTEGER;
+        ALTER TABLE collection ADD COLUMN latest_builds_full_refresh TIMESTAMP;
+    """)
+
+
+def downgrade():
+    op.execute("""
+        ALTER TABLE collection DROP COLUMN latest_builds_full_refresh;
+        ALTER TABLE collection DROP COLUMN latest_builds_event_id;
+    """)
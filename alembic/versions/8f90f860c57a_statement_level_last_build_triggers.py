@@ -0,0 +1,222 @@
+"""
+Statement-level last build triggers
+
+Create Date: 2026-10-19 20:12:37.518042
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f90f860c57a'
+down_revision = '9cc07c98bbc7'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        DROP TRIGGER update_last_build_trigger ON build;
+        DROP TRIGGER update_last_build_trigger_up ON build;
+        DROP TRIGGER update_last_build_trigger_del ON build;
+
+        -- recomputes last builds of given packages, in a few set-based statements
+        CREATE OR REPLACE FUNCTION update_last_builds(pkg_ids integer[])
+            RETURNS void AS $$
+        BEGIN
+            IF cardinality(pkg_ids) = 0 THEN
+                RETURN;
+            END IF;
+            WITH new AS (
+                SELECT package.id AS package_id,
+                       lb.id AS last_build_id,
+                       CASE WHEN lb.state = 2 THEN lcb.id ELSE lb.id END
+                           AS last_complete_build_id,
+                       CASE WHEN lb.state = 2 THEN lcb.state ELSE lb.state END
+                           AS last_complete_build_state,
+                       package.last_complete_build_id IS DISTINCT FROM
+                           CASE WHEN lb.state = 2 THEN lcb.id ELSE lb.id END
+                           AS last_complete_changed
+                    FROM package
+                         LEFT JOIN LATERAL (
+                            SELECT id, state FROM build
+                                WHERE package_id = package.id
+                                  AND NOT untagged
+                                ORDER BY started DESC
+                                LIMIT 1
+                         ) AS lb ON TRUE
+                         LEFT JOIN LATERAL (
+                            SELECT id, state FROM build
+                                WHERE package_id = package.id
+                                  AND (state = 3 OR state = 5)
+                                  AND NOT untagged
+                                ORDER BY started DESC
+                                LIMIT 1
+                         ) AS lcb ON lb.state = 2
+                    WHERE package.id = ANY(pkg_ids)
+            ), updated AS (
+                UPDATE package
+                    SET last_build_id = new.last_build_id,
+                        last_complete_build_id = new.last_complete_build_id,
+                        last_complete_build_state = CASE WHEN new.last_complete_changed
+                            THEN new.last_complete_build_state
+                            ELSE package.last_complete_build_state
+                        END
+                    FROM new
+                    WHERE package.id = new.package_id
+                      AND (package.last_build_id IS DISTINCT FROM new.last_build_id
+                           OR new.last_complete_changed)
+                    RETURNING new.package_id, new.last_complete_build_id,
+                              new.last_complete_changed
+            )
+            UPDATE build
+                SET last_complete = build.id IS NOT DISTINCT FROM
+                                    updated.last_complete_build_id
+                FROM updated
+                WHERE updated.last_complete_changed
+                  AND build.package_id = updated.package_id
+                  AND (build.last_complete OR build.id = updated.last_complete_build_id);
+        END $$ LANGUAGE plpgsql;
+
+        -- insert, update and delete triggers on build are statement-level, changed_rows
+        -- contains the inserted or deleted rows, old_rows and new_rows the updated rows
+        CREATE OR REPLACE FUNCTION update_last_build_trigger()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM update_last_builds(ARRAY(
+                SELECT DISTINCT package_id FROM changed_rows
+            ));
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_last_build_up()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            -- transition tables cannot be used together with column list or WHEN
+            -- condition. Updates of last_complete made by update_last_builds itself end
+            -- up here as well, with no changed rows
+            PERFORM update_last_builds(ARRAY(
+                SELECT DISTINCT new_rows.package_id
+                    FROM new_rows JOIN old_rows ON old_rows.id = new_rows.id
+                    WHERE old_rows.state != new_rows.state
+                       OR old_rows.untagged != new_rows.untagged
+            ));
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_last_build_del()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            -- package has no foreign keys to build (it's partitioned), so the package
+            -- needs to be updated only if it still points to a deleted build
+            PERFORM update_last_builds(ARRAY(
+                SELECT DISTINCT package.id
+                    FROM package JOIN changed_rows ON changed_rows.package_id = package.id
+                    WHERE package.last_build_id = changed_rows.id
+                       OR package.last_complete_build_id = changed_rows.id
+            ));
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_last_build_trigger
+            AFTER INSERT ON build
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_last_build_trigger();
+        CREATE TRIGGER update_last_build_trigger_up
+            AFTER UPDATE ON build
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_last_build_up();
+        CREATE TRIGGER update_last_build_trigger_del
+            AFTER DELETE ON build
+            REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_last_build_del();
+
+        DROP FUNCTION update_last_build(integer);
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DROP TRIGGER update_last_build_trigger ON build;
+        DROP TRIGGER update_last_build_trigger_up ON build;
+        DROP TRIGGER update_last_build_trigger_del ON build;
+
+        DROP FUNCTION update_last_build_up();
+        DROP FUNCTION update_last_builds(integer[]);
+
+        CREATE OR REPLACE FUNCTION update_last_build(pkg_id integer)
+            RETURNS void AS $$
+        DECLARE pkg record;
+                lb record;
+                lcb record;
+        BEGIN
+            SELECT INTO pkg * FROM package WHERE id = pkg_id;
+            SELECT INTO lb * FROM build
+                WHERE package_id = pkg_id
+                  AND NOT untagged
+                ORDER BY started DESC
+                LIMIT 1;
+            IF lb.state = 2 THEN
+                SELECT INTO lcb * FROM build
+                    WHERE package_id = pkg_id
+                      AND (state = 3 OR state = 5)
+                      AND NOT untagged
+                    ORDER BY started DESC
+                    LIMIT 1;
+            ELSE
+                lcb := lb;
+            END IF;
+            IF pkg.last_build_id IS DISTINCT FROM lb.id THEN
+                UPDATE package
+                    SET last_build_id = lb.id
+                    WHERE package.id = pkg_id;
+            END IF;
+            IF pkg.last_complete_build_id IS DISTINCT FROM lcb.id THEN
+                UPDATE package
+                    SET last_complete_build_id = lcb.id,
+                        last_complete_build_state = lcb.state
+                    WHERE id = pkg_id;
+                UPDATE build
+                    SET last_complete = FALSE
+                    WHERE last_complete AND package_id = pkg_id;
+                UPDATE build
+                    SET last_complete = TRUE
+                    WHERE id = lcb.id;
+            END IF;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_last_build_trigger()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM update_last_build(NEW.package_id);
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_last_build_del()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            -- try to avoid running more queries than necessary
+            -- package has no foreign keys to build (it's partitioned), so the package
+            -- needs to be updated only if it still points to the deleted build
+            IF EXISTS (
+                    SELECT 1 FROM package
+                        WHERE id = OLD.package_id
+                          AND (last_build_id = OLD.id OR last_complete_build_id = OLD.id)
+            ) THEN
+                PERFORM update_last_build(OLD.package_id);
+            END IF;
+            RETURN OLD;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_last_build_trigger
+            AFTER INSERT ON build FOR EACH ROW
+            EXECUTE PROCEDURE update_last_build_trigger();
+        CREATE TRIGGER update_last_build_trigger_up
+            AFTER UPDATE ON build FOR EACH ROW
+            WHEN (OLD.state != NEW.state OR OLD.untagged != NEW.untagged)
+            EXECUTE PROCEDURE update_last_build_trigger();
+        CREATE TRIGGER update_last_build_trigger_del
+            AFTER DELETE ON build FOR EACH ROW
+            EXECUTE PROCEDURE update_last_build_del();
+    """)
@@ -0,0 +1,277 @@
+"""
+Partition build and resolution tables by month
+
+Create Date: 2026-10-19 18:04:51.311248
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9cc07c98bbc7'
+down_revision = '52c4a7e0d913'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        -- build's primary key includes partitioning key, package's last build
+        -- columns cannot reference it anymore
+        ALTER TABLE package DROP CONSTRAINT fkey_package_last_complete_build_id;
+        ALTER TABLE package DROP CONSTRAINT fkey_package_last_build_id;
+
+        CREATE OR REPLACE FUNCTION update_last_build_del()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            -- try to avoid running more queries than necessary
+            -- package has no foreign keys to build (it's partitioned), so the package
+            -- needs to be updated only if it still points to the deleted build
+            IF EXISTS (
+                    SELECT 1 FROM package
+                        WHERE id = OLD.package_id
+                          AND (last_build_id = OLD.id OR last_complete_build_id = OLD.id)
+            ) THEN
+                PERFORM update_last_build(OLD.package_id);
+            END IF;
+            RETURN OLD;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION create_month_partitions(month date)
+            RETURNS void AS $$
+        DECLARE lower_bound date := date_trunc('month', month);
+                upper_bound date := date_trunc('month', month) + interval '1 month';
+                suffix text := to_char(month, '_YYYY_MM');
+                part record;
+                conflict boolean;
+        BEGIN
+            FOR part IN SELECT * FROM (VALUES
+                    ('build', 'started'),
+                    ('koji_task', 'build_started'),
+                    ('applied_change', 'build_started'),
+                    ('resolution_change', 'timestamp'),
+                    ('resolution_problem', 'resolution_timestamp')
+                ) AS p(parent, key) LOOP
+                CONTINUE WHEN to_regclass(part.parent || suffix) IS NOT NULL;
+                -- rows already stored in the default partition would violate the new
+                -- partition's constraint, they stay in the default partition
+                EXECUTE 'SELECT EXISTS (SELECT 1 FROM '
+                        || quote_ident(part.parent || '_default') || ' WHERE '
+                        || quote_ident(part.key) || ' >= ' || quote_literal(lower_bound)
+                        || ' AND ' || quote_ident(part.key) || ' < '
+                        || quote_literal(upper_bound) || ')'
+                    INTO conflict;
+                IF conflict THEN
+                    RAISE WARNING USING MESSAGE = 'Not creating partition ' || part.parent
+                        || suffix || ', default partition contains rows in its range';
+                    CONTINUE;
+                END IF;
+                EXECUTE 'CREATE TABLE ' || quote_ident(part.parent || suffix)
+                        || ' PARTITION OF ' || quote_ident(part.parent)
+                        || ' FOR VALUES FROM (' || quote_literal(lower_bound)
+                        || ') TO (' || quote_literal(upper_bound) || ')';
+            END LOOP;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION drop_month_partitions(month date)
+            RETURNS void AS $$
+        DECLARE lower_bound date := date_trunc('month', month);
+                upper_bound date := date_trunc('month', month) + interval '1 month';
+                suffix text := to_char(month, '_YYYY_MM');
+                part record;
+        BEGIN
+            IF to_regclass('build' || suffix) IS NULL THEN
+                RETURN;
+            END IF;
+            CREATE TEMPORARY TABLE kept_build AS
+                SELECT * FROM build
+                    WHERE started >= lower_bound AND started < upper_bound
+                      AND id IN (SELECT last_build_id FROM package
+                                 UNION
+                                 SELECT last_complete_build_id FROM package);
+            CREATE TEMPORARY TABLE kept_koji_task AS
+                SELECT * FROM koji_task
+                    WHERE build_started >= lower_bound AND build_started < upper_bound
+                      AND build_id IN (SELECT id FROM kept_build);
+            CREATE TEMPORARY TABLE kept_applied_change AS
+                SELECT * FROM applied_change
+                    WHERE build_started >= lower_bound AND build_started < upper_bound
+                      AND build_id IN (SELECT id FROM kept_build);
+            -- referencing tables first, detaching a partition of a referenced table
+            -- requires that there are no referencing rows
+            FOR part IN SELECT * FROM (VALUES
+                    ('resolution_problem', 'resolution_timestamp'),
+                    ('resolution_change', 'timestamp'),
+                    ('applied_change', 'build_started'),
+                    ('koji_task', 'build_started'),
+                    ('build', 'started')
+                ) AS p(parent, key) LOOP
+                IF to_regclass(part.parent || suffix) IS NOT NULL THEN
+                    EXECUTE 'ALTER TABLE ' || quote_ident(part.parent)
+                            || ' DETACH PARTITION ' || quote_ident(part.parent || suffix);
+                    EXECUTE 'DROP TABLE ' || quote_ident(part.parent || suffix);
+                END IF;
+                -- rows of the month that ended up in the default partition
+                EXECUTE 'DELETE FROM ' || quote_ident(part.parent) || ' WHERE '
+                        || quote_ident(part.key) || ' >= ' || quote_literal(lower_bound)
+                        || ' AND ' || quote_ident(part.key) || ' < '
+                        || quote_literal(upper_bound);
+            END LOOP;
+            INSERT INTO build SELECT * FROM kept_build;
+            INSERT INTO koji_task SELECT * FROM kept_koji_task;
+            INSERT INTO applied_change SELECT * FROM kept_applied_change;
+            DROP TABLE kept_build, kept_koji_task, kept_applied_change;
+        END $$ LANGUAGE plpgsql;
+
+        ALTER TABLE resolution_problem RENAME TO resolution_problem_old;
+        ALTER TABLE resolution_change RENAME TO resolution_change_old;
+        ALTER TABLE applied_change RENAME TO applied_change_old;
+        ALTER TABLE koji_task RENAME TO koji_task_old;
+        ALTER TABLE build RENAME TO build_old;
+        ALTER SEQUENCE resolution_problem_id_seq OWNED BY NONE;
+        ALTER SEQUENCE resolution_change_id_seq OWNED BY NONE;
+        ALTER SEQUENCE applied_change_id_seq OWNED BY NONE;
+        ALTER SEQUENCE koji_task_id_seq OWNED BY NONE;
+        ALTER SEQUENCE build_id_seq OWNED BY NONE;
+
+        CREATE TABLE build (LIKE build_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            PARTITION BY RANGE (started);
+        CREATE TABLE koji_task (
+            LIKE koji_task_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+            build_started TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        ) PARTITION BY RANGE (build_started);
+        CREATE TABLE applied_change (
+            LIKE applied_change_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+            build_started TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        ) PARTITION BY RANGE (build_started);
+        CREATE TABLE resolution_change (
+            LIKE resolution_change_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+        ) PARTITION BY RANGE ("timestamp");
+        CREATE TABLE resolution_problem (
+            LIKE resolution_problem_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+            resolution_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        ) PARTITION BY RANGE (resolution_timestamp);
+
+        CREATE TABLE build_default PARTITION OF build DEFAULT;
+        CREATE TABLE koji_task_default PARTITION OF koji_task DEFAULT;
+        CREATE TABLE applied_change_default PARTITION OF applied_change DEFAULT;
+        CREATE TABLE resolution_change_default PARTITION OF resolution_change DEFAULT;
+        CREATE TABLE resolution_problem_default PARTITION OF resolution_problem DEFAULT;
+
+        -- builds older than the oldest build that isn't referenced by a package
+        -- were kept by cleanup, they go to the default partition
+        SELECT create_month_partitions(month::date)
+            FROM generate_series(
+                date_trunc('month', LEAST(
+                    (SELECT min(started) FROM build_old
+                        WHERE id NOT IN (
+                            SELECT last_build_id FROM package
+                                WHERE last_build_id IS NOT NULL
+                            UNION
+                            SELECT last_complete_build_id FROM package
+                                WHERE last_complete_build_id IS NOT NULL
+                        )),
+                    (SELECT min("timestamp") FROM resolution_change_old),
+                    now()
+                )),
+                now() + interval '2 months',
+                interval '1 month'
+            ) AS month;
+
+        INSERT INTO build SELECT * FROM build_old;
+        INSERT INTO koji_task
+            SELECT koji_task_old.*, build_old.started
+                FROM koji_task_old JOIN build_old ON build_old.id = build_id;
+        INSERT INTO applied_change
+            SELECT applied_change_old.*, build_old.started
+                FROM applied_change_old JOIN build_old ON build_old.id = build_id;
+        INSERT INTO resolution_change SELECT * FROM resolution_change_old;
+        INSERT INTO resolution_problem
+            SELECT resolution_problem_old.*, resolution_change_old."timestamp"
+                FROM resolution_problem_old
+                     JOIN resolution_change_old
+                          ON resolution_change_old.id = resolution_id;
+
+        DROP TABLE resolution_problem_old, resolution_change_old, applied_change_old,
+                   koji_task_old, build_old;
+        ALTER SEQUENCE resolution_problem_id_seq OWNED BY resolution_problem.id;
+        ALTER SEQUENCE resolution_change_id_seq OWNED BY resolution_change.id;
+        ALTER SEQUENCE applied_change_id_seq OWNED BY applied_change.id;
+        ALTER SEQUENCE koji_task_id_seq OWNED BY koji_task.id;
+        ALTER SEQUENCE build_id_seq OWNED BY build.id;
+
+        ALTER TABLE build ADD PRIMARY KEY (id, started);
+        ALTER TABLE build ADD FOREIGN KEY (package_id)
+            REFERENCES package (id) ON DELETE CASCADE;
+        ALTER TABLE koji_task ADD PRIMARY KEY (id, build_started);
+        ALTER TABLE koji_task ADD FOREIGN KEY (build_id, build_started)
+            REFERENCES build (id, started) ON DELETE CASCADE;
+        ALTER TABLE applied_change ADD PRIMARY KEY (id, build_started);
+        ALTER TABLE applied_change ADD FOREIGN KEY (build_id, build_started)
+            REFERENCES build (id, started) ON DELETE CASCADE;
+        ALTER TABLE applied_change ADD FOREIGN KEY (prev_dep_id)
+            REFERENCES dependency (id);
+        ALTER TABLE applied_change ADD FOREIGN KEY (curr_dep_id)
+            REFERENCES dependency (id);
+        ALTER TABLE resolution_change ADD PRIMARY KEY (id, "timestamp");
+        ALTER TABLE resolution_change ADD FOREIGN KEY (package_id)
+            REFERENCES package (id) ON DELETE CASCADE;
+        ALTER TABLE resolution_problem ADD PRIMARY KEY (id, resolution_timestamp);
+        ALTER TABLE resolution_problem
+            ADD FOREIGN KEY (resolution_id, resolution_timestamp)
+            REFERENCES resolution_change (id, "timestamp") ON DELETE CASCADE;
+
+        CREATE INDEX ix_build_composite ON build (package_id, started DESC);
+        CREATE INDEX ix_builds_unprocessed ON build (task_id)
+            WHERE deps_resolved IS NULL AND repo_id IS NOT NULL;
+        CREATE INDEX ix_builds_last_complete ON build (package_id, task_id)
+            WHERE last_complete;
+        CREATE INDEX ix_builds_last_complete_started ON build (started)
+            WHERE last_complete;
+        CREATE INDEX ix_koji_task_build_id ON koji_task (build_id);
+        CREATE INDEX ix_applied_change_build_id ON applied_change (build_id);
+        CREATE INDEX ix_applied_change_prev_dep_id ON applied_change (prev_dep_id);
+        CREATE INDEX ix_applied_change_curr_dep_id ON applied_change (curr_dep_id);
+        CREATE INDEX ix_resolution_change_package_id ON resolution_change (package_id);
+        CREATE INDEX ix_resolution_problem_resolution_id
+            ON resolution_problem (resolution_id);
+
+        CREATE TRIGGER update_last_build_trigger
+            AFTER INSERT ON build FOR EACH ROW
+            EXECUTE PROCEDURE update_last_build_trigger();
+        CREATE TRIGGER update_last_build_trigger_up
+            AFTER UPDATE ON build FOR EACH ROW
+            WHEN (OLD.state != NEW.state OR OLD.untagged != NEW.untagged)
+            EXECUTE PROCEDURE update_last_build_trigger();
+        CREATE TRIGGER update_last_build_trigger_del
+            AFTER DELETE ON build FOR EACH ROW
+            EXECUTE PROCEDURE update_last_build_del();
+        CREATE TRIGGER update_build_stats_trigger_ins
+            AFTER INSERT ON build
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_build_stats();
+        CREATE TRIGGER update_build_stats_trigger_del
+            AFTER DELETE ON build
+            REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_build_stats();
+        CREATE TRIGGER update_build_stats_trigger_up
+            AFTER UPDATE OF real ON build
+            FOR EACH ROW
+            WHEN (OLD.real != NEW.real)
+            EXECUTE PROCEDURE update_build_stats_up();
+        CREATE TRIGGER update_resource_consumption_stats_trigger
+            AFTER INSERT ON koji_task
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE update_resource_consumption_stats();
+        CREATE TRIGGER update_resource_consumption_stats_trigger_up
+            AFTER UPDATE OF started, finished ON koji_task
+            FOR EACH ROW
+            WHEN (OLD.started IS DISTINCT FROM NEW.started
+                  OR OLD.finished IS DISTINCT FROM NEW.finished)
+            EXECUTE PROCEDURE update_resource_consumption_stats_up();
+    """)
+
+
+def downgrade():
+    raise NotImplementedError()
@@ -0,0 +1,84 @@
+"""
+Add package.precomputed_priority
+
+Create Date: 2026-10-19 09:12:40.118302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'faedc93800f1'
+down_revision = 'f97587df0763'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+        ALTER TABLE package ADD COLUMN precomputed_priority DOUBLE PRECISION;
+
+        CREATE OR REPLACE FUNCTION update_precomputed_priority()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            -- keep in sync with Package.current_priority_expression
+            IF NEW.blocked OR NOT NEW.tracked
+                    OR NEW.last_build_id IS NULL
+                    OR NEW.last_complete_build_id IS DISTINCT FROM NEW.last_build_id
+                    OR NEW.resolved = FALSE
+                    OR (NEW.resolved IS NULL AND NOT NEW.skip_resolution) THEN
+                NEW.precomputed_priority := NULL;
+            ELSE
+                NEW.precomputed_priority := NEW.manual_priority + NEW.static_priority +
+                    (NEW.dependency_priority + NEW.build_priority) *
+                    (SELECT priority_coefficient FROM collection
+                        WHERE id = NEW.collection_id);
+            END IF;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION update_collection_precomputed_priority()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            -- no-op update, makes update_precomputed_priority_trigger use the new
+            -- coefficient
+            UPDATE package
+                SET collection_id = collection_id
+                WHERE collection_id = NEW.id;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_precomputed_priority_trigger
+            BEFORE INSERT OR UPDATE OF collection_id, blocked, tracked, last_build_id,
+                last_complete_build_id, resolved, skip_resolution, manual_priority,
+                static_priority, dependency_priority, build_priority
+            ON package
+            FOR EACH ROW
+            EXECUTE PROCEDURE update_precomputed_priority();
+
+        CREATE TRIGGER update_collection_precomputed_priority_trigger
+            AFTER UPDATE OF priority_coefficient ON collection
+            FOR EACH ROW
+            WHEN (OLD.priority_coefficient IS DISTINCT FROM NEW.priority_coefficient)
+            EXECUTE PROCEDURE update_collection_precomputed_priority();
+
+        -- execute the trigger once
+        UPDATE package SET collection_id = collection_id;
+
+        CREATE INDEX ix_package_precomputed_priority
+            ON package (precomputed_priority DESC)
+            WHERE precomputed_priority IS NOT NULL;
+        CREATE INDEX ix_builds_last_complete_started
+            ON build (started)
+            WHERE last_complete;
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DROP INDEX ix_builds_last_complete_started;
+        DROP INDEX ix_package_precomputed_priority;
+        DROP TRIGGER update_collection_precomputed_priority_trigger ON collection;
+        DROP TRIGGER update_precomputed_priority_trigger ON package;
+        DROP FUNCTION update_collection_precomputed_priority();
+        DROP FUNCTION update_precomputed_priority();
+        ALTER TABLE package DROP COLUMN precomputed_priority;
+    """)
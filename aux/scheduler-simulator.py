@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Runs the offline scheduler simulator (see koschei/backend/simulator.py) for the
+current configuration and given variants of it and prints the results.
+
+The database given by configuration should be a local copy of production data, for
+example the test database set up by aux/set-env.sh (pg_init, pg_start), with tables
+restored from a dump:
+    pg_dump -Fc -t collection -t base_package -t package -t build -t koji_task \\
+        -t dependency -t unapplied_change -t applied_change -t resolution_change \\
+        koschei > snapshot.dump
+    pg_restore -d koschei snapshot.dump
+The simulation doesn't modify the database.
+
+Usage:
+    KOSCHEI_CONFIG=config.cfg.template:aux/test-config.cfg \\
+        aux/scheduler-simulator.py --days 7 \\
+        --variant 'koji_config.max_builds=50' \\
+        --variant 'priorities.t1=336 services.scheduler.batch=True'
+"""
+
+import argparse
+import ast
+import logging
+
+from datetime import timedelta
+
+from koschei.config import load_config
+from koschei.backend import KoscheiBackendSession
+from koschei.backend.simulator import Simulator
+
+
+def parse_variant(variant):
+    """
+    Parses space separated KEY=VALUE pairs, values are Python literals.
+    """
+    overrides = {}
+    for item in variant.split():
+        key, value = item.split('=', 1)
+        overrides[key] = ast.literal_eval(value)
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates the scheduler")
+    parser.add_argument('--days', type=float, default=7,
+                        help="length of the replayed history and of the simulation")
+    parser.add_argument('--tick', type=int, default=300,
+                        help="interval between scheduling rounds, in seconds")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for sampling build durations")
+    parser.add_argument('--variant', action='append', default=[],
+                        help="configuration to compare with the current one, given as "
+                        "space separated KEY=VALUE pairs (may be repeated)")
+    args = parser.parse_args()
+
+    load_config(['/usr/share/koschei/config.cfg', '/etc/koschei/config-backend.cfg'])
+    logging.getLogger().setLevel(logging.INFO)
+
+    simulator = Simulator(
+        KoscheiBackendSession(),
+        window=timedelta(days=args.days),
+        tick=timedelta(seconds=args.tick),
+        seed=args.seed,
+    )
+    print(simulator.run().format())
+    for variant in args.variant:
+        print(simulator.run(variant, parse_variant(variant)).format())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Micro-benchmark of in-Python evaluation of sql_property. Computes state_string of
+given number of packages in various states, once by compiling the expression on
+each access (the way sql_property used to work) and once using sql_property,
+which compiles the expression only once. No database is needed.
+
+Usage:
+    aux/sql-property-benchmark.py --packages 10000
+"""
+
+import argparse
+import itertools
+import timeit
+
+from koschei.db import Evaluator
+from koschei.models import Package, Build
+
+
+def prepare_packages(count):
+    states = itertools.cycle([
+        dict(blocked=True, tracked=True, resolved=True,
+             last_complete_build_state=Build.COMPLETE),
+        dict(blocked=False, tracked=False, resolved=True,
+             last_complete_build_state=Build.COMPLETE),
+        dict(blocked=False, tracked=True, resolved=False,
+             last_complete_build_state=Build.COMPLETE),
+        dict(blocked=False, tracked=True, resolved=True,
+             last_complete_build_state=Build.COMPLETE),
+        dict(blocked=False, tracked=True, resolved=True,
+             last_complete_build_state=Build.FAILED),
+        dict(blocked=False, tracked=True, resolved=None,
+             last_complete_build_state=None),
+    ])
+    return [Package(name='p{}'.format(i), **state)
+            for i, state in zip(range(count), states)]
+
+
+def uncached(packages):
+    expression = Package.__mapper__.all_orm_descriptors['state_string'].fget
+    return [Evaluator(Package).process(expression(Package))(package)
+            for package in packages]
+
+
+def cached(packages):
+    return [package.state_string for package in packages]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks sql_property evaluation")
+    parser.add_argument('--packages', type=int, default=10000,
+                        help="number of packages whose state is computed")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of measurements, the best one is reported")
+    args = parser.parse_args()
+
+    packages = prepare_packages(args.packages)
+    assert uncached(packages) == cached(packages)
+    for name, fn in (('compiled on each access', uncached),
+                     ('compiled once per class', cached)):
+        best = min(timeit.repeat(lambda: fn(packages), number=1, repeat=args.repeat))
+        print("{:<24} {:8.1f} ms".format(name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
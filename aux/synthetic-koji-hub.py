@@ -0,0 +1,868 @@
+#!/usr/bin/python3
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Synthetic Koji hub for load testing Koschei backend services on a single machine,
+without network access.
+
+Generates a deterministic (seeded) distribution of given size - packages, builds,
+SRPM and binary dependencies, build group, builders and running tasks - and serves
+it over Koji's XML-RPC protocol, together with createrepo-style repodata of the build
+tag repos (binary, source and comps), which are written to the data directory.
+
+Scratch-builds submitted by Koschei are simulated - they are assigned to builders
+and complete after a random time. Optionally, new repos with some updated packages
+are generated periodically to make the resolvers and polling do some work.
+Koji history of the tags (package listings, tagged builds and inheritance) is
+kept, so that incremental polling can be tested as well.
+
+Usage:
+    aux/synthetic-koji-hub.py --packages 50000 --running-tasks 3000
+
+Koschei configuration snippet (use it for both koji_config and
+secondary_koji_config, if secondary mode is tested):
+    "koji_config": {
+        "server": "http://localhost:8888/kojihub",
+        "topurl": "http://localhost:8888",
+        "weburl": "http://localhost:8888/koji",
+        "srpm_relative_path_root": "http://localhost:8888",
+        # there is no authentication, use a harmless call instead of login
+        "login_method": "getLoggedInUser",
+        "login_args": {},
+    },
+Then create a collection with target "f29", dest tag "f29" and build tag
+"f29-build" (the names can be changed by options).
+"""
+
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+
+from http.server import SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from xml.sax.saxutils import escape
+from xmlrpc.client import Fault
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+log = logging.getLogger('synthetic-koji-hub')
+
+# koji.TASK_STATES
+TASK_FREE, TASK_OPEN, TASK_CLOSED, TASK_CANCELED, TASK_FAILED = 0, 1, 2, 3, 5
+# koji.BUILD_STATES['COMPLETE'], koji.REPO_STATES['READY']
+BUILD_COMPLETE = 1
+REPO_READY = 1
+# GenericError and BuildError fault codes, used by koji.convertFault
+GENERIC_ERROR = 1000
+BUILD_ERROR = 1005
+
+REAL_TASK_BASE = 10000000
+SUBTASK_FACTOR = 10
+BUILD_GROUP_SIZE = 20
+
+
+class Package(object):
+    def __init__(self, pkg_id, name, version, arch):
+        self.id = pkg_id
+        self.name = name
+        self.version = version
+        self.release = 1
+        self.arch = arch
+        self.blocked = False
+        self.build_id = None
+        # tag_listing history entry of the latest build
+        self.listing = None
+        self.requires = []
+        self.build_requires = []
+
+    @property
+    def dist_release(self):
+        return '{}.fc29'.format(self.release)
+
+    def nvra(self, arch):
+        return '{}-{}-{}.{}'.format(self.name, self.version, self.dist_release, arch)
+
+
+class Task(object):
+    def __init__(self, task_id, method, arch, request, create_ts, duration,
+                 success, parent=None, host_id=None):
+        self.id = task_id
+        self.method = method
+        self.arch = arch
+        self.request = request
+        self.create_ts = create_ts
+        self.duration = duration
+        self.success = success
+        self.parent = parent
+        self.host_id = host_id
+        self.canceled_ts = None
+
+    @property
+    def state(self):
+        now = time.time()
+        if self.canceled_ts:
+            return TASK_CANCELED
+        if now < self.create_ts + self.duration:
+            return TASK_OPEN
+        return TASK_CLOSED if self.success else TASK_FAILED
+
+    @property
+    def completion_ts(self):
+        if self.canceled_ts:
+            return self.canceled_ts
+        if self.state in (TASK_CLOSED, TASK_FAILED):
+            return self.create_ts + self.duration
+        return None
+
+    def info(self, request=False):
+        info = {
+            'id': self.id,
+            'method': self.method,
+            'arch': self.arch,
+            'state': self.state,
+            'parent': self.parent,
+            'host_id': self.host_id,
+            'owner': 1,
+            'channel_id': 1,
+            'priority': 20,
+            'weight': 1.0,
+            'label': None,
+            'create_ts': self.create_ts,
+            'start_ts': self.create_ts,
+            'completion_ts': self.completion_ts,
+        }
+        if request:
+            info['request'] = self.request
+        return info
+
+
+class Distribution(object):
+    """
+    Synthetic content of the Koji instance. All public methods are exported as
+    Koji API calls.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.lock = threading.RLock()
+        self.event_id = 1000
+        self.next_task_id = 1
+        self.next_build_id = 1
+        self.arches = args.arches.split()
+        self.tasks = {}
+        self.repos = {}
+        self.packages = []
+        self.builds = {}
+        self.hosts = []
+        # format: {table: [entry]}, entries of queryHistory
+        self.history = {'tag_packages': [], 'tag_inheritance': [], 'tag_listing': []}
+        self.generate_inheritance()
+        self.generate_packages()
+        self.generate_hosts()
+        self.generate_running_tasks()
+        self.generate_repo()
+
+    def new_event(self):
+        self.event_id += 1
+        return self.event_id
+
+    def new_task_id(self):
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        return task_id
+
+    def record_history(self, table, event, entry):
+        entry = dict(
+            entry,
+            create_event=event, create_ts=time.time(), creator_id=1,
+            revoke_event=None, revoke_ts=None, revoker_id=None, active=True,
+        )
+        self.history[table].append(entry)
+        return entry
+
+    def tag_id(self, tag):
+        return 1 if tag == self.args.dest_tag else 2
+
+    def new_build(self, package, event):
+        """
+        Creates a new build of given package and tags it into the destination tag,
+        untagging the previous one.
+        """
+        package.build_id = self.next_build_id
+        self.next_build_id += 1
+        # builds use the latest repo as buildroot, the first repo is generated after
+        # the initial builds
+        repo_id = max(self.repos) if self.repos else 1
+        self.builds[package.build_id] = (package, package.release, time.time(), repo_id)
+        if package.listing:
+            package.listing.update(revoke_event=event, revoke_ts=time.time(),
+                                   revoker_id=1, active=None)
+        package.listing = self.record_history('tag_listing', event, {
+            'tag.name': self.args.dest_tag,
+            'tag_id': self.tag_id(self.args.dest_tag),
+            'build_id': package.build_id,
+            'build.state': BUILD_COMPLETE,
+            'name': package.name,
+            'version': package.version,
+            'release': package.dist_release,
+            'epoch': None,
+        })
+
+    def generate_inheritance(self):
+        """
+        Build tag inherits from the destination tag.
+        """
+        self.record_history('tag_inheritance', self.new_event(), {
+            'tag.name': self.args.build_tag,
+            'tag_id': self.tag_id(self.args.build_tag),
+            'parent.name': self.args.dest_tag,
+            'parent_id': self.tag_id(self.args.dest_tag),
+            'priority': 0,
+            'maxdepth': None,
+            'intransitive': False,
+            'noconfig': False,
+            'pkg_filter': '',
+        })
+
+    def generate_packages(self):
+        args = self.args
+        event = self.new_event()
+        for i in range(args.packages):
+            arch = 'noarch' if self.rnd.random() < args.noarch_ratio else self.arches[0]
+            package = Package(
+                pkg_id=i + 1,
+                name='pkg{:05d}'.format(i),
+                version='{}.{}'.format(self.rnd.randint(0, 9), self.rnd.randint(0, 99)),
+                arch=arch,
+            )
+            self.packages.append(package)
+        for i, package in enumerate(self.packages):
+            # packages in the build group are leaves
+            if i < BUILD_GROUP_SIZE:
+                continue
+            # requiring only packages with lower index makes dependencies acyclic
+            package.requires = self.sample_deps(i, args.max_requires)
+            package.build_requires = self.sample_deps(i, args.max_build_requires)
+            if self.rnd.random() < args.broken_ratio:
+                package.build_requires.append('missing-dep-{}'.format(i))
+            if self.rnd.random() < args.blocked_ratio:
+                package.blocked = True
+            self.new_build(package, event)
+        for package in self.packages[:BUILD_GROUP_SIZE]:
+            self.new_build(package, event)
+        for package in self.packages:
+            self.record_history('tag_packages', event, {
+                'tag.name': args.dest_tag,
+                'tag_id': self.tag_id(args.dest_tag),
+                'package.name': package.name,
+                'package_id': package.id,
+                'owner.name': 'packager',
+                'blocked': package.blocked,
+                'extra_arches': '',
+            })
+
+    def sample_deps(self, index, max_count):
+        count = min(index, self.rnd.randint(0, max_count))
+        return [self.packages[dep].name for dep in self.rnd.sample(range(index), count)]
+
+    def generate_hosts(self):
+        for i in range(self.args.hosts):
+            arch = self.arches[i % len(self.arches)]
+            self.hosts.append({
+                'id': i + 1,
+                'user_id': i + 1,
+                'name': 'buildvm-{}-{:02d}.example.com'.format(arch, i),
+                'arches': arch if arch != 'i686' else 'i386 i686',
+                'capacity': self.args.host_capacity,
+                'task_load': 0.0,
+                'ready': True,
+                'enabled': True,
+                'comment': None,
+                'description': None,
+            })
+
+    def generate_running_tasks(self):
+        """
+        Tasks of other Koji users that keep the builders busy.
+        """
+        now = time.time()
+        for _ in range(self.args.running_tasks):
+            arch = self.rnd.choice(self.arches)
+            self.create_task(
+                'buildArch', arch, [], create_ts=now,
+                duration=self.rnd.uniform(0, 2 * self.args.task_duration),
+            )
+
+    def create_task(self, method, arch, request, create_ts, duration, success=True,
+                    parent=None):
+        hosts = [host for host in self.hosts if arch in host['arches'].split()]
+        host = self.rnd.choice(hosts) if hosts and method == 'buildArch' else None
+        task = Task(
+            self.new_task_id(), method, arch, request, create_ts, duration, success,
+            parent=parent, host_id=host['id'] if host else None,
+        )
+        self.tasks[task.id] = task
+        return task
+
+    def update_packages(self):
+        """
+        Simulates new builds being tagged by bumping release of random packages.
+        """
+        count = int(len(self.packages) * self.args.update_ratio)
+        event = self.new_event()
+        for package in self.rnd.sample(self.packages[BUILD_GROUP_SIZE:], count):
+            package.release += 1
+            self.new_build(package, event)
+
+    def generate_repo(self):
+        repo_id = len(self.repos) + 1
+        event = self.new_event()
+        repo_dir = os.path.join(self.args.data_dir, 'repos', self.args.build_tag,
+                                str(repo_id))
+        started = time.time()
+        for arch in self.arches:
+            write_repo(os.path.join(repo_dir, arch), self.binary_packages(arch),
+                       comps=self.comps())
+        write_repo(os.path.join(repo_dir, 'src'), self.source_packages())
+        self.repos[repo_id] = {
+            'id': repo_id,
+            'state': REPO_READY,
+            'create_event': event,
+            'create_ts': time.time(),
+            'creation_time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'tag_id': 2,
+            'tag_name': self.args.build_tag,
+            'dist': False,
+        }
+        log.info("Generated repo %d in %.1fs", repo_id, time.time() - started)
+        return repo_id
+
+    def binary_packages(self, arch):
+        for package in self.packages:
+            yield dict(
+                name=package.name,
+                arch='noarch' if package.arch == 'noarch' else arch,
+                version=package.version, release=package.dist_release,
+                sourcerpm=package.nvra('src') + '.rpm',
+                provides=[package.name], requires=package.requires,
+                files=['/usr/share/{}/data'.format(package.name)],
+            )
+
+    def source_packages(self):
+        for package in self.packages:
+            yield dict(
+                name=package.name, arch='src',
+                version=package.version, release=package.dist_release,
+                sourcerpm='', provides=[], requires=package.build_requires,
+                files=[],
+            )
+
+    def comps(self):
+        return [package.name for package in self.packages[:BUILD_GROUP_SIZE]]
+
+    def latest_repo(self):
+        return self.repos[max(self.repos)]
+
+    def package_by_name(self, name):
+        index = int(name[3:]) if name.startswith('pkg') and name[3:].isdigit() else -1
+        if 0 <= index < len(self.packages):
+            return self.packages[index]
+        return None
+
+    def package_by_nvra(self, nvra):
+        package = self.package_by_name(nvra['name'])
+        if package and nvra['version'] == package.version:
+            return package
+        return None
+
+    def build_info(self, package, build_id=None):
+        build_id = build_id or package.build_id
+        _, release, ts, _ = self.builds[build_id]
+        dist_release = '{}.fc29'.format(release)
+        return {
+            'build_id': build_id,
+            'id': build_id,
+            'package_id': package.id,
+            'package_name': package.name,
+            'name': package.name,
+            'epoch': None,
+            'version': package.version,
+            'release': dist_release,
+            'nvr': '{}-{}-{}'.format(package.name, package.version, dist_release),
+            'state': BUILD_COMPLETE,
+            'task_id': REAL_TASK_BASE + build_id,
+            'owner_name': 'packager',
+            'tag_name': self.args.dest_tag,
+            'volume_name': 'DEFAULT',
+            'volume_id': 0,
+            'creation_ts': ts,
+            'completion_ts': ts,
+        }
+
+    def real_build_task(self, task_id):
+        """
+        Tasks of real builds are not stored, they are computed on demand.
+        """
+        build_id = task_id - REAL_TASK_BASE
+        if build_id not in self.builds:
+            return None
+        _, _, ts, _ = self.builds[build_id]
+        return Task(task_id, 'build', 'noarch', [], ts - 3600, 3600, True)
+
+    def real_build_subtasks(self, task_id):
+        build_id = task_id - REAL_TASK_BASE
+        package, _, ts, repo_id = self.builds[build_id]
+        arches = ['noarch'] if package.arch == 'noarch' else self.arches
+        return [
+            Task(
+                REAL_TASK_BASE * SUBTASK_FACTOR + build_id * SUBTASK_FACTOR + i,
+                'buildArch', arch,
+                ['srpm', self.args.build_tag, arch, True, {'repo_id': repo_id}],
+                ts - 3600, 3600, True, parent=task_id,
+            )
+            for i, arch in enumerate(arches)
+        ]
+
+    def get_task(self, task_id):
+        task = self.tasks.get(task_id)
+        if not task and task_id >= REAL_TASK_BASE:
+            task = self.real_build_task(task_id)
+        return task
+
+    # Koji API
+
+    def getLoggedInUser(self):
+        return {'id': 1, 'name': 'koschei', 'status': 0, 'usertype': 0}
+
+    def getLastEvent(self):
+        return {'id': self.event_id, 'ts': time.time()}
+
+    def getChannel(self, channelInfo, strict=False):
+        return {'id': 1, 'name': 'default'}
+
+    def getTag(self, taginfo, strict=False, event=None):
+        return {'id': self.tag_id(taginfo), 'name': taginfo,
+                'arches': ' '.join(self.arches),
+                'locked': False, 'perm': None, 'perm_id': None, 'extra': {}}
+
+    def getBuildConfig(self, tag, event=None):
+        return dict(self.getTag(tag), arches=' '.join(self.arches))
+
+    def getBuildTarget(self, info, event=None, strict=False):
+        return {'id': 1, 'name': self.args.target,
+                'build_tag': 2, 'build_tag_name': self.args.build_tag,
+                'dest_tag': 1, 'dest_tag_name': self.args.dest_tag}
+
+    def getFullInheritance(self, tag, event=None, reverse=False, stops=None,
+                           jumps=None):
+        # the inheritance is not deeper than one level
+        tag_key, parent_key = 'tag.name', 'parent.name'
+        if reverse:
+            tag_key, parent_key = parent_key, tag_key
+        return [
+            {'child_id': self.tag_id(entry[tag_key]),
+             'parent_id': self.tag_id(entry[parent_key]),
+             'name': entry[parent_key], 'currdepth': 1, 'nextdepth': None,
+             'priority': entry['priority'], 'maxdepth': entry['maxdepth'],
+             'intransitive': entry['intransitive'], 'noconfig': entry['noconfig'],
+             'pkg_filter': entry['pkg_filter'], 'filter': []}
+            for entry in self.history['tag_inheritance']
+            if entry['active'] and entry[tag_key] == tag
+            and (event is None or entry['create_event'] <= event)
+        ]
+
+    def queryHistory(self, tables=None, tag=None, event=None, afterEvent=None,
+                     beforeEvent=None, **kwargs):
+        # entries match if they were created or revoked at given event (range)
+        def matches(entry):
+            events = [entry['create_event']]
+            if entry['revoke_event']:
+                events.append(entry['revoke_event'])
+            return (
+                (not tag or entry['tag.name'] == tag) and
+                (event is None or event in events) and
+                (afterEvent is None or max(events) > afterEvent) and
+                (beforeEvent is None or min(events) < beforeEvent)
+            )
+        result = {}
+        for table in tables or self.history:
+            if table not in self.history:
+                raise Fault(GENERIC_ERROR, 'No such history table: {}'.format(table))
+            result[table] = [entry for entry in self.history[table] if matches(entry)]
+        return result
+
+    def listHosts(self, arches=None, channelID=None, ready=None, enabled=None,
+                  userID=None, queryOpts=None):
+        load = {}
+        for task in self.tasks.values():
+            if task.host_id and task.state == TASK_OPEN:
+                load[task.host_id] = load.get(task.host_id, 0) + 1.0
+        hosts = []
+        for host in self.hosts:
+            if arches and not set(arches) & set(host['arches'].split()):
+                continue
+            hosts.append(dict(host, task_load=load.get(host['id'], 0.0)))
+        return hosts
+
+    def listPackages(self, tagID=None, userID=None, pkgID=None, prefix=None,
+                     inherited=False, with_dups=False, event=None, queryOpts=None):
+        return [
+            {'package_id': package.id, 'package_name': package.name,
+             'tag_id': 1, 'tag_name': self.args.dest_tag,
+             'owner_name': 'packager', 'blocked': package.blocked,
+             'extra_arches': ''}
+            for package in self.packages
+        ]
+
+    def listTagged(self, tag, event=None, inherit=False, prefix=None, latest=False,
+                   package=None, owner=None, type=None):
+        if package:
+            package = self.package_by_name(package)
+            packages = [package] if package else []
+        else:
+            packages = self.packages
+        if latest:
+            return [self.build_info(package) for package in packages]
+        package_ids = {package.id for package in packages}
+        return [
+            self.build_info(package, build_id)
+            for build_id, (package, _, _, _) in self.builds.items()
+            if package.id in package_ids
+        ]
+
+    def getBuild(self, buildInfo, strict=False):
+        if buildInfo in self.builds:
+            package, _, _, _ = self.builds[buildInfo]
+            return self.build_info(package, buildInfo)
+        if strict:
+            raise Fault(GENERIC_ERROR, 'No such build: {}'.format(buildInfo))
+        return None
+
+    def listRPMs(self, buildID=None, buildrootID=None, imageID=None,
+                 componentBuildrootID=None, hostID=None, arches=None, queryOpts=None):
+        if buildID not in self.builds:
+            return []
+        package, release, _, _ = self.builds[buildID]
+        rpm_arches = ['src'] + (['noarch'] if package.arch == 'noarch' else self.arches)
+        if arches:
+            arches = [arches] if isinstance(arches, str) else arches
+            rpm_arches = [arch for arch in rpm_arches if arch in arches]
+        return [
+            {'id': buildID * SUBTASK_FACTOR + i, 'build_id': buildID,
+             'name': package.name, 'epoch': None, 'version': package.version,
+             'release': '{}.fc29'.format(release), 'arch': arch,
+             'external_repo_id': 0, 'external_repo_name': 'INTERNAL'}
+            for i, arch in enumerate(rpm_arches)
+        ]
+
+    def getRPMDeps(self, rpmID, depType=None, queryOpts=None):
+        package = self.package_by_nvra(rpmID)
+        if not package:
+            return []
+        requires = package.build_requires if rpmID['arch'] == 'src' else package.requires
+        return [{'name': name, 'version': '', 'flags': 0, 'type': 0}
+                for name in requires]
+
+    def getRPMHeaders(self, rpmID=None, taskID=None, filepath=None, headers=None):
+        package = self.package_by_nvra(rpmID)
+        if not package:
+            return {}
+        values = {
+            'BUILDARCHS': ['noarch'] if package.arch == 'noarch' else [],
+            'EXCLUDEARCH': [],
+            'EXCLUSIVEARCH': [],
+        }
+        return {header: values.get(header, []) for header in headers or values}
+
+    def getTaskInfo(self, task_id, request=False, strict=False):
+        task = self.get_task(task_id)
+        return task.info(request=request) if task else None
+
+    def getTaskChildren(self, task_id, request=False, strict=False):
+        if task_id in self.tasks:
+            return [task.info(request=request) for task in self.tasks.values()
+                    if task.parent == task_id]
+        if self.real_build_task(task_id):
+            return [task.info(request=request)
+                    for task in self.real_build_subtasks(task_id)]
+        return []
+
+    def getTaskResult(self, task_id, raise_fault=True):
+        task = self.get_task(task_id)
+        if task and task.state == TASK_FAILED:
+            raise Fault(BUILD_ERROR, 'error building package (arch x86_64)')
+        return {}
+
+    def cancelTask(self, task_id, recurse=True):
+        for task in self.tasks.values():
+            if task.id == task_id or (recurse and task.parent == task_id):
+                task.canceled_ts = time.time()
+
+    def repoInfo(self, repo_id, strict=False):
+        return self.repos.get(repo_id)
+
+    def getRepo(self, tag, state=None, event=None, dist=False):
+        return self.latest_repo()
+
+    def getTagGroups(self, tag, event=None, inherit=True, incl_pkgs=True,
+                     incl_reqs=True, incl_blocked=False):
+        return [{
+            'name': 'build',
+            'group_id': 1,
+            'blocked': False,
+            'packagelist': [
+                {'package': name, 'blocked': False, 'type': 'default',
+                 'basearchonly': None, 'requires': None}
+                for name in self.comps()
+            ],
+        }]
+
+    def build(self, src, target, opts=None, priority=None, channel=None):
+        opts = opts or {}
+        now = time.time()
+        duration = self.rnd.uniform(0.5, 1.5) * self.args.task_duration
+        success = self.rnd.random() >= self.args.failure_ratio
+        repo_id = opts.get('repo_id') or max(self.repos)
+        parent = self.create_task('build', 'noarch', [src, target, opts], now,
+                                  duration, success)
+        arches = opts.get('arch_override', '').split() or self.arches
+        for arch in arches:
+            self.create_task('buildArch', arch,
+                             [src, self.args.build_tag, arch, True,
+                              {'repo_id': repo_id}],
+                             now, duration, success, parent=parent.id)
+        return parent.id
+
+
+def write_repo(repo_dir, packages, comps=None):
+    """
+    Writes createrepo-style repodata (primary, filelists and optionally comps) for
+    given package dictionaries.
+    """
+    repodata_dir = os.path.join(repo_dir, 'repodata')
+    os.makedirs(repodata_dir, exist_ok=True)
+    primary = []
+    filelists = []
+    count = 0
+    for package in packages:
+        count += 1
+        nvra = '{name}-{version}-{release}.{arch}'.format(**package)
+        pkgid = hashlib.sha256(nvra.encode()).hexdigest()
+        version = '<version epoch="0" ver="{}" rel="{}"/>'.format(
+            escape(package['version']), escape(package['release']),
+        )
+        provides = ''.join(
+            '<rpm:entry name="{}" flags="EQ" epoch="0" ver="{}" rel="{}"/>'
+            .format(escape(name), escape(package['version']), escape(package['release']))
+            for name in package['provides']
+        )
+        requires = ''.join('<rpm:entry name="{}"/>'.format(escape(name))
+                           for name in package['requires'])
+        primary.append(
+            '<package type="rpm"><name>{name}</name><arch>{arch}</arch>{version}'
+            '<checksum type="sha256" pkgid="YES">{pkgid}</checksum>'
+            '<summary>{name}</summary><description>{name}</description>'
+            '<packager/><url/><time file="0" build="0"/>'
+            '<size package="1" installed="1" archive="1"/>'
+            '<location href="Packages/{nvra}.rpm"/>'
+            '<format><rpm:license>MIT</rpm:license>'
+            '<rpm:sourcerpm>{sourcerpm}</rpm:sourcerpm>'
+            '<rpm:header-range start="0" end="1"/>'
+            '<rpm:provides>{provides}</rpm:provides>'
+            '<rpm:requires>{requires}</rpm:requires>'
+            '{files}</format></package>\n'
+            .format(
+                name=escape(package['name']), arch=package['arch'], version=version,
+                pkgid=pkgid, nvra=escape(nvra), sourcerpm=escape(package['sourcerpm']),
+                provides=provides, requires=requires,
+                files=''.join('<file>{}</file>'.format(escape(f))
+                              for f in package['files']),
+            )
+        )
+        filelists.append(
+            '<package pkgid="{}" name="{}" arch="{}">{}{}</package>\n'.format(
+                pkgid, escape(package['name']), package['arch'], version,
+                ''.join('<file>{}</file>'.format(escape(f)) for f in package['files']),
+            )
+        )
+    metadata = [
+        ('primary', 'primary.xml.gz',
+         '<?xml version="1.0" encoding="UTF-8"?>\n'
+         '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+         'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{}">\n{}</metadata>\n'
+         .format(count, ''.join(primary))),
+        ('filelists', 'filelists.xml.gz',
+         '<?xml version="1.0" encoding="UTF-8"?>\n'
+         '<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="{}">\n'
+         '{}</filelists>\n'.format(count, ''.join(filelists))),
+    ]
+    if comps:
+        metadata.append((
+            'group', 'comps.xml',
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<comps><group><id>build</id><name>build</name><description/>'
+            '<default>false</default><uservisible>true</uservisible><packagelist>{}'
+            '</packagelist></group></comps>\n'
+            .format(''.join('<packagereq type="default">{}</packagereq>'.format(name)
+                            for name in comps)),
+        ))
+    repomd = []
+    for data_type, filename, content in metadata:
+        content = content.encode()
+        open_checksum = hashlib.sha256(content).hexdigest()
+        if filename.endswith('.gz'):
+            content = gzip.compress(content)
+        with open(os.path.join(repodata_dir, filename), 'wb') as metadata_file:
+            metadata_file.write(content)
+        repomd.append(
+            '<data type="{}"><checksum type="sha256">{}</checksum>'
+            '<open-checksum type="sha256">{}</open-checksum>'
+            '<location href="repodata/{}"/><timestamp>{}</timestamp>'
+            '<size>{}</size></data>\n'.format(
+                data_type, hashlib.sha256(content).hexdigest(), open_checksum,
+                filename, int(time.time()), len(content),
+            )
+        )
+    with open(os.path.join(repodata_dir, 'repomd.xml'), 'w') as repomd_file:
+        repomd_file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo" '
+            'xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n'
+            '<revision>{}</revision>\n{}</repomd>\n'.format(int(time.time()),
+                                                           ''.join(repomd))
+        )
+
+
+class HubRequestHandler(SimpleXMLRPCRequestHandler, SimpleHTTPRequestHandler):
+    """
+    Serves XML-RPC on /kojihub and repodata files using GET.
+    """
+    rpc_paths = ('/kojihub',)
+
+    def __init__(self, request, client_address, server):
+        super(HubRequestHandler, self).__init__(
+            request, client_address, server, directory=server.data_dir,
+        )
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class KojiHubServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self, address, distribution, data_dir):
+        super(KojiHubServer, self).__init__(
+            address, requestHandler=HubRequestHandler, allow_none=True,
+            logRequests=False,
+        )
+        self.distribution = distribution
+        self.data_dir = data_dir
+
+    def call(self, method, params):
+        # Koji passes keyword arguments as a trailing struct marked with __starstar
+        kwargs = {}
+        if params and isinstance(params[-1], dict) and params[-1].get('__starstar'):
+            kwargs = dict(params[-1])
+            del kwargs['__starstar']
+            params = params[:-1]
+        if method.startswith('_') or not hasattr(self.distribution, method):
+            raise Fault(GENERIC_ERROR, 'Invalid method: {}'.format(method))
+        with self.distribution.lock:
+            return getattr(self.distribution, method)(*params, **kwargs)
+
+    def _dispatch(self, method, params):
+        if method == 'multiCall':
+            results = []
+            for call in params[0]:
+                try:
+                    results.append([self.call(call['methodName'], call['params'])])
+                except Fault as fault:
+                    results.append({'faultCode': fault.faultCode,
+                                    'faultString': fault.faultString})
+            return results
+        try:
+            return self.call(method, params)
+        except Fault:
+            raise
+        except Exception as e:
+            log.exception("Call %s failed", method)
+            raise Fault(GENERIC_ERROR, str(e))
+
+
+def regenerate_repos(distribution, interval):
+    while True:
+        time.sleep(interval)
+        with distribution.lock:
+            distribution.update_packages()
+            distribution.generate_repo()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--data-dir', default='.workdir/synthetic-koji',
+                        help="where to write generated repos")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--packages', type=int, default=50000)
+    parser.add_argument('--running-tasks', type=int, default=2000,
+                        help="number of other users' tasks running at the start")
+    parser.add_argument('--hosts', type=int, default=400)
+    parser.add_argument('--host-capacity', type=float, default=10.0)
+    parser.add_argument('--arches', default='x86_64 i686 armhfp aarch64')
+    parser.add_argument('--target', default='f29')
+    parser.add_argument('--dest-tag', default='f29')
+    parser.add_argument('--build-tag', default='f29-build')
+    parser.add_argument('--max-requires', type=int, default=5)
+    parser.add_argument('--max-build-requires', type=int, default=15)
+    parser.add_argument('--noarch-ratio', type=float, default=0.3)
+    parser.add_argument('--broken-ratio', type=float, default=0.02,
+                        help="ratio of packages with unresolvable build requires")
+    parser.add_argument('--blocked-ratio', type=float, default=0.01)
+    parser.add_argument('--failure-ratio', type=float, default=0.1,
+                        help="ratio of failing scratch-builds")
+    parser.add_argument('--task-duration', type=float, default=600,
+                        help="average task duration in seconds")
+    parser.add_argument('--repo-interval', type=float, default=0,
+                        help="regenerate repo every N seconds, 0 to disable")
+    parser.add_argument('--update-ratio', type=float, default=0.005,
+                        help="ratio of packages updated on repo regeneration")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    args.data_dir = os.path.abspath(args.data_dir)
+    started = time.time()
+    distribution = Distribution(args)
+    log.info("Generated %d packages in %.1fs", args.packages, time.time() - started)
+    if args.repo_interval:
+        threading.Thread(
+            target=regenerate_repos, args=(distribution, args.repo_interval),
+            daemon=True,
+        ).start()
+    server = KojiHubServer((args.host, args.port), distribution, args.data_dir)
+    log.info("Serving on http://%s:%d/kojihub", args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -25,12 +25,12 @@ import pwd
 import logging
 import argparse
 
-from koschei import data, backend, plugin
+from koschei import data, backend, plugin, partitions
 from koschei.backend import koji_util
 from koschei.db import get_engine, create_all, get_or_create
 from koschei.models import (
     Package, PackageGroup, AdminNotice, Collection, User, LogEntry,
-    CollectionGroup, CollectionGroupRelation,
+    CollectionGroup, CollectionGroupRelation, ResourceConsumptionStats, ScalarStats,
 )
 from koschei.config import get_config
 
@@ -129,8 +129,15 @@ class Cleanup(Command):
     def execute(self, session, older_than):
         if older_than < 2:
             sys.exit("Minimal allowed value is 2 months")
+        # whole months are dropped as partitions, the remaining old rows are in
+        # default partitions, which are small
+        months = partitions.drop_partitions(session.db, older_than)
+        session.log_user_action(
+            "Cleanup: Dropped partitions of {} months".format(len(months))
+        )
         build_res = session.db.execute("""
-            DELETE FROM build WHERE started < now() - '{months} month'::interval
+            DELETE FROM build_default
+                WHERE started < now() - '{months} month'::interval
                 AND id NOT IN (
                     SELECT last_build_id AS id FROM package
                         WHERE last_build_id IS NOT null
@@ -140,7 +147,7 @@ class Cleanup(Command):
                 )
         """.format(months=older_than))
         resolution_res = session.db.execute("""
-            DELETE FROM resolution_change
+            DELETE FROM resolution_change_default
                 WHERE "timestamp" < now() - '{months} month':: interval
         """.format(months=older_than))
         session.log_user_action(
@@ -149,6 +156,8 @@ class Cleanup(Command):
         session.log_user_action(
             "Cleanup: Deleted {} resolution changes".format(resolution_res.rowcount)
         )
+        # triggers don't see the rows of dropped partitions
+        session.db.refresh_materialized_view(ResourceConsumptionStats, ScalarStats)
         plugin.dispatch_event('cleanup', session, older_than)
 
 
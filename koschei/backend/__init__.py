@@ -16,13 +16,13 @@
 #
 # Author: Michael Simacek <msimacek@redhat.com>
 
+from collections import defaultdict
 from datetime import datetime, timedelta
 
 import koji
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import ObjectDeletedError, StaleDataError
-from sqlalchemy.sql import true
 
 from koschei import util
 from koschei.session import KoscheiSession
@@ -106,7 +106,7 @@ class KoscheiBackendSession(KoscheiSession):
         return self._repo_cache
 
 
-def submit_build(session, package, arch_override=None):
+def submit_build(session, package, arch_override=None, srpm_res=None):
     """
     Submits a scratch-build to Koji for given package.
 
@@ -114,6 +114,8 @@ def submit_build(session, package, arch_override=None):
     :param package: A package for which to submit build
     :param arch_override: optional list of architectures that will be used intead of
                           Koji's default
+    :param srpm_res: optional result of `koji_util.get_last_srpm(..., relative=True)`
+                     obtained beforehand. Queried from Koji if not given.
     :return:
     """
     assert package.collection.latest_repo_id
@@ -125,12 +127,13 @@ def submit_build(session, package, arch_override=None):
     # on secondary Koji, collections SRPMs are taken from secondary, primary
     # needs to be able to build from relative URL constructed against
     # secondary (internal redirect)
-    srpm_res = koji_util.get_last_srpm(
-        session.secondary_koji_for(package.collection),
-        package.collection.dest_tag,
-        name,
-        relative=True
-    )
+    if srpm_res is None:
+        srpm_res = koji_util.get_last_srpm(
+            session.secondary_koji_for(package.collection),
+            package.collection.dest_tag,
+            name,
+            relative=True
+        )
     if srpm_res:
         srpm, srpm_url = srpm_res
         if session.build_from_repo_id:
@@ -246,6 +249,7 @@ def register_real_builds(session, collection, package_build_infos):
         for build, tasks in build_tasks.items():
             for task in tasks:
                 task.build_id = build.id
+                task.build_started = build.started
         # insert tasks
         insert_koji_tasks(session, build_tasks)
         # reset priorities
@@ -253,6 +257,23 @@ def register_real_builds(session, collection, package_build_infos):
 
         session.db.commit()
 
+        # prefill SRPM arch header cache used by scheduler, so that it doesn't
+        # need to query Koji for each candidate
+        if build_tasks and get_config('prefetch_srpm_arch_headers'):
+            koji_util.get_srpm_arch_headers_cached(
+                session,
+                session.secondary_koji_for(collection),
+                [
+                    dict(
+                        name=packages[build.package_id].name,
+                        version=build.version,
+                        release=build.release,
+                        arch='src',
+                    )
+                    for build in build_tasks
+                ],
+            )
+
 
 def set_failed_build_priority(session, package, last_build):
     """
@@ -397,15 +418,196 @@ def update_build_state(session, build, task_state):
         session.db.rollback()
 
 
+def update_build_states(session, build_states):
+    """
+    Batched version of `update_build_state`. Koji is queried using multicalls and
+    finished builds are finalized in transactions of `finished_builds_chunk` builds.
+    Builds and then their packages are locked in consistent order to prevent
+    deadlocks.
+    Sends fedmsg when builds are complete, after the corresponding commit.
+    Commits the transaction.
+
+    :param build_states: list of (build, task_state) pairs, where task_state is Koji
+                         task state name
+    """
+    task_timeout = timedelta(0, get_config('koji_config.task_timeout'))
+    time_threshold = datetime.now() - task_timeout
+    finished = []
+    to_cancel = []
+    running = []
+    for build, task_state in build_states:
+        if task_state == 'CANCELED' or task_state in Build.KOJI_STATE_MAP:
+            finished.append((build.id, task_state))
+        elif (build.started and build.started < time_threshold or
+              build.cancel_requested):
+            # Cancel builds that were running for too long, see update_build_state
+            session.log.info('Canceling build {0}'.format(build))
+            to_cancel.append(build)
+        else:
+            running.append(build)
+    if to_cancel:
+        # errors are ignored, the builds are deleted anyway
+        for _ in itercall(session.koji('primary'), [b.task_id for b in to_cancel],
+                          lambda k, task_id: k.cancelTask(task_id)):
+            pass
+        finished += [(build.id, 'CANCELED') for build in to_cancel]
+    for chunk in util.chunks(finished, get_config('finished_builds_chunk')):
+        finish_builds(session, dict(chunk))
+    if running:
+        # The builds are still running, but we can at least get the buildArch tasks
+        # and repo_ids, so that resolver can already resolve their dependencies
+        try:
+            for collection, builds in group_builds_by_collection(running).items():
+                insert_koji_tasks(session, sync_tasks(session, collection, builds))
+            session.db.commit()
+        except (StaleDataError, ObjectDeletedError, IntegrityError):
+            # Build was deleted concurrently by another process, nothing to do
+            session.db.rollback()
+
+
+def group_builds_by_collection(builds):
+    """
+    Returns a dict mapping collections to lists of given builds.
+    """
+    by_collection = defaultdict(list)
+    for build in builds:
+        by_collection[build.package.collection].append(build)
+    return by_collection
+
+
+def finish_builds(session, build_states):
+    """
+    Finalizes given finished builds in a single transaction. Part of
+    `update_build_states`, performs the same steps as `update_build_state` does for
+    a single finished build.
+    Koji is queried before the builds are locked, so that the locks are not held
+    across the multicall round trips. Results for builds that were finished by
+    another process in the meantime are discarded.
+
+    :param build_states: dict mapping build ids to Koji task state names
+    """
+    try:
+        # The objects need to be expired, so that they're fetched anew (see
+        # update_build_state). Builds that are not running anymore were finished by
+        # another process in parallel.
+        session.db.expire_all()
+        builds = session.db.query(Build)\
+            .filter(Build.id.in_(build_states.keys()))\
+            .filter(Build.state == Build.RUNNING)\
+            .order_by(Build.id)\
+            .all()
+        if not builds:
+            session.db.rollback()
+            return
+        canceled = [build for build in builds if build_states[build.id] == 'CANCELED']
+        to_finish = [build for build in builds if build_states[build.id] != 'CANCELED']
+        # Detect builds that ended with a "Koji fault"
+        faults = koji_util.get_koji_faults(
+            session.koji('primary'),
+            [build.task_id for build in to_finish],
+        )
+        faulted = [build for build, fault in zip(to_finish, faults) if fault]
+        to_finish = [build for build, fault in zip(to_finish, faults) if not fault]
+        # Get buildArch subtasks and repo_ids. Changes made by sync_tasks must not be
+        # flushed before the builds are locked and checked to be still running
+        with session.db.no_autoflush:
+            build_tasks = {}
+            for collection, collection_builds in \
+                    group_builds_by_collection(to_finish).items():
+                build_tasks.update(sync_tasks(session, collection, collection_builds))
+            running_ids = {
+                build_id for [build_id] in session.db.query(Build.id)
+                .filter(Build.id.in_([build.id for build in builds]))
+                .filter(Build.state == Build.RUNNING)
+                .order_by(Build.id)
+                .with_for_update()
+            }
+        for build in builds:
+            if build.id not in running_ids:
+                # discard changes made by sync_tasks
+                session.db.expire(build)
+                build_tasks.pop(build, None)
+        builds = [build for build in builds if build.id in running_ids]
+        if not builds:
+            session.db.rollback()
+            return
+        to_delete = []
+        for build in canceled:
+            if build.id in running_ids:
+                session.log.info('Deleting build {0} because it was canceled'
+                                 .format(build))
+                to_delete.append(build)
+        for build in faulted:
+            if build.id in running_ids:
+                session.log.info('Deleting build {0} because it ended with Koji fault'
+                                 .format(build))
+                to_delete.append(build)
+        to_finish = [build for build in to_finish if build.id in running_ids]
+        for build in to_finish:
+            if build.repo_id is None:
+                session.log.info('Deleting build {0} because it has no repo_id'
+                                 .format(build))
+                to_delete.append(build)
+                build_tasks.pop(build, None)
+        to_finish = [build for build in to_finish if build.repo_id is not None]
+        # Lock packages, always after the builds to prevent deadlocks
+        packages = {
+            package.id: package for package in session.db.query(Package)
+            .filter(Package.id.in_({build.package_id for build in builds}))
+            .populate_existing()
+            .lock_rows()
+        }
+        for build in to_delete:
+            session.db.delete(build)
+        insert_koji_tasks(session, build_tasks)
+        finished_packages = [packages[build.package_id] for build in to_finish]
+        # Reset priorities, delete UnappliedChanges
+        clear_priority_data(session, finished_packages)
+        prev_states = {
+            package.id: package.msg_state_string for package in finished_packages
+        }
+        for build in to_finish:
+            build.state = Build.KOJI_STATE_MAP[build_states[build.id]]
+            session.log.info('Setting build {build} state to {state}'
+                             .format(build=build,
+                                     state=Build.REV_STATE_MAP[build.state]))
+            set_failed_build_priority(session, packages[build.package_id], build)
+        session.db.flush()
+        # Re-fetch packages so they have fields updated by triggers
+        state_changes = []
+        for package in finished_packages:
+            session.db.expire(package)
+            new_state = package.msg_state_string
+            if prev_states[package.id] != new_state:
+                state_changes.append((package, prev_states[package.id], new_state))
+        session.db.commit()
+        for package, prev_state, new_state in state_changes:
+            # Send fedmsg if there was a change
+            dispatch_event(
+                'package_state_change',
+                session=session,
+                package=package,
+                prev_state=prev_state,
+                new_state=new_state,
+            )
+    except (StaleDataError, ObjectDeletedError, IntegrityError):
+        # Build was deleted concurrently by another process, nothing to do
+        session.db.rollback()
+
+
 def refresh_repo_mappings(session):
     """
     Only useful in secondary mode.
     Polls primary koji for createrepo tasks that have secondary counterparts
     and updates their repo mapping in the database.
+    Only the mappings are flushed, so that it can be used without autoflush (see
+    `finish_builds`).
     """
     primary = session.koji('primary')
-    for mapping in session.db.query(RepoMapping)\
-            .filter_by(primary_id=None):
+    mappings = session.db.query(RepoMapping)\
+        .filter_by(primary_id=None)\
+        .all()
+    for mapping in mappings:
         task_info = primary.getTaskInfo(mapping.task_id)
         if task_info['state'] in (koji.TASK_STATES['CANCELED'],
                                   koji.TASK_STATES['FAILED']):
@@ -419,6 +621,10 @@ def refresh_repo_mappings(session):
                 break
             except KeyError:
                 pass
+    # the mappings are queried by primary_id afterwards. An empty list would
+    # flush everything
+    if mappings:
+        session.db.flush(mappings)
 
 
 def set_build_repo_id(session, build, task, secondary_mode):
@@ -473,7 +679,11 @@ def sync_tasks(session, collection, builds, real=False):
     for build, task_info in zip(builds, call):
         if not task_info:
             continue
-        build.started = datetime.fromtimestamp(task_info['create_ts'])
+        if build.started is None:
+            # started is part of build's primary key referenced by its tasks and
+            # dependency changes, it's only set for builds not inserted yet (real
+            # builds). Scratch builds get it when submitted
+            build.started = datetime.fromtimestamp(task_info['create_ts'])
         if task_info.get('completion_ts'):
             build.finished = datetime.fromtimestamp(task_info['completion_ts'])
         elif build.state != Build.RUNNING:
@@ -490,6 +700,7 @@ def sync_tasks(session, collection, builds, real=False):
             if task['method'] == 'buildArch':
                 db_task = KojiTask(task_id=task['id'])
                 db_task.build_id = build.id
+                db_task.build_started = build.started
                 db_task.state = task['state']
                 db_task.arch = task['arch']
                 db_task.started = datetime.fromtimestamp(task['create_ts'])
@@ -523,118 +734,239 @@ def insert_koji_tasks(session, tasks):
             else:
                 to_insert.append(task)
         session.db.flush()
-        session.db.bulk_insert(to_insert)
+        session.db.bulk_copy(to_insert)
+
+
+def _incremental_refresh_possible(event_id, last_full_refresh, interval_key):
+    """
+    Returns whether data obtained from Koji can be refreshed incrementally since
+    given Koji event or a full refresh needs to be done, because there was no
+    refresh yet or because the last full refresh is older than the interval given
+    by configuration key. Interval set to None disables periodic full refreshes.
+    """
+    if not event_id or not last_full_refresh:
+        return False
+    interval = get_config(interval_key)
+    return (
+        interval is None or
+        last_full_refresh > datetime.now() - timedelta(seconds=interval)
+    )
 
 
 def refresh_packages(session):
     """
     Refresh package list from Koji. Add packages not yet known by Koschei
     and update blocked flag of existing packages.
+
+    The package list of a collection is refreshed incrementally - only packages whose
+    listing changed in Koji history since the Koji event of the previous refresh are
+    processed. A full refresh is done when there was no previous refresh, when the
+    changes cannot be determined from the history and periodically, according to
+    `services.polling.package_list_refresh_interval`.
     """
-    bases = {base.name: base for base
-             in session.db.query(BasePackage.id, BasePackage.name)}
-    for collection in session.db.query(Collection.id, Collection.dest_tag,
-                                       Collection.secondary_mode):
+    for collection in session.db.query(Collection):
         koji_session = session.secondary_koji_for(collection)
-        koji_packages = koji_session.listPackages(tagID=collection.dest_tag,
-                                                  inherited=True)
-        whitelisted = {p['package_name'] for p in koji_packages if not p['blocked']}
-        packages = session.db.query(Package.id, Package.name, Package.blocked)\
-            .filter_by(collection_id=collection.id)\
-            .all()
-        # Find packages which need to be blocked/unblocked
-        to_update = [p.id for p in packages if p.blocked == (p.name in whitelisted)]
-        if to_update:
-            session.db.query(Package).filter(Package.id.in_(to_update))\
-                .update({'blocked': ~Package.blocked}, synchronize_session=False)
-        existing_names = {p.name for p in packages}
-        # Find packages to be added
-        to_add = []
-        # Add PackageBases
-        for pkg_dict in koji_packages:
-            name = pkg_dict['package_name']
-            if name not in bases.keys():
-                base = BasePackage(name=name)
-                bases[name] = base
-                to_add.append(base)
-        session.db.bulk_insert(to_add)
-        to_add = []
-        # Add Packages
-        for pkg_dict in koji_packages:
-            name = pkg_dict['package_name']
-            if name not in existing_names:
-                pkg = Package(name=name, base_id=bases.get(name).id,
-                              collection_id=collection.id, tracked=False,
-                              blocked=pkg_dict['blocked'])
-                to_add.append(pkg)
-        session.db.bulk_insert(to_add)
-        session.db.expire_all()
+        event_id = koji_session.getLastEvent()['id']
+        names = None
+        if _incremental_refresh_possible(
+                collection.packages_event_id,
+                collection.packages_full_refresh,
+                'services.polling.package_list_refresh_interval',
+        ):
+            names = koji_util.get_tag_package_changes(
+                koji_session,
+                collection.dest_tag,
+                after_event=collection.packages_event_id,
+                before_event=event_id,
+            )
+        if names is None:
+            session.log.info("Refreshing package list of {}".format(collection))
+            koji_packages = koji_session.listPackages(tagID=collection.dest_tag,
+                                                      inherited=True)
+            collection.packages_full_refresh = datetime.now()
+        else:
+            koji_packages = koji_util.get_tag_packages(
+                koji_session,
+                collection.dest_tag,
+                names,
+            )
+        collection.packages_event_id = event_id
+        session.db.flush()
+        update_package_list(session, collection, koji_packages, names)
+
+
+def update_package_list(session, collection, koji_packages, names=None):
+    """
+    Updates packages of a collection according to package listings from Koji.
+
+    :param collection: Collection whose packages are updated
+    :param koji_packages: Package listings in collection's dest tag, as returned by
+                          listPackages
+    :param names: Names of packages to be updated. All packages of the collection
+                  if None. Packages that are not in koji_packages are blocked.
+    """
+    bases_query = session.db.query(BasePackage.id, BasePackage.name)
+    packages_query = session.db.query(Package.id, Package.name, Package.blocked)\
+        .filter_by(collection_id=collection.id)
+    if names is not None:
+        if not names:
+            return
+        bases_query = bases_query.filter(BasePackage.name.in_(names))
+        packages_query = packages_query.filter(Package.name.in_(names))
+    bases = {base.name: base for base in bases_query}
+    packages = packages_query.all()
+    whitelisted = {p['package_name'] for p in koji_packages if not p['blocked']}
+    # Find packages which need to be blocked/unblocked
+    to_update = [p.id for p in packages if p.blocked == (p.name in whitelisted)]
+    if to_update:
+        session.db.query(Package).filter(Package.id.in_(to_update))\
+            .update({'blocked': ~Package.blocked}, synchronize_session=False)
+    existing_names = {p.name for p in packages}
+    # Find packages to be added
+    to_add = []
+    # Add PackageBases
+    for pkg_dict in koji_packages:
+        name = pkg_dict['package_name']
+        if name not in bases.keys():
+            base = BasePackage(name=name)
+            bases[name] = base
+            to_add.append(base)
+    session.db.bulk_copy(to_add)
+    to_add = []
+    # Add Packages
+    for pkg_dict in koji_packages:
+        name = pkg_dict['package_name']
+        if name not in existing_names:
+            pkg = Package(name=name, base_id=bases.get(name).id,
+                          collection_id=collection.id, tracked=False,
+                          blocked=pkg_dict['blocked'])
+            to_add.append(pkg)
+    session.db.bulk_copy(to_add)
+    # loaded packages and collection's package list don't reflect the changes
+    for obj in list(session.db.identity_map.values()):
+        if isinstance(obj, (Package, BasePackage)):
+            session.db.expire(obj)
+    session.db.expire(collection)
 
 
-def _check_untagged_builds(session, collection, package_map, build_infos):
+def _load_koji_latest_builds(session, build_infos):
+    """
+    Loads latest builds from Koji into temporary table koji_latest_build, so that
+    they can be compared with builds in the database using set-based queries.
+    The table is kept until it's dropped by `_drop_koji_latest_builds`, even
+    across commits.
+    """
+    session.db.execute("""
+        DROP TABLE IF EXISTS koji_latest_build;
+        CREATE TEMPORARY TABLE koji_latest_build (
+            name VARCHAR NOT NULL,
+            epoch INTEGER,
+            version VARCHAR NOT NULL,
+            release VARCHAR NOT NULL
+        );
+    """)
+    session.db.copy_rows(
+        'koji_latest_build',
+        ['name', 'epoch', 'version', 'release'],
+        (
+            (info['package_name'], info['epoch'], info['version'], info['release'])
+            for info in build_infos
+        ),
+    )
+    session.db.execute("ANALYZE koji_latest_build")
+
+
+def _drop_koji_latest_builds(session):
+    session.db.execute("DROP TABLE IF EXISTS koji_latest_build")
+
+
+def _check_untagged_builds(session, collection, build_infos):
     """
     Check whether some of the builds we have weren't untagged/deleted in the
     meantime. Only checks last builds of packages.
+
+    Requires build_infos to be loaded by `_load_koji_latest_builds`.
     """
-    for info in build_infos:
-        package = package_map.get(info['package_name'])
-        # info contains the last build for the package that Koji knows
-        if package and util.is_build_newer(info, package.last_build):
-            # The last build (possibly more) we have is newer than last build in Koji.
-            # That means it was untagged or deleted.
-            # Get the last build we have that was not untagged.
-            last_valid_build_query = (
-                session.db.query(Build)
-                .filter(
-                    (Build.package_id == package.id) &
-                    (Build.epoch == info['epoch']) &
-                    (Build.version == info['version']) &
-                    (Build.release == info['release'])
-                )
-                .order_by(Build.started.desc())
-            )
-            last_valid_build = last_valid_build_query.first()
-            if not last_valid_build:
-                # We don't have the build anymore, register it again
-                register_real_builds(session, collection,
-                                     [(package.id, info)])
-                # Now, it must find it as we've just inserted it
-                last_valid_build = last_valid_build_query.first()
-            # set all following builds as untagged
-            # last_build pointers get reset by the trigger
-            (
-                session.db.query(Build)
-                .filter(Build.package_id == package.id)
-                .filter(
-                    Build.started > last_valid_build.started
-                    if last_valid_build else true()
-                )
-                .update({'untagged': True})
-            )
-            session.log.info("{} is no longer tagged".format(package.last_build))
+    # Last builds (possibly more) we have that are newer than the last build in
+    # Koji. That means they were untagged or deleted. Along with the last build we
+    # have that was not untagged, if any.
+    untagged = session.db.execute("""
+        SELECT p.id AS package_id, p.name, lb.id AS build_id,
+               (SELECT max(b.started) FROM build AS b
+                    WHERE b.package_id = p.id
+                      AND b.epoch IS NOT DISTINCT FROM k.epoch
+                      AND b.version = k.version
+                      AND b.release = k.release) AS valid_started
+            FROM koji_latest_build AS k
+                 JOIN package AS p ON p.name = k.name
+                 JOIN build AS lb ON lb.id = p.last_build_id
+            WHERE p.collection_id = :collection_id
+              AND rpmvercmp_evr(k.epoch, k.version, k.release,
+                                lb.epoch, lb.version, lb.release) < 0
+    """, dict(collection_id=collection.id)).fetchall()
+    if not untagged:
+        return
+    valid_started = {row.package_id: row.valid_started for row in untagged}
+    missing = [row for row in untagged if row.valid_started is None]
+    if missing:
+        # We don't have the valid builds anymore, register them again
+        info_map = {info['package_name']: info for info in build_infos}
+        register_real_builds(
+            session, collection,
+            [(row.package_id, info_map[row.name]) for row in missing],
+        )
+        # Now, it must find them as we've just inserted them, unless they
+        # couldn't be registered
+        valid_started.update(session.db.execute("""
+            SELECT p.id, max(b.started)
+                FROM koji_latest_build AS k
+                     JOIN package AS p ON p.name = k.name
+                     JOIN build AS b ON b.package_id = p.id
+                WHERE p.id = ANY(:package_ids)
+                  AND b.epoch IS NOT DISTINCT FROM k.epoch
+                  AND b.version = k.version
+                  AND b.release = k.release
+                GROUP BY p.id
+        """, dict(package_ids=[row.package_id for row in missing])).fetchall())
+    for row in untagged:
+        session.log.info(
+            "Last build of {} (id {}) in {} is no longer tagged"
+            .format(row.name, row.build_id, collection)
+        )
+    # set all following builds as untagged
+    # last_build pointers get reset by the trigger
+    package_ids, started = zip(*valid_started.items())
+    session.db.execute("""
+        UPDATE build SET untagged = TRUE
+            FROM unnest(CAST(:package_ids AS INTEGER[]),
+                        CAST(:started AS TIMESTAMP[])) AS v(package_id, started)
+            WHERE build.package_id = v.package_id
+              AND (v.started IS NULL OR build.started > v.started)
+              AND NOT build.untagged
+    """, dict(package_ids=list(package_ids), started=list(started)))
+    session.db.expire_all()
 
 
-def _check_retagged_builds(session, collection, package_map, build_infos):
+def _check_retagged_builds(session, collection):
     """
     Check whether some of the builds that were marked as untagged/deleted
     weren't tagged back.
+
+    Requires build_infos to be loaded by `_load_koji_latest_builds`.
     """
-    for info in build_infos:
-        package = package_map.get(info['package_name'])
-        # info contains the last build for the package that Koji knows
-        if package:
-            (
-                # Set the same build in our DB as tagged. Most likely a no-op.
-                session.db.query(Build)
-                .filter(
-                    (Build.package_id == package.id) &
-                    (Build.epoch == info['epoch']) &
-                    (Build.version == info['version']) &
-                    (Build.release == info['release']) &
-                    (Build.untagged)
-                )
-                .update({'untagged': False})
-            )
+    # Set the same build in our DB as tagged. Most likely a no-op.
+    session.db.execute("""
+        UPDATE build SET untagged = FALSE
+            FROM koji_latest_build AS k
+                 JOIN package AS p ON p.name = k.name
+            WHERE p.collection_id = :collection_id
+              AND build.package_id = p.id
+              AND build.untagged
+              AND build.epoch IS NOT DISTINCT FROM k.epoch
+              AND build.version = k.version
+              AND build.release = k.release
+    """, dict(collection_id=collection.id))
+    session.db.expire_all()
 
 
 def _check_new_real_builds(session, collection, package_map, build_infos):
@@ -648,8 +980,9 @@ def _check_new_real_builds(session, collection, package_map, build_infos):
         .join(Build.package)
         .filter(Package.collection_id == collection.id)
         .filter(Build.real)
+        .filter(Build.task_id.in_([info['task_id'] for info in build_infos]))
         .all_flat(set)
-    )
+    ) if build_infos else set()
     # Find task ids we don't have and add them
     to_add = [info for info in build_infos if info['task_id'] not in existing_task_ids]
     if to_add:
@@ -673,21 +1006,61 @@ def refresh_latest_builds(session):
     - Add new real builds
     - Mark no longer present builds as untagged
     - Unmark builds that were marked as untagged, but are present again
+
+    Only packages that had builds tagged or untagged since the Koji event of the
+    previous refresh are processed. All latest builds in the tag are reconciled
+    when there was no previous refresh, when the changes cannot be determined
+    from the history and periodically, according to
+    `services.polling.latest_builds_refresh_interval`.
     """
     for collection in session.db.query(Collection):
         koji_session = session.secondary_koji_for(collection)
-        build_infos = koji_session.listTagged(
-            collection.dest_tag,
-            latest=True,
-            inherit=True,
-        )
-        package_map = {
-            package.name: package for package in
+        event_id = koji_session.getLastEvent()['id']
+        names = None
+        if _incremental_refresh_possible(
+                collection.latest_builds_event_id,
+                collection.latest_builds_full_refresh,
+                'services.polling.latest_builds_refresh_interval',
+        ):
+            names = koji_util.get_tag_build_changes(
+                koji_session,
+                collection.dest_tag,
+                after_event=collection.latest_builds_event_id,
+                before_event=event_id,
+            )
+        full_refresh = names is None
+        if full_refresh:
+            session.log.info("Refreshing latest builds of {}".format(collection))
+            build_infos = koji_session.listTagged(
+                collection.dest_tag,
+                latest=True,
+                inherit=True,
+            )
+        else:
+            build_infos = [
+                info for info in
+                koji_util.get_latest_builds(koji_session, collection.dest_tag, names)
+                if info
+            ]
+        package_query = (
             session.db.query(Package)
             .options(joinedload(Package.last_build))
             .filter(Package.collection_id == collection.id)
-        }
+        )
+        if not full_refresh:
+            package_query = package_query.filter(Package.name.in_(names))
+        package_map = {
+            package.name: package for package in package_query
+        } if build_infos else {}
         _check_new_real_builds(session, collection, package_map, build_infos)
-        _check_untagged_builds(session, collection, package_map, build_infos)
-        _check_retagged_builds(session, collection, package_map, build_infos)
+        if build_infos:
+            _load_koji_latest_builds(session, build_infos)
+            _check_untagged_builds(session, collection, build_infos)
+            _check_retagged_builds(session, collection)
+            _drop_koji_latest_builds(session)
+        # the checks may commit, so the event is recorded only once all of them
+        # passed
+        collection.latest_builds_event_id = event_id
+        if full_refresh:
+            collection.latest_builds_full_refresh = datetime.now()
         session.db.commit()
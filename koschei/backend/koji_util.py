@@ -21,7 +21,10 @@
 Ac ollection of utility functions and classes for insteacting with Koji.
 """
 
+import os
 import re
+import time
+import threading
 import koji
 import logging
 
@@ -31,6 +34,192 @@ from rpm import RPMSENSE_LESS, RPMSENSE_GREATER, RPMSENSE_EQUAL
 from koschei.config import get_config, get_koji_config
 
 
+class Histogram(object):
+    """
+    Simple cumulative histogram with fixed bucket upper bounds (in the sense of
+    Prometheus histograms).
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_prometheus(self, name, **labels):
+        """
+        Returns lines of the histogram in Prometheus text exposition format.
+        """
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{}_bucket{{{}}} {}'.format(
+                name, format_prometheus_labels(le=bound, **labels), count,
+            ))
+        lines.append('{}_bucket{{{}}} {}'.format(
+            name, format_prometheus_labels(le='+Inf', **labels), self.count,
+        ))
+        lines.append('{}_sum{{{}}} {}'.format(
+            name, format_prometheus_labels(**labels), self.sum,
+        ))
+        lines.append('{}_count{{{}}} {}'.format(
+            name, format_prometheus_labels(**labels), self.count,
+        ))
+        return lines
+
+
+def format_prometheus_labels(**labels):
+    return ','.join(
+        '{}="{}"'.format(name, value) for name, value in sorted(labels.items())
+    )
+
+
+def write_prometheus_textfile(path, text):
+    """
+    Atomically writes metrics in Prometheus text format to a file, suitable for
+    node_exporter's textfile collector.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as textfile:
+        textfile.write(text)
+    os.rename(tmp_path, path)
+
+
+class KojiMethodStats(object):
+    """
+    Statistics of calls of a single Koji method on a single Koji instance.
+    """
+    def __init__(self):
+        # number of calls sent directly (not as part of multicall)
+        self.calls = 0
+        # number of calls sent as part of a multicall
+        self.batched_calls = 0
+        # number of repeated attempts to send a call
+        self.retries = 0
+        # total size of sent request bodies, including retries
+        self.request_bytes = 0
+        self.duration = Histogram(KojiCallStats.DURATION_BUCKETS)
+        # only used for multiCall method
+        self.multicall_size = Histogram(KojiCallStats.MULTICALL_SIZE_BUCKETS)
+
+
+class KojiCallStats(object):
+    """
+    Collects statistics of Koji calls made by all `KojiSession`s in the process,
+    per Koji instance (koji_id) and method. Multicalls are recorded under
+    `multiCall` method, calls batched in them are counted under their own method
+    as `batched_calls`.
+    Statistics are cumulative and can be exported in Prometheus text format or
+    logged as a summary.
+    """
+    DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+    MULTICALL_SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def get_method_stats(self, koji_id, method):
+        key = (koji_id, method)
+        if key not in self.methods:
+            self.methods[key] = KojiMethodStats()
+        return self.methods[key]
+
+    def record_call(self, koji_id, method, duration, multicall_size=None):
+        with self.lock:
+            stats = self.get_method_stats(koji_id, method)
+            stats.calls += 1
+            stats.duration.observe(duration)
+            if multicall_size is not None:
+                stats.multicall_size.observe(multicall_size)
+
+    def record_batched_call(self, koji_id, method):
+        with self.lock:
+            self.get_method_stats(koji_id, method).batched_calls += 1
+
+    def record_request(self, koji_id, method, size, retry):
+        with self.lock:
+            stats = self.get_method_stats(koji_id, method)
+            stats.request_bytes += size
+            if retry:
+                stats.retries += 1
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+
+    def to_prometheus(self, **labels):
+        """
+        Returns the statistics formatted in Prometheus text exposition format.
+
+        :param labels: Additional labels added to all samples, such as service name
+        """
+        metrics = [
+            ('koschei_koji_calls_total', 'counter',
+             "Number of Koji calls sent directly", 'calls'),
+            ('koschei_koji_batched_calls_total', 'counter',
+             "Number of Koji calls sent as part of a multicall", 'batched_calls'),
+            ('koschei_koji_retries_total', 'counter',
+             "Number of retried Koji call attempts", 'retries'),
+            ('koschei_koji_request_bytes_total', 'counter',
+             "Total size of Koji request bodies", 'request_bytes'),
+            ('koschei_koji_call_duration_seconds', 'histogram',
+             "Duration of Koji calls", 'duration'),
+            ('koschei_koji_multicall_size', 'histogram',
+             "Number of calls in Koji multicalls", 'multicall_size'),
+        ]
+        lines = []
+        with self.lock:
+            for name, metric_type, description, attr in metrics:
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                for (koji_id, method), stats in sorted(self.methods.items()):
+                    value = getattr(stats, attr)
+                    sample_labels = dict(labels, koji_id=koji_id, method=method)
+                    if metric_type == 'histogram':
+                        if value.count:
+                            lines.extend(value.to_prometheus(name, **sample_labels))
+                    else:
+                        lines.append('{}{{{}}} {}'.format(
+                            name, format_prometheus_labels(**sample_labels), value,
+                        ))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, **labels):
+        """
+        Atomically writes the statistics to a file in Prometheus text format, suitable
+        for node_exporter's textfile collector.
+        """
+        write_prometheus_textfile(path, self.to_prometheus(**labels))
+
+    def log_summary(self, log):
+        """
+        Logs a summary of the statistics, methods with the highest total duration
+        first.
+        """
+        with self.lock:
+            items = sorted(
+                self.methods.items(),
+                key=lambda item: item[1].duration.sum,
+                reverse=True,
+            )
+            for (koji_id, method), stats in items:
+                log.info(
+                    "Koji calls of {} on {}: calls={}, batched_calls={}, retries={}, "
+                    "request_bytes={}, total_time={:.2f}s"
+                    .format(method, koji_id, stats.calls, stats.batched_calls,
+                            stats.retries, stats.request_bytes, stats.duration.sum)
+                )
+
+
+koji_call_stats = KojiCallStats()
+
+
 class KojiSession(object):
     """
     Koschei's wrapper around koji.ClientSession.
@@ -39,6 +228,7 @@ class KojiSession(object):
     keys for this session (`koji_config` or `secondary_koji_config`).
     Also adds `koji_id` attribute which specifies whther this is primary or secondary
     session.
+    All calls are recorded in `koji_call_stats`.
     """
     def __init__(self, koji_id='primary', anonymous=True):
         """
@@ -62,10 +252,54 @@ class KojiSession(object):
         }
         opts.update(self.config.get('session_opts', {}))
         session = koji.ClientSession(server, opts)
+        self.__instrument(session)
         if not self.__anonymous:
             getattr(session, self.config['login_method'])(**self.config['login_args'])
         return session
 
+    def __instrument(self, session):
+        """
+        Wraps internal methods of given koji.ClientSession to record statistics of
+        calls into `koji_call_stats`. `_callMethod` is invoked once per method call
+        (or once per queued call in multicall mode), `_sendCall` once per attempt to
+        send a request.
+        """
+        call_method = session._callMethod
+        send_call = session._sendCall
+        state = dict(method=None, attempts=0, batched=0)
+
+        def instrumented_call_method(name, *args, **kwargs):
+            if session.multicall:
+                koji_call_stats.record_batched_call(self.koji_id, name)
+                state['batched'] += 1
+                return call_method(name, *args, **kwargs)
+            multicall_size = None
+            if name == 'multiCall':
+                multicall_size = state['batched']
+                state['batched'] = 0
+            outer_method, outer_attempts = state['method'], state['attempts']
+            state['method'], state['attempts'] = name, 0
+            started = time.time()
+            try:
+                return call_method(name, *args, **kwargs)
+            finally:
+                koji_call_stats.record_call(
+                    self.koji_id, name, time.time() - started,
+                    multicall_size=multicall_size,
+                )
+                state['method'], state['attempts'] = outer_method, outer_attempts
+
+        def instrumented_send_call(handler, headers, request):
+            state['attempts'] += 1
+            koji_call_stats.record_request(
+                self.koji_id, state['method'], len(request),
+                retry=state['attempts'] > 1,
+            )
+            return send_call(handler, headers, request)
+
+        session._callMethod = instrumented_call_method
+        session._sendCall = instrumented_send_call
+
     def __getattr__(self, name):
         return getattr(self.__proxied, name)
 
@@ -156,6 +390,145 @@ def get_last_srpm(koji_session, tag, name, relative=False, topdir=None):
                     rel_pathinfo.rpm(srpms[0]))
 
 
+def get_latest_builds(koji_session, tag, names, chunk_size=None):
+    """
+    Bulk query of latest builds of given packages in a tag (including inherited
+    builds).
+
+    :param koji_session: Koji session used for queries
+    :param tag: Koji tag name
+    :param names: List of package names
+    :param chunk_size: Passed to `itercall`
+    :return: List of build infos as returned by Koji's listTagged or None for packages
+             with no build tagged, in the same order as names
+    """
+    infos = itercall(
+        koji_session, list(names),
+        lambda k, name: k.listTagged(tag, latest=True, package=name, inherit=True),
+        chunk_size=chunk_size,
+    )
+    return [info[0] if info else None for info in infos]
+
+
+def get_last_srpms(koji_session, tag, names, relative=False, topdir=None,
+                   chunk_size=None):
+    """
+    Bulk version of `get_last_srpm`. Queries latest SRPMs of multiple packages
+    in the same tag using multicalls.
+
+    :param koji_session: Koji session used for queries
+    :param tag: Koji build tag name
+    :param names: List of package names
+    :param relative: Same as in `get_last_srpm`
+    :param topdir: Same as in `get_last_srpm`
+    :param chunk_size: Passed to `itercall`
+    :return: List of results of `get_last_srpm` (tuples or None), in the same order
+             as names
+    """
+    if not topdir:
+        topdir = koji_session.config[
+            'srpm_relative_path_root' if relative else 'topurl']
+    rel_pathinfo = koji.PathInfo(topdir=topdir)
+    infos = get_latest_builds(koji_session, tag, names, chunk_size=chunk_size)
+    builds = [info for info in infos if info]
+    srpms_list = itercall(
+        koji_session, builds,
+        lambda k, build: k.listRPMs(buildID=build['build_id'], arches='src'),
+        chunk_size=chunk_size,
+    )
+    srpm_map = {
+        build['build_id']: (
+            srpms[0],
+            rel_pathinfo.build(build) + '/' + rel_pathinfo.rpm(srpms[0]),
+        )
+        for build, srpms in zip(builds, srpms_list) if srpms
+    }
+    return [srpm_map.get(info['build_id']) if info else None for info in infos]
+
+
+def get_tag_inheritance(koji_session, tag):
+    """
+    Obtain names of given tag and all tags it inherits from.
+
+    :param koji_session: Koji session used for queries
+    :param tag: Koji tag name
+    :return: List of tag names, starting with given tag
+    """
+    return [tag] + [parent['name'] for parent in koji_session.getFullInheritance(tag)]
+
+
+def _get_tag_history_changes(koji_session, tag, table, name_key, after_event,
+                             before_event):
+    tags = get_tag_inheritance(koji_session, tag)
+    histories = itercall(
+        koji_session, tags,
+        lambda k, t: k.queryHistory(
+            tables=[table, 'tag_inheritance'],
+            tag=t,
+            afterEvent=after_event,
+            # beforeEvent is exclusive
+            beforeEvent=before_event + 1,
+        ),
+    )
+    names = set()
+    for history in histories:
+        if history is None or history['tag_inheritance']:
+            return None
+        names.update(entry[name_key] for entry in history[table])
+    return names
+
+
+def get_tag_package_changes(koji_session, tag, after_event, before_event):
+    """
+    Obtain names of packages whose listing in given tag (including inherited
+    listings) changed between two Koji events, using Koji history.
+
+    :param koji_session: Koji session used for queries
+    :param tag: Koji tag name
+    :param after_event: ID of the Koji event after which the changes are looked for
+    :param before_event: ID of the last Koji event to be considered
+    :return: Set of package names or None if the changes cannot be determined, such as
+             when the tag inheritance changed
+    """
+    return _get_tag_history_changes(
+        koji_session, tag, 'tag_packages', 'package.name', after_event, before_event,
+    )
+
+
+def get_tag_build_changes(koji_session, tag, after_event, before_event):
+    """
+    Obtain names of packages that had builds tagged into or untagged from given tag
+    (or tags it inherits from) between two Koji events, using Koji history.
+
+    :param koji_session: Koji session used for queries
+    :param tag: Koji tag name
+    :param after_event: ID of the Koji event after which the changes are looked for
+    :param before_event: ID of the last Koji event to be considered
+    :return: Set of package names or None if the changes cannot be determined, such as
+             when the tag inheritance changed
+    """
+    return _get_tag_history_changes(
+        koji_session, tag, 'tag_listing', 'name', after_event, before_event,
+    )
+
+
+def get_tag_packages(koji_session, tag, names):
+    """
+    Bulk query of listings of given packages in a tag (including inherited
+    listings). Packages that are not listed in the tag are omitted.
+
+    :param koji_session: Koji session used for queries
+    :param tag: Koji tag name
+    :param names: List of package names
+    :return: List of package listings as returned by Koji's listPackages
+    """
+    listings = itercall(
+        koji_session, list(names),
+        lambda k, name: k.listPackages(tagID=tag, pkgID=name, inherited=True),
+    )
+    return [listing[0] for listing in listings if listing]
+
+
 def koji_scratch_build(session, target, name, source, build_opts):
     """
     Submit a Koji scratch build.
@@ -199,6 +572,39 @@ def is_koji_fault(session, task_id):
         return True
 
 
+def get_koji_faults(session, task_ids, chunk_size=None):
+    """
+    Bulk version of `is_koji_fault`. Queries results of given finished Koji tasks using
+    multicalls.
+
+    :param session: Koji session used for queries
+    :param task_ids: List of Koji task IDs
+    :param chunk_size: How many tasks should be queried in a single multicall
+    :return: List of booleans in the same order as task_ids
+    """
+    if not chunk_size:
+        chunk_size = get_config('koji_config.multicall_chunk_size')
+    faults = []
+    for i in range(0, len(task_ids), chunk_size):
+        session.multicall = True
+        for task_id in task_ids[i:i + chunk_size]:
+            session.getTaskResult(task_id)
+        for result in session.multiCall():
+            if isinstance(result, dict):
+                # the call raised an exception, convert it the same way as Koji does
+                # for a direct call
+                fault = koji.convertFault(
+                    koji.Fault(result['faultCode'], result['faultString'])
+                )
+                faults.append(
+                    isinstance(fault, koji.LockError) or
+                    not isinstance(fault, koji.GenericError)
+                )
+            else:
+                faults.append(False)
+    return faults
+
+
 def cached_koji_call(fn):
     """
     Decorator that adds caching to a function that takes a Koji session. Decorated
@@ -269,6 +675,33 @@ def get_koji_arches(koji_session, build_tag):
 
 
 get_koji_arches_cached = cached_koji_call(get_koji_arches)
+get_tag_inheritance_cached = cached_koji_call(get_tag_inheritance)
+
+
+def normalize_requires(deps):
+    """
+    Convert dependency entries to strings in the form accepted by hawkey. Only plain
+    versioned or unversioned requires are kept, rich flags (such as rpmlib requires)
+    are dropped.
+
+    :param deps: Iterable of dicts with 'name', 'flags' (RPMSENSE bitmask) and
+                 'version' (EVR string) keys, as returned by Koji's `getRPMDeps`
+    :return: List of requires strings, e.g. ['foo >= 1.0', 'bar']
+    """
+    requires = []
+    for dep in deps:
+        flags = dep['flags']
+        if flags & ~(RPMSENSE_LESS | RPMSENSE_GREATER | RPMSENSE_EQUAL):
+            continue
+        order = ""
+        while flags:
+            old = flags
+            flags &= flags - 1
+            order += {RPMSENSE_LESS: '<',
+                      RPMSENSE_GREATER: '>',
+                      RPMSENSE_EQUAL: '='}[old ^ flags]
+        requires.append(("%s %s %s" % (dep['name'], order, dep['version'])).rstrip())
+    return requires
 
 
 def get_rpm_requires(koji_session, nvras, chunk_size=None):
@@ -285,20 +718,7 @@ def get_rpm_requires(koji_session, nvras, chunk_size=None):
                          lambda k, nvra: k.getRPMDeps(nvra, koji.DEP_REQUIRE),
                          chunk_size=chunk_size)
     for deps in deps_list:
-        requires = []
-        for dep in deps:
-            flags = dep['flags']
-            if flags & ~(RPMSENSE_LESS | RPMSENSE_GREATER | RPMSENSE_EQUAL):
-                continue
-            order = ""
-            while flags:
-                old = flags
-                flags &= flags - 1
-                order += {RPMSENSE_LESS: '<',
-                          RPMSENSE_GREATER: '>',
-                          RPMSENSE_EQUAL: '='}[old ^ flags]
-            requires.append(("%s %s %s" % (dep['name'], order, dep['version'])).rstrip())
-        yield requires
+        yield normalize_requires(deps)
 
 
 def get_rpm_requires_cached(session, koji_session, nvras):
@@ -314,36 +734,180 @@ def get_rpm_requires_cached(session, koji_session, nvras):
     return get_rpm_requires_inner(*nvras)
 
 
-def get_koji_load(koji_session, all_arches, arches):
+def get_rpm_requires_from_repo(session, koji_session, repo_requires, nvras):
+    """
+    Obtain BuildRequires of given packages using requires parsed from source repo
+    metadata (see `repo_util.get_srpm_requires`). SRPMs which are not present in the
+    metadata are queried from Koji using `get_rpm_requires_cached`.
+
+    :param session: Koschei session
+    :param koji_session: Koji session to be used for the fallback queries
+    :param repo_requires: dict mapping (name, version, release) to BuildRequires
+    :param nvras: List of NVRA dictionaries for the SRPMs
+    :return: A list containing a list of BuildRequires for each package
+    """
+    result = [
+        repo_requires.get((nvra['name'], nvra['version'], nvra['release']))
+        for nvra in nvras
+    ]
+    missing = [nvra for nvra, requires in zip(nvras, result) if requires is None]
+    if missing:
+        fallback = iter(get_rpm_requires_cached(session, koji_session, missing))
+        result = [
+            requires if requires is not None else next(fallback)
+            for requires in result
+        ]
+    return result
+
+
+def get_koji_load_snapshot(koji_session, all_arches):
+    """
+    Obtain per-arch load of Koji builders in default channel.
+
+    :param koji_session: Koji session to be used for the query
+    :param all_arches: List of all arches obtained from `get_koji_arches`
+    :return: A dictionary with `timestamp` key containing the time when the snapshot
+             was taken and `arches` key containing a dictionary mapping canonical
+             arch names to dictionaries with keys `hosts` (number of enabled hosts),
+             `ready` (number of ready hosts), `capacity` (sum of host capacities) and
+             `task_load` (sum of host loads, hosts that are not ready are counted as
+             fully loaded).
+    """
+    channel = koji_session.getChannel('default')
+    hosts = koji_session.listHosts(list(all_arches), channel['id'], enabled=True)
+    arch_snapshots = {}
+    for arch in set(map(koji.canonArch, all_arches)):
+        arch_hosts = [host for host in hosts if arch in host['arches'].split()]
+        arch_snapshots[arch] = dict(
+            hosts=len(arch_hosts),
+            ready=sum(1 for host in arch_hosts if host['ready']),
+            capacity=sum(host['capacity'] for host in arch_hosts),
+            task_load=sum(min(host['task_load'], host['capacity']) if host['ready']
+                          else host['capacity'] for host in arch_hosts),
+        )
+    return dict(timestamp=time.time(), arches=arch_snapshots)
+
+
+def get_koji_load_snapshot_cached(session, koji_session, all_arches):
+    """
+    Cached version of `get_koji_load_snapshot`. Additionally takes Koschei session
+    argument. The snapshot is stored in `koji_load` cache region, which can be shared
+    by all services, and it's refreshed (by whichever service asks first) once it's
+    older than `koji_config.load_snapshot_max_age` seconds.
+    """
+    cache = session.cache('koji_load')
+    key = 'koji_load-{}-{}'.format(koji_session.koji_id, ' '.join(sorted(all_arches)))
+    return cache.get_or_create(
+        key,
+        lambda: get_koji_load_snapshot(koji_session, all_arches),
+        expiration_time=get_config('koji_config.load_snapshot_max_age'),
+    )
+
+
+def get_koji_load(koji_session, all_arches, arches, snapshot=None):
     """
     Compute load of Koji instance.
 
     :param koji_session: Koji session to be used for the query
     :param all_arches: List of all arches obtained from `get_koji_arches`
     :param arches: Set of arches for package computed by `get_srpm_arches`
+    :param snapshot: Load snapshot obtained by `get_koji_load_snapshot`. Koji is
+                     queried directly if not given.
     :return: A floating point number from 0 to 1 representing the load
     """
     assert arches
     noarch = 'noarch' in arches
     if noarch:
         arches = all_arches
-    channel = koji_session.getChannel('default')
-    hosts = koji_session.listHosts(list(arches), channel['id'], enabled=True)
+    if snapshot is None:
+        snapshot = get_koji_load_snapshot(koji_session, arches)
     min_load = 1
     max_load = 0
     for arch in set(map(koji.canonArch, arches)):
-        arch_hosts = [host for host in hosts if arch in host['arches'].split()]
-        capacity = sum(host['capacity'] for host in arch_hosts)
-        load = sum(min(host['task_load'], host['capacity']) if host['ready']
-                   else host['capacity'] for host in arch_hosts)
-        arch_load = load / capacity if capacity else 1.0
+        arch_snapshot = snapshot['arches'].get(arch)
+        capacity = arch_snapshot['capacity'] if arch_snapshot else 0
+        arch_load = arch_snapshot['task_load'] / capacity if capacity else 1.0
         min_load = min(min_load, arch_load)
         max_load = max(max_load, arch_load)
     return min_load if noarch else max_load
 
 
+def add_koji_load(snapshot, all_arches, arches, load):
+    """
+    Account for a newly submitted build in a load snapshot, so that it can be used for
+    scheduling more builds before a fresh snapshot is obtained. Modifies the snapshot
+    in place.
+
+    :param snapshot: Load snapshot obtained by `get_koji_load_snapshot`
+    :param all_arches: List of all arches obtained from `get_koji_arches`
+    :param arches: Set of arches of the build computed by `get_srpm_arches`
+    :param load: Estimated load a build adds to builders of each of its arches
+    """
+    arch_snapshots = snapshot['arches']
+    if 'noarch' in arches:
+        # noarch builds are built on a single arch, assume the least loaded one
+        arches = [
+            min(
+                (arch for arch in set(map(koji.canonArch, all_arches))
+                 if arch_snapshots.get(arch, {}).get('capacity')),
+                key=lambda arch: (arch_snapshots[arch]['task_load'] /
+                                  arch_snapshots[arch]['capacity']),
+                default=None,
+            )
+        ]
+    for arch in set(koji.canonArch(arch) for arch in arches if arch):
+        if arch in arch_snapshots:
+            arch_snapshots[arch]['task_load'] += load
+
+
+ARCH_HEADERS = ['BUILDARCHS', 'EXCLUDEARCH', 'EXCLUSIVEARCH']
+
+
+def get_srpm_arch_headers(koji_session, nvras, chunk_size=None):
+    """
+    Obtain SRPM headers needed for computing build architectures of given packages
+    (NVRAs). Queried in bulk for performance reasons.
+
+    :param koji_session: Koji session to be used for the query
+    :param nvras: List of NVRA dictionaries for the SRPMs
+    :param chunk_size: Passed to `itercall`
+    :return: A generator yielding a header dictionary for each package. The dictionary
+             is empty if the SRPM was not found.
+    """
+    headers_list = itercall(
+        koji_session, nvras,
+        lambda k, nvra: k.getRPMHeaders(rpmID=nvra, headers=ARCH_HEADERS),
+        chunk_size=chunk_size,
+    )
+    for headers in headers_list:
+        yield headers or {}
+
+
+def get_srpm_arch_headers_cached(session, koji_session, nvras):
+    """
+    Cached version of `get_srpm_arch_headers`. Additionally takes Koschei session
+    argument. The headers never change for given NVRA, so the cache can be persistent.
+    Missing SRPMs are not cached.
+    """
+    cache = session.cache('srpm_arch_headers')
+    nvra_map = {
+        '{name}-{version}-{release}.{arch}'.format(**nvra): nvra for nvra in nvras
+    }
+
+    @cache.cache_multi_on_arguments(
+        namespace='srpm_arch_headers-' + koji_session.koji_id,
+        should_cache_fn=bool,
+    )
+    def get_srpm_arch_headers_inner(*keys):
+        return list(get_srpm_arch_headers(koji_session, [nvra_map[k] for k in keys]))
+
+    return get_srpm_arch_headers_inner(
+        *('{name}-{version}-{release}.{arch}'.format(**nvra) for nvra in nvras)
+    )
+
+
 def get_srpm_arches(koji_session, all_arches, nvra, arch_override=None,
-                    build_arches=None):
+                    build_arches=None, headers=None):
     """
     Compute architectures that should be used for a build. Computation is based on the one
     in Koji (kojid/getArchList).
@@ -353,15 +917,15 @@ def get_srpm_arches(koji_session, all_arches, nvra, arch_override=None,
     :param nvra: NVRA dict of the SRPM
     :param arch_override: User specified arch override
     :param build_arches: List of allowed arches for building. Taken from config by default
+    :param headers: SRPM headers obtained by `get_srpm_arch_headers`. Queried from Koji
+                    if not given.
     :return: Set of architectures that can be passed to `koji_scratch_build`. May be
              empty, in which case no build should be submitted.
     """
     archlist = all_arches
     tag_archlist = {koji.canonArch(a) for a in archlist}
-    headers = koji_session.getRPMHeaders(
-        rpmID=nvra,
-        headers=['BUILDARCHS', 'EXCLUDEARCH', 'EXCLUSIVEARCH'],
-    )
+    if headers is None:
+        headers = koji_session.getRPMHeaders(rpmID=nvra, headers=ARCH_HEADERS)
     if not headers:
         return None
     buildarchs = headers.get('BUILDARCHS', [])
@@ -446,16 +1010,25 @@ class KojiRepoDescriptor(object):
     def __lt__(self, other):
         return self.repo_id < other.repo_id
 
+    def _url_for_arch(self, arch):
+        topurl = get_koji_config(self.koji_id, 'topurl')
+        url = '{topurl}/repos/{build_tag}/{repo_id}/{arch}'
+        return url.format(topurl=topurl, build_tag=self.build_tag,
+                          repo_id=self.repo_id, arch=arch)
+
     @property
     def url(self):
         """
         Produce URL where the repo can be downloaded.
         """
-        arch = get_config('dependency.repo_arch')
-        topurl = get_koji_config(self.koji_id, 'topurl')
-        url = '{topurl}/repos/{build_tag}/{repo_id}/{arch}'
-        return url.format(topurl=topurl, build_tag=self.build_tag,
-                          repo_id=self.repo_id, arch=arch)
+        return self._url_for_arch(get_config('dependency.repo_arch'))
+
+    @property
+    def source_url(self):
+        """
+        Produce URL where the source (SRPM) repo can be downloaded.
+        """
+        return self._url_for_arch('src')
 
 
 def create_repo_descriptor(koji_session, repo_id):
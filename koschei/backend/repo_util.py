@@ -21,11 +21,30 @@ Utility functions for downloading repos.
 """
 
 import os
+import bz2
+import gzip
+import lzma
 import hawkey
 import librepo
 import shutil
 
+from xml.etree import ElementTree
+from rpm import RPMSENSE_LESS, RPMSENSE_GREATER, RPMSENSE_EQUAL
+
 from koschei.config import get_config
+from koschei.backend.koji_util import normalize_requires
+
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+RPM_NS = '{http://linux.duke.edu/metadata/rpm}'
+
+# mapping of repodata dependency flags to RPMSENSE bitmask used by Koji
+REPODATA_FLAGS = {
+    'EQ': RPMSENSE_EQUAL,
+    'LT': RPMSENSE_LESS,
+    'GT': RPMSENSE_GREATER,
+    'LE': RPMSENSE_LESS | RPMSENSE_EQUAL,
+    'GE': RPMSENSE_GREATER | RPMSENSE_EQUAL,
+}
 
 
 def get_repo(repo_dir, repo_descriptor, download=False):
@@ -96,3 +115,98 @@ def load_sack(repo_dir, repo_descriptor, download=False):
     if repo:
         sack.load_repo(repo, load_filelists=True, build_cache=download)
         return sack
+
+
+def _open_metadata(path):
+    """
+    Open (possibly compressed) repodata file for reading in binary mode.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _repodata_evr(entry):
+    """
+    Format EVR of repodata dependency entry the same way as Koji's getRPMDeps does.
+    """
+    evr = entry.get('ver') or ''
+    epoch = entry.get('epoch')
+    if epoch and epoch != '0':
+        evr = '{}:{}'.format(epoch, evr)
+    release = entry.get('rel')
+    if release:
+        evr = '{}-{}'.format(evr, release)
+    return evr
+
+
+def parse_srpm_requires(primary_path):
+    """
+    Parse BuildRequires of all SRPMs from primary metadata of a source repo.
+    The file is processed in a single streaming pass, so that the whole document is
+    never kept in memory.
+
+    :primary_path: path to primary.xml (may be compressed)
+    :return: dict mapping (name, version, release) to list of BuildRequires
+    """
+    srpm_requires = {}
+    with _open_metadata(primary_path) as primary:
+        for _, elem in ElementTree.iterparse(primary):
+            if elem.tag != COMMON_NS + 'package':
+                continue
+            if elem.findtext(COMMON_NS + 'arch') == 'src':
+                version = elem.find(COMMON_NS + 'version')
+                deps = [
+                    {
+                        'name': entry.get('name'),
+                        'flags': REPODATA_FLAGS.get(entry.get('flags'), 0),
+                        'version': _repodata_evr(entry),
+                    }
+                    for entry in elem.iterfind(
+                        '{0}format/{1}requires/{1}entry'.format(COMMON_NS, RPM_NS)
+                    )
+                ]
+                key = (
+                    elem.findtext(COMMON_NS + 'name'),
+                    version.get('ver'),
+                    version.get('rel'),
+                )
+                srpm_requires[key] = normalize_requires(deps)
+            elem.clear()
+    return srpm_requires
+
+
+def get_srpm_requires(repo_dir, repo_descriptor, download=False):
+    """
+    Obtain BuildRequires of all SRPMs present in source repo corresponding to given
+    repo descriptor, either by loading its metadata from disk, or by downloading it
+    from Koji. Only primary metadata is downloaded.
+
+    :repo_dir: path to directory where the repo is/should be stored
+    :repo_descriptor: which repo to obtain
+    :download: whether to download or load locally
+    :return: dict mapping (name, version, release) to list of BuildRequires or None if
+             the source repo is not available
+    """
+    h = librepo.Handle()
+    repo_path = os.path.join(repo_dir, str(repo_descriptor))
+    if download:
+        h.destdir = repo_path
+        shutil.rmtree(repo_path, ignore_errors=True)
+        os.makedirs(repo_path)
+    h.repotype = librepo.LR_YUMREPO
+    h.urls = [repo_descriptor.source_url if download else repo_path]
+    h.local = not download
+    h.yumdlist = ['primary']
+    try:
+        result = h.perform(librepo.Result())
+    except librepo.LibrepoException as e:
+        # source repos are optional in Koji, treat download failures as absence
+        if download or e.args[0] == librepo.LRE_NOURL:
+            return None
+        raise
+    return parse_srpm_requires(result.yum_repo['primary'])
@@ -29,6 +29,8 @@ import time
 
 from koschei import util
 from koschei.config import get_config
+from koschei.db import SqlStats
+from koschei.backend import koji_util, KoscheiBackendSession
 
 
 def load_service(name):
@@ -58,6 +60,16 @@ class Service(object):
             '{}.{}'.format(type(self).__module__, type(self).__name__),
         )
         self.service_config = get_config('services').get(self.get_name(), {})
+        self.koji_stats_logged = time.time()
+        # SQL statements executed by main since the last summary
+        self.sql_stats = SqlStats()
+        self.sql_stats_logged = time.time()
+
+    def create_session(self):
+        """
+        Creates a new session for use in another thread of the service.
+        """
+        return KoscheiBackendSession()
 
     @classmethod
     def get_name(cls):
@@ -96,14 +108,53 @@ class Service(object):
         self.log.info("{name} started".format(name=self.get_name()))
         while True:
             self.notify_watchdog()
+            iteration_stats = SqlStats()
             try:
-                self.main()
+                with iteration_stats.collect():
+                    self.main()
             finally:
                 self.db.rollback()
+                self.sql_stats.merge(iteration_stats)
+            self.log.debug("SQL statements of iteration: {}"
+                           .format(iteration_stats.summary()))
+            self.report_koji_stats()
+            self.report_sql_stats()
             self.memory_check()
             self.notify_watchdog()
             time.sleep(interval)
 
+    def report_koji_stats(self):
+        """
+        Export statistics of Koji calls made by the service, as specified by
+        `koji_stats` configuration.
+        """
+        textfile = get_config('koji_stats.prometheus_textfile')
+        if textfile:
+            koji_util.koji_call_stats.write_prometheus(
+                textfile.format(service=self.get_name()),
+                service=self.get_name(),
+            )
+        log_interval = get_config('koji_stats.log_interval')
+        if log_interval and time.time() - self.koji_stats_logged >= log_interval:
+            koji_util.koji_call_stats.log_summary(self.log)
+            self.koji_stats_logged = time.time()
+
+    def report_sql_stats(self):
+        """
+        Periodically log statistics of SQL statements executed by the service's main
+        method, as specified by `sql_stats` configuration. Statistics are reset after
+        being logged.
+        """
+        log_interval = get_config('sql_stats.log_interval')
+        if log_interval and time.time() - self.sql_stats_logged >= log_interval:
+            self.sql_stats.log_summary(
+                self.log,
+                "last {:.0f}s".format(time.time() - self.sql_stats_logged),
+                top=get_config('sql_stats.top_statements'),
+            )
+            self.sql_stats = SqlStats()
+            self.sql_stats_logged = time.time()
+
     @classmethod
     def find_service(cls, name):
         """
@@ -23,13 +23,22 @@ from sqlalchemy.sql import insert
 from sqlalchemy.orm.exc import ObjectDeletedError, StaleDataError
 
 from koschei.config import get_config
+from koschei.db import PreparedStatement
 from koschei.locks import pg_session_lock, Locked, LOCK_BUILD_RESOLVER
 from koschei.models import (
-    Collection, Package, AppliedChange, Build,
+    Collection, AppliedChange, Build,
 )
 
 from koschei.backend.services.resolver import Resolver
 
+# uses ix_builds_unprocessed
+UNPROCESSED_BUILDS = PreparedStatement('unprocessed_builds', """
+    SELECT build.* FROM build JOIN package ON package.id = build.package_id
+        WHERE build.deps_resolved IS NULL AND build.repo_id IS NOT NULL
+            AND package.collection_id = :collection_id
+        ORDER BY build.repo_id
+""")
+
 
 class BuildResolver(Resolver):
     """
@@ -42,6 +51,7 @@ class BuildResolver(Resolver):
         """
         for collection in self.db.query(Collection).all():
             self.process_builds(collection)
+        self.db.log_prepared_statements(self.log)
 
     def process_builds(self, collection):
         """
@@ -52,11 +62,7 @@ class BuildResolver(Resolver):
         """
         builds = (
             self.db.query(Build)
-            .join(Build.package)
-            .filter(Build.deps_resolved == None)
-            .filter(Build.repo_id != None)
-            .filter(Package.collection_id == collection.id)
-            .order_by(Build.repo_id)
+            .from_prepared(UNPROCESSED_BUILDS, collection_id=collection.id)
             .all()
         )
 
@@ -157,6 +163,7 @@ class BuildResolver(Resolver):
                 changes = self.create_dependency_changes(
                     prev_deps, curr_deps,
                     build_id=build.id,
+                    build_started=build.started,
                 )
                 if changes:
                     self.db.execute(insert(AppliedChange, changes))
@@ -16,17 +16,120 @@
 #
 # Author: Michael Simacek <msimacek@redhat.com>
 
+import sys
+import threading
+import time
+
 import koji
 
 from sqlalchemy.orm.exc import ObjectDeletedError, StaleDataError
 
-from koschei import plugin, backend
+from koschei import plugin, backend, partitions
+from koschei.db import SqlStats
 from koschei.models import Build, ResourceConsumptionStats, ScalarStats
 from koschei.backend.service import Service
-from koschei.backend.koji_util import itercall
+from koschei.backend.koji_util import (
+    itercall, Histogram, KojiCallStats, write_prometheus_textfile,
+)
+
+
+class PollingTask(object):
+    """
+    A part of polling that is run periodically in its own thread, independently
+    of other tasks. Tracks durations of its runs.
+
+    :param name: Name of the task, used as key in `services.polling.tasks`
+                 configuration
+    :param method: Name of Polling method that implements the task
+    """
+    def __init__(self, name, method, interval, timeout):
+        self.name = name
+        self.method = method
+        self.interval = interval
+        self.timeout = timeout
+        self.duration = Histogram(KojiCallStats.DURATION_BUCKETS)
+        self.last_duration = None
+        # time when the current run started, None when not running
+        self.started = None
+        self.exception = None
+        self.thread = None
+
+    def start(self, polling):
+        """
+        Starts the task's thread.
+
+        :param polling: Polling instance with its own session, used exclusively by
+                        this task
+        """
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(polling,),
+            name='polling-' + self.name,
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, polling):
+        try:
+            while True:
+                self.run_once(polling)
+                time.sleep(self.interval)
+        except Exception as e:
+            polling.log.exception("Polling task {} failed".format(self.name))
+            self.exception = e
+
+    def run_once(self, polling):
+        self.started = time.time()
+        sql_stats = SqlStats()
+        try:
+            with sql_stats.collect():
+                getattr(polling, self.method)()
+        finally:
+            polling.db.rollback()
+            self.last_duration = time.time() - self.started
+            self.started = None
+            self.duration.observe(self.last_duration)
+            polling.log.info("Polling task {} finished in {:.2f}s, SQL {}"
+                             .format(self.name, self.last_duration,
+                                     sql_stats.summary()))
+
+    def is_overdue(self):
+        started = self.started
+        return bool(self.timeout and started and
+                    time.time() - started > self.timeout)
 
 
 class Polling(Service):
+    """
+    Polls Koji for changes. Consists of independent tasks, that are run
+    concurrently, each with its own interval and timeout (see `TASKS`).
+    """
+    # task name -> method
+    TASKS = (
+        ('builds', 'poll_builds'),
+        ('packages', 'refresh_packages'),
+        ('polling_event', 'dispatch_polling_event'),
+        ('latest_builds', 'refresh_latest_builds'),
+        ('stats', 'refresh_stats'),
+        ('stats_deltas', 'fold_stats_deltas'),
+        ('partitions', 'create_partitions'),
+    )
+
+    def get_tasks(self):
+        """
+        Returns PollingTasks according to configuration. Tasks with no interval are
+        disabled.
+        """
+        tasks = []
+        tasks_config = self.service_config.get('tasks', {})
+        for name, method in self.TASKS:
+            task_config = tasks_config.get(name, {})
+            interval = task_config.get('interval')
+            if interval is not None:
+                tasks.append(PollingTask(name, method, interval,
+                                         task_config.get('timeout')))
+        return tasks
+
     def poll_builds(self):
         self.log.info('Polling running Koji tasks...')
         running_builds = self.db.query(Build)\
@@ -35,6 +138,7 @@ class Polling(Service):
         infos = itercall(self.session.koji('primary'), running_builds,
                          lambda k, b: k.getTaskInfo(b.task_id))
 
+        build_states = []
         for task_info, build in zip(infos, running_builds):
             try:
                 name = build.package.name
@@ -42,23 +146,103 @@ class Polling(Service):
                               .format(id=build.task_id, name=name,
                                       info=task_info))
                 state = koji.TASK_STATES[task_info['state']]
-                backend.update_build_state(self.session, build, state)
+                build_states.append((build, state))
             except (StaleDataError, ObjectDeletedError):
                 # build was deleted concurrently
                 self.db.rollback()
                 continue
+        backend.update_build_states(self.session, build_states)
 
-    def main(self):
-        self.poll_builds()
+    def refresh_packages(self):
         self.log.info('Polling Koji packages...')
         backend.refresh_packages(self.session)
         self.db.commit()
+
+    def dispatch_polling_event(self):
         plugin.dispatch_event('polling_event', self.session)
         self.db.commit()
+
+    def refresh_latest_builds(self):
         self.log.info('Polling latest real builds...')
         backend.refresh_latest_builds(self.session)
         self.db.commit()
+
+    def refresh_stats(self):
+        """
+        Regenerates statistics from scratch. Statistics are kept up to date by
+        triggers, this folds in the changes they recorded in ScalarStatsDelta and
+        reconciles changes they don't account for, such as deleted builds.
+        """
         self.log.info('Refreshing statistics...')
         self.db.refresh_materialized_view(ResourceConsumptionStats, ScalarStats)
         self.db.commit()
+
+    def fold_stats_deltas(self):
+        """
+        Folds statistics changes recorded by triggers into ScalarStats, so that
+        they don't accumulate until the next full refresh.
+        """
+        ScalarStats.fold_deltas(self.db)
+        self.db.commit()
+
+    def create_partitions(self):
+        """
+        Creates monthly partitions of build and resolution tables ahead of time.
+        """
+        self.log.info('Creating partitions...')
+        partitions.create_partitions(
+            self.db,
+            self.service_config.get('partition_months_ahead', 2),
+        )
+        self.db.commit()
+
+    def main(self):
+        """
+        Runs all enabled tasks once, one after another.
+        """
+        for task in self.get_tasks():
+            task.run_once(self)
         self.log.info('Polling finished')
+
+    def run_service(self):
+        """
+        Runs each task in its own thread with its own session. The main thread
+        supervises the tasks - if a task fails or exceeds its timeout, the service
+        exits.
+        """
+        self.log.info("{name} started".format(name=self.get_name()))
+        tasks = self.get_tasks()
+        for task in tasks:
+            task.start(type(self)(self.create_session()))
+        while True:
+            self.notify_watchdog()
+            for task in tasks:
+                if task.exception:
+                    raise task.exception
+                if task.is_overdue():
+                    self.log.error("Polling task {} exceeded its timeout of {}s. "
+                                   "Exiting.".format(task.name, task.timeout))
+                    sys.exit(4)
+            self.report_koji_stats()
+            self.report_task_stats(tasks)
+            self.memory_check()
+            time.sleep(self.service_config.get('supervisor_interval', 10))
+
+    def report_task_stats(self, tasks):
+        """
+        Exports durations of polling tasks to a file in Prometheus text format, if
+        configured by `services.polling.prometheus_textfile`.
+        """
+        textfile = self.service_config.get('prometheus_textfile')
+        if not textfile:
+            return
+        lines = [
+            '# HELP koschei_polling_task_duration_seconds Duration of polling tasks',
+            '# TYPE koschei_polling_task_duration_seconds histogram',
+        ]
+        for task in tasks:
+            if task.duration.count:
+                lines.extend(task.duration.to_prometheus(
+                    'koschei_polling_task_duration_seconds', task=task.name,
+                ))
+        write_prometheus_textfile(textfile, '\n'.join(lines) + '\n')
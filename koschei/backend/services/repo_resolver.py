@@ -29,6 +29,7 @@ from sqlalchemy.sql import insert
 
 from koschei import util, backend
 from koschei.config import get_config
+from koschei.db import PreparedStatement
 from koschei.backend import koji_util
 from koschei.plugin import dispatch_event
 from koschei.util import stopwatch
@@ -50,6 +51,11 @@ ResolutionOutput = namedtuple(
     ['package', 'prev_resolved', 'resolved', 'problems', 'changes', 'last_build_id'],
 )
 
+# ordering to prevent deadlocks
+LOCK_PACKAGES = PreparedStatement('lock_packages', """
+    SELECT id FROM package WHERE id = ANY(:ids) ORDER BY id FOR UPDATE
+""")
+
 
 class RepoResolver(Resolver):
     def main(self):
@@ -85,6 +91,7 @@ class RepoResolver(Resolver):
             total_time.stop()
             total_time.display()
             self.log.info("Dependency cache stats: %s", self.dependency_cache.get_stats())
+            self.db.log_prepared_statements(self.log)
         elif collection.latest_repo_resolved:
             # we don't have a new repo, but we can at least resolve new packages
             new_packages = self.get_packages(collection, only_new=True)
@@ -203,6 +210,7 @@ class RepoResolver(Resolver):
         brs = self.get_rpm_requires(
             collection,
             [p.srpm_nvra for p in packages],
+            repo_id=repo_id,
         )
 
         self.log.info(
@@ -306,13 +314,7 @@ class RepoResolver(Resolver):
             self.db.expire(p.package)
 
         # lock the packages to be updated
-        (
-            self.db.query(Package.id)
-            .filter(Package.id.in_(package_ids))
-            .order_by(Package.id)  # ordering to prevent deadlocks
-            .with_for_update()
-            .all()
-        )
+        self.db.execute_prepared(LOCK_PACKAGES, ids=package_ids).fetchall()
 
         # find latest resolution problems to be compared for change
         previous_problems = {
@@ -383,12 +385,16 @@ class RepoResolver(Resolver):
                 self.db.add(resolution_change)
                 problem_entries.append((resolution_change, pkg_result.problems))
 
-        # populate resolution changes' ids
+        # populate resolution changes' ids and timestamps
         self.db.flush()
 
         # set problem resolution_ids and prepare dict form
         to_insert = [
-            dict(resolution_id=resolution_change.id, problem=problem)
+            dict(
+                resolution_id=resolution_change.id,
+                resolution_timestamp=resolution_change.timestamp,
+                problem=problem,
+            )
             for resolution_change, problems in problem_entries
             for problem in problems
         ]
@@ -17,6 +17,9 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
+import os
+import shutil
+
 from collections import OrderedDict, namedtuple
 
 from sqlalchemy.orm import undefer
@@ -25,7 +28,8 @@ from sqlalchemy.exc import IntegrityError
 
 from koschei import util
 from koschei.config import get_config
-from koschei.backend import koji_util, depsolve
+from koschei.db import PreparedStatement
+from koschei.backend import koji_util, depsolve, repo_util
 from koschei.backend.service import Service
 from koschei.models import Dependency, Build
 from koschei.util import Stopwatch, stopwatch
@@ -37,6 +41,25 @@ DepTuple = namedtuple(
     ['id', 'name', 'epoch', 'version', 'release', 'arch'],
 )
 
+# NEVRA lookup is executed for each dependency not found in DependencyCache,
+# NULL epoch needs a separate statement, because it is compared using IS NULL
+DEPENDENCY_BY_NEVRA = PreparedStatement('dependency_by_nevra', """
+    SELECT id, name, epoch, version, release, arch FROM dependency
+        WHERE name = :name AND epoch = :epoch AND version = :version
+            AND release = :release AND arch = :arch
+""")
+DEPENDENCY_BY_NEVRA_NO_EPOCH = PreparedStatement('dependency_by_nevra_no_epoch', """
+    SELECT id, name, epoch, version, release, arch FROM dependency
+        WHERE name = :name AND epoch IS NULL AND version = :version
+            AND release = :release AND arch = :arch
+""")
+PREV_BUILD_FOR_COMPARISON = PreparedStatement('prev_build_for_comparison', """
+    SELECT * FROM build
+        WHERE package_id = :package_id AND started < :started AND deps_resolved
+        ORDER BY started DESC
+        LIMIT 1
+""")
+
 
 class DependencyCache(object):
     def __init__(self, db, capacity):
@@ -82,13 +105,14 @@ class DependencyCache(object):
     def _get_or_create_nevra(self, nevra):
         dep = self.nevras.get(nevra)
         if dep is None:
-            dep = self.db.query(*Dependency.inevra)\
-                .filter((Dependency.name == nevra[0]) &
-                        (Dependency.epoch == nevra[1]) &
-                        (Dependency.version == nevra[2]) &
-                        (Dependency.release == nevra[3]) &
-                        (Dependency.arch == nevra[4]))\
-                .first()
+            params = dict(name=nevra[0], version=nevra[2], release=nevra[3],
+                          arch=nevra[4])
+            if nevra[1] is None:
+                statement = DEPENDENCY_BY_NEVRA_NO_EPOCH
+            else:
+                statement = DEPENDENCY_BY_NEVRA
+                params['epoch'] = nevra[1]
+            dep = self.db.execute_prepared(statement, **params).first()
             if dep is None:
                 kwds = dict(name=nevra[0], epoch=nevra[1], version=nevra[2],
                             release=nevra[3], arch=nevra[4])
@@ -105,6 +129,7 @@ class DependencyCache(object):
                 dep = DepTuple(id=dep_id, **kwds)
                 self.inserts += 1
             else:
+                dep = DepTuple(*dep)
                 self.misses += 1
             self._add(dep)
         else:
@@ -157,6 +182,8 @@ class Resolver(Service):
         super(Resolver, self).__init__(session)
         capacity = get_config('dependency.dependency_cache_capacity')
         self.dependency_cache = DependencyCache(db=self.db, capacity=capacity)
+        # (repo_descriptor, requires) of the last used source repo
+        self.source_repo_requires = (None, None)
 
     def get_build_group(self, collection, repo_id):
         """
@@ -171,17 +198,56 @@ class Resolver(Service):
         )
         return group
 
-    def get_rpm_requires(self, collection, nvras):
+    def get_rpm_requires(self, collection, nvras, repo_id=None):
         """
         Returns a list of lists of build requires of packages with given
         name-version-release-arch.
+        If `dependency.srpm_requires_from_repo` is enabled and repo_id is given, the
+        requires are read from the corresponding source repo metadata and Koji is
+        queried only for SRPMs missing from it.
         """
+        koji_session = self.session.secondary_koji_for(collection)
+        if repo_id and get_config('dependency.srpm_requires_from_repo'):
+            repo_descriptor = self.create_repo_descriptor(collection, repo_id)
+            repo_requires = (
+                self.get_source_repo_requires(repo_descriptor)
+                if repo_descriptor else None
+            )
+            if repo_requires is not None:
+                return koji_util.get_rpm_requires_from_repo(
+                    self.session,
+                    koji_session,
+                    repo_requires,
+                    nvras,
+                )
         return koji_util.get_rpm_requires_cached(
             self.session,
-            self.session.secondary_koji_for(collection),
+            koji_session,
             nvras,
         )
 
+    def get_source_repo_requires(self, repo_descriptor):
+        """
+        Returns BuildRequires of all SRPMs in the source repo for given repo
+        descriptor. Only the most recently used source repo is kept, both in
+        memory and on disk. Returns None if the source repo is not available.
+        """
+        descriptor, requires = self.source_repo_requires
+        if descriptor != repo_descriptor:
+            repo_dir = os.path.join(get_config('directories.cachedir'), 'srpm-repodata')
+            shutil.rmtree(repo_dir, ignore_errors=True)
+            self.log.info("Downloading source repo %s", repo_descriptor)
+            requires = repo_util.get_srpm_requires(
+                repo_dir,
+                repo_descriptor,
+                download=True,
+            )
+            if requires is None:
+                self.log.info("Source repo %s not available, using Koji",
+                              repo_descriptor)
+            self.source_repo_requires = (repo_descriptor, requires)
+        return requires
+
     @stopwatch(total_time)
     def create_dependency_changes(self, deps1, deps2, **rest):
         """
@@ -254,11 +320,12 @@ class Resolver(Service):
         """
         return (
             self.db.query(Build)
-            .filter_by(package_id=build.package_id)
-            .filter(Build.started < build.started)
-            .filter(Build.deps_resolved == True)
-            .order_by(Build.started.desc())
             .options(undefer('dependency_keys'))
+            .from_prepared(
+                PREV_BUILD_FOR_COMPARISON,
+                package_id=build.package_id,
+                started=build.started,
+            )
             .first()
         )
 
@@ -16,6 +16,12 @@
 #
 # Author: Michael Simacek <msimacek@redhat.com>
 
+from collections import defaultdict
+from itertools import islice
+
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import literal_column
+
 from koschei import backend
 from koschei.config import get_config
 from koschei.backend import koji_util
@@ -26,17 +32,143 @@ from koschei.models import Package, Build, Collection
 class Scheduler(Service):
     koji_anonymous = False
 
-    def get_priorities(self):
-        priority_expr = Package.current_priority_expression(
-            collection=Collection,
-            last_build=Build,
+    def query_candidates(self):
+        """
+        Returns a query for schedulable packages, yielding rows with package id,
+        current priority, precomputed priority and (uncoefficiented) time priority.
+        Equivalent to filtering by Package.current_priority_expression, but uses
+        Package.precomputed_priority.
+        """
+        time_priority = Package.time_priority_expression(Build)
+        priority_expr = (
+            Package.precomputed_priority +
+            time_priority * Collection.priority_coefficient
         )
-        return self.db.query(Package.id, priority_expr)\
+        return self.db.query(
+            Package.id,
+            priority_expr.label('priority'),
+            Package.precomputed_priority,
+            time_priority.label('time_priority'),
+        )\
             .join(Package.collection)\
             .join(Package.last_build)\
-            .filter(priority_expr != None)\
-            .order_by(priority_expr.desc())\
+            .filter(Package.precomputed_priority != None)\
+            .filter(Build.last_complete)\
+            .filter(Collection.latest_repo_resolved == True)
+
+    def get_priorities(self):
+        """
+        Generates (package_id, priority) pairs of schedulable packages in descending
+        order of priority.
+
+        In order to avoid computing priorities of all packages, candidates are
+        selected using indices - packages with the highest precomputed priority and
+        packages with the oldest last builds. A package that is not among them cannot
+        have higher priority than a bound given by the last candidates of both lists,
+        so candidates above the bound are in correct order. Priorities of all packages
+        are computed only if all of those candidates are consumed and the bound is not
+        below the build threshold.
+        """
+        limit = get_config('priorities.scheduler_candidates')
+        by_precomputed = self.query_candidates()\
+            .order_by(Package.precomputed_priority.desc())\
+            .limit(limit)\
+            .all()
+        by_time = self.query_candidates()\
+            .order_by(Build.started)\
+            .limit(limit)\
             .all()
+        candidates = sorted(
+            {row.id: row.priority for row in by_precomputed + by_time}.items(),
+            key=lambda candidate: candidate[1],
+            reverse=True,
+        )
+        if len(by_precomputed) < limit or len(by_time) < limit:
+            # all schedulable packages are among the candidates
+            yield from candidates
+            return
+        coefficients = self.db.query(Collection.priority_coefficient)\
+            .filter(Collection.latest_repo_resolved == True)\
+            .all_flat()
+        bound = by_precomputed[-1].precomputed_priority + max(
+            coefficient * by_time[-1].time_priority for coefficient in coefficients
+        )
+        seen = set()
+        for package_id, priority in candidates:
+            if priority < bound:
+                break
+            seen.add(package_id)
+            yield package_id, priority
+        if bound < get_config('priorities.build_threshold'):
+            # packages that are not among the candidates are below the threshold
+            yield from (
+                candidate for candidate in candidates if candidate[0] not in seen
+            )
+            return
+        self.log.debug("Candidates exhausted, computing priorities of all packages")
+        all_candidates = self.query_candidates()\
+            .order_by(literal_column('priority').desc())\
+            .all()
+        for row in all_candidates:
+            if row.id not in seen:
+                yield row.id, row.priority
+
+    def prefetch_srpms(self, packages):
+        """
+        Queries latest SRPMs and arch headers of given packages from Koji in bulk,
+        using one multicall per collection.
+
+        :return: dict mapping package ids to (srpm_res, headers) pairs, where srpm_res
+                 is the result of `koji_util.get_last_srpm(..., relative=True)`
+        """
+        by_collection = defaultdict(list)
+        for package in packages:
+            by_collection[package.collection].append(package)
+        prefetched = {}
+        for collection, collection_packages in by_collection.items():
+            koji_session = self.session.secondary_koji_for(collection)
+            srpms = koji_util.get_last_srpms(
+                koji_session,
+                collection.dest_tag,
+                [package.name for package in collection_packages],
+                relative=True,
+            )
+            headers_list = koji_util.get_srpm_arch_headers_cached(
+                self.session,
+                koji_session,
+                [package.srpm_nvra for package in collection_packages],
+            )
+            for package, srpm_res, headers in zip(collection_packages, srpms,
+                                                  headers_list):
+                prefetched[package.id] = srpm_res, headers
+        return prefetched
+
+    def get_prefetched_candidates(self, window_size):
+        """
+        Generates (package, priority, srpm_res, headers) tuples in the order given by
+        `get_priorities`. SRPMs of candidates are prefetched (see `prefetch_srpms`) in
+        windows of given size. Candidates below the build threshold are not
+        prefetched and are yielded with None srpm_res and headers.
+        """
+        threshold = get_config('priorities.build_threshold')
+        candidates = self.get_priorities()
+        while True:
+            window = list(islice(candidates, window_size))
+            if not window:
+                return
+            packages = self.db.query(Package)\
+                .filter(Package.id.in_([package_id for package_id, _ in window]))\
+                .options(joinedload(Package.collection))\
+                .all()
+            package_map = {package.id: package for package in packages}
+            prefetched = self.prefetch_srpms([
+                package_map[package_id]
+                for package_id, priority in window
+                if priority >= threshold
+            ])
+            for package_id, priority in window:
+                srpm_res, headers = prefetched.get(package_id, (None, None))
+                yield package_map[package_id], priority, srpm_res, headers
 
     def skip_no_srpm(self, package):
         self.log.info("No SRPM found for {} in {}"
@@ -56,16 +188,23 @@ class Scheduler(Service):
         incomplete_builds_count = self.db.query(Build)\
             .filter(Build.state == Build.RUNNING)\
             .count()
-        if incomplete_builds_count >= get_config('koji_config.max_builds'):
+        free_slots = get_config('koji_config.max_builds') - incomplete_builds_count
+        if free_slots <= 0:
             self.log.debug("Not scheduling: {} incomplete builds"
                            .format(incomplete_builds_count))
             return
+        if not self.service_config.get('batch'):
+            free_slots = 1
+
+        # per-arch Koji load, updated with builds submitted in this cycle
+        arch_loads = {}
+        window_size = min(free_slots, self.service_config.get('prefetch') or 1)
 
-        for package_id, priority in self.get_priorities():
+        for package, priority, srpm_res, headers in \
+                self.get_prefetched_candidates(window_size):
             if priority < get_config('priorities.build_threshold'):
                 self.log.info("Not scheduling: no package above threshold")
                 return
-            package = self.db.query(Package).get(package_id)
 
             koji_session = self.session.koji('primary')
             all_arches = koji_util.get_koji_arches_cached(
@@ -78,6 +217,7 @@ class Scheduler(Service):
                 all_arches=all_arches,
                 nvra=package.srpm_nvra,
                 arch_override=package.arch_override,
+                headers=headers,
             )
             if arches is None:
                 self.skip_no_srpm(package)
@@ -91,10 +231,18 @@ class Scheduler(Service):
                 continue
             koji_load_threshold = get_config('koji_config.load_threshold')
             if koji_load_threshold < 1:
+                snapshot = koji_util.get_koji_load_snapshot_cached(
+                    self.session,
+                    koji_session,
+                    all_arches,
+                )
+                for arch, arch_load in snapshot['arches'].items():
+                    arch_loads.setdefault(arch, dict(arch_load))
                 koji_load = koji_util.get_koji_load(
                     koji_session=koji_session,
                     all_arches=all_arches,
                     arches=arches,
+                    snapshot=dict(snapshot, arches=arch_loads),
                 )
                 if koji_load > koji_load_threshold:
                     self.log.debug("Not scheduling {}: {} koji load"
@@ -103,11 +251,14 @@ class Scheduler(Service):
 
             self.log.info('Scheduling build for {} in {}, priority {}'
                           .format(package.name, package.collection.name, priority))
-            build = backend.submit_build(
-                self.session,
-                package,
-                arch_override=None if 'noarch' in arches else arches,
-            )
+            build = None
+            if srpm_res:
+                build = backend.submit_build(
+                    self.session,
+                    package,
+                    arch_override=None if 'noarch' in arches else arches,
+                    srpm_res=srpm_res,
+                )
             package.current_priority = None
             package.scheduler_skip_reason = None
             package.manual_priority = 0
@@ -117,4 +268,12 @@ class Scheduler(Service):
                 continue
 
             self.db.commit()
-            break
+            free_slots -= 1
+            koji_util.add_koji_load(
+                {'arches': arch_loads},
+                all_arches,
+                arches,
+                get_config('koji_config.submitted_build_load'),
+            )
+            if not free_slots:
+                break
@@ -0,0 +1,421 @@
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Offline simulator of the scheduler, used for evaluating priority configuration
+(priorities.*) and koji_config.max_builds without touching production.
+
+The simulation runs in the database given by configuration, which is supposed to be
+a local copy of production data (collection, package, build, koji_task,
+unapplied_change, applied_change and resolution_change tables). The current state of
+the database is the initial state of the simulation and history from a window of given
+length preceding it is replayed as the future - real builds, resolution changes and
+dependency changes (taken from applied changes of historical scratch-builds) recur
+after the length of the window. Builds are submitted in order given by
+Package.current_priority_expression and finish after a duration sampled from
+historical Koji tasks. All changes done by a simulation are rolled back.
+
+Not simulated: Koji load, SRPM availability and arch restrictions (the scheduler
+skips), and resolution of the simulated builds (dependency priority accumulates only
+from replayed dependency changes).
+"""
+
+import logging
+import random
+
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+
+from sqlalchemy import func, literal
+from sqlalchemy.types import DateTime
+
+from koschei.config import get_config
+from koschei.backend import clear_priority_data
+from koschei.models import (
+    AppliedChange, Build, Collection, KojiTask, Package, ResolutionChange,
+    UnappliedChange, TIME_PRIORITY,
+)
+
+# used when there are no finished Koji tasks to sample from
+DEFAULT_BUILD_DURATION = timedelta(hours=1)
+
+# An event replayed from history
+# kind is one of 'real_build', 'resolution', 'dependency'
+Event = namedtuple('Event', ['time', 'kind', 'package_id', 'data'])
+
+NOT_SET = object()
+
+
+@contextmanager
+def config_overrides(overrides):
+    """
+    Temporarily overrides configuration values.
+
+    :param overrides: dict of dot separated configuration keys (as in get_config) to
+                      values
+    """
+    originals = []
+    for key, value in overrides.items():
+        *parts, last = key.split('.')
+        config_dict = get_config('.'.join(parts) if parts else None)
+        originals.append((config_dict, last, config_dict.get(last, NOT_SET)))
+        config_dict[last] = value
+    # time priority inputs are computed from configuration only once
+    vars(TIME_PRIORITY).pop('inputs', None)
+    try:
+        yield
+    finally:
+        for config_dict, last, value in reversed(originals):
+            if value is NOT_SET:
+                del config_dict[last]
+            else:
+                config_dict[last] = value
+        vars(TIME_PRIORITY).pop('inputs', None)
+
+
+class BuildDurationModel(object):
+    """
+    Model of Koji build durations. Durations are sampled from historical builds of the
+    same package, or of all packages if the package has no finished Koji tasks.
+    Duration of a historical build is the time from the start of its first Koji task to
+    the end of its last Koji task.
+    """
+    def __init__(self, db):
+        self.durations = defaultdict(list)
+        self.all_durations = []
+        rows = db.query(
+            Build.package_id,
+            func.min(KojiTask.started),
+            func.max(KojiTask.finished),
+        )\
+            .join(KojiTask, KojiTask.build_id == Build.id)\
+            .filter(KojiTask.finished != None)\
+            .group_by(Build.id, Build.package_id)\
+            .all()
+        for package_id, started, finished in rows:
+            self.durations[package_id].append(finished - started)
+            self.all_durations.append(finished - started)
+
+    def sample(self, package_id, rng):
+        """
+        Returns a random build duration of given package.
+
+        :param rng: random.Random instance
+        """
+        durations = self.durations.get(package_id) or self.all_durations
+        if not durations:
+            return DEFAULT_BUILD_DURATION
+        return rng.choice(durations)
+
+
+class SimulationResult(object):
+    """
+    Metrics collected by a simulation run.
+
+    Queue latency is the time from the arrival of a dependency change of a package
+    (or the start of the simulation for packages that already have unapplied changes)
+    to the submission of its build. Builds submitted for packages with no such pending
+    changes are counted as wasted.
+    """
+    def __init__(self, name, duration):
+        self.name = name
+        self.duration = duration
+        self.submitted = 0
+        self.completed = 0
+        self.wasted = 0
+        self.latencies = []
+        # packages with changes that didn't get a build until the end
+        self.pending = 0
+
+    @property
+    def throughput(self):
+        """
+        Completed builds per day.
+        """
+        return self.completed * timedelta(days=1) / self.duration
+
+    def latency_percentile(self, percentile):
+        """
+        Returns given percentile of queue latencies or None if there were no builds of
+        packages with pending changes.
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+        return latencies[index]
+
+    def format(self):
+        """
+        Returns a human-readable report.
+        """
+        def hours(latency):
+            if latency is None:
+                return 'N/A'
+            return '{:.1f} h'.format(latency / timedelta(hours=1))
+
+        return '\n'.join([
+            '{}:'.format(self.name),
+            '  throughput: {:.1f} builds/day'.format(self.throughput),
+            '  submitted builds: {}'.format(self.submitted),
+            '  completed builds: {}'.format(self.completed),
+            '  wasted builds: {}'.format(self.wasted),
+            '  queue latency: median {}, p95 {}, max {}'.format(
+                hours(self.latency_percentile(50)),
+                hours(self.latency_percentile(95)),
+                hours(self.latency_percentile(100)),
+            ),
+            '  packages still waiting: {}'.format(self.pending),
+        ])
+
+
+class Simulator(object):
+    """
+    Scheduler simulator, see the module documentation.
+
+    :param session: KoscheiBackendSession. Its database transaction is rolled back
+                    after each run.
+    :param window: timedelta, length of the replayed history and of the simulation
+    :param tick: timedelta, interval between scheduling rounds
+    :param seed: seed of the random generator used to sample build durations, the same
+                 for each run
+    :param start: start of the simulation, the time of the last build by default
+    """
+    def __init__(self, session, window, tick=timedelta(minutes=5), seed=0, start=None):
+        self.log = logging.getLogger('koschei.simulator.Simulator')
+        self.session = session
+        self.db = session.db
+        self.window = window
+        self.tick = tick
+        self.seed = seed
+        self.start = start or self.db.query(func.max(Build.started)).scalar()
+        if not self.start:
+            raise RuntimeError("No builds to start the simulation from")
+        self.duration_model = BuildDurationModel(self.db)
+        self.events = self.load_events()
+        self.db.rollback()
+        self.log.info("Loaded {} events to be replayed".format(len(self.events)))
+
+    def load_events(self):
+        """
+        Returns events from the window preceding the start of the simulation, shifted by
+        the length of the window, sorted by time.
+        """
+        since = self.start - self.window
+        events = []
+        real_builds = self.db.query(
+            Build.package_id, Build.started, Build.state, Build.task_id,
+            Build.epoch, Build.version, Build.release, Build.repo_id,
+        )\
+            .filter(Build.real)\
+            .filter(Build.started > since)\
+            .filter(Build.started <= self.start)\
+            .all()
+        for row in real_builds:
+            data = row._asdict()
+            package_id = data.pop('package_id')
+            started = data.pop('started')
+            events.append(Event(started + self.window, 'real_build', package_id, data))
+        resolution_changes = self.db.query(
+            ResolutionChange.package_id,
+            ResolutionChange.timestamp,
+            ResolutionChange.resolved,
+        )\
+            .filter(ResolutionChange.timestamp > since)\
+            .filter(ResolutionChange.timestamp <= self.start)\
+            .all()
+        for package_id, timestamp, resolved in resolution_changes:
+            events.append(Event(timestamp + self.window, 'resolution', package_id,
+                                resolved))
+        dependency_changes = self.db.query(
+            Build.id, Build.package_id, Build.started, AppliedChange.distance,
+        )\
+            .join(AppliedChange, AppliedChange.build_id == Build.id)\
+            .filter(~Build.real)\
+            .filter(Build.started > since)\
+            .filter(Build.started <= self.start)\
+            .all()
+        # distances of changes, grouped by build
+        changes = defaultdict(list)
+        for build_id, package_id, started, distance in dependency_changes:
+            changes[build_id, package_id, started].append(distance)
+        for (_, package_id, started), distances in changes.items():
+            events.append(Event(started + self.window, 'dependency', package_id,
+                                distances))
+        events.sort(key=lambda event: event.time)
+        return events
+
+    def run(self, name='baseline', overrides=None):
+        """
+        Runs the simulation with given configuration overrides.
+
+        :param name: name of the configuration used in the report
+        :param overrides: dict of configuration overrides (see `config_overrides`)
+        :return: SimulationResult
+        """
+        with config_overrides(overrides or {}):
+            try:
+                return self.simulate(name)
+            finally:
+                self.db.rollback()
+
+    def simulate(self, name):
+        result = SimulationResult(name, self.window)
+        rng = random.Random(self.seed)
+        threshold = get_config('priorities.build_threshold')
+        max_builds = get_config('koji_config.max_builds')
+        batch = get_config('services.scheduler', {}).get('batch')
+        end = self.start + self.window
+        # build id -> (finish time, resulting state)
+        running = {}
+        builds = self.db.query(Build.id, Build.package_id, Build.started,
+                               Package.last_complete_build_state)\
+            .join(Build.package)\
+            .filter(Build.state == Build.RUNNING)\
+            .all()
+        for build_id, package_id, started, state in builds:
+            finished = started + self.duration_model.sample(package_id, rng)
+            running[build_id] = max(finished, self.start), state or Build.COMPLETE
+        # package id -> time since when it has changes waiting for a build
+        pending = {
+            package_id: self.start
+            for package_id in self.db.query(UnappliedChange.package_id)
+            .distinct()
+            .all_flat()
+        }
+        events = iter(self.events)
+        next_event = next(events, None)
+        now = self.start
+        while now < end:
+            now += self.tick
+            for build_id, (finished, state) in list(running.items()):
+                if finished <= now:
+                    del running[build_id]
+                    self.finish_build(build_id, finished, state)
+                    result.completed += 1
+            while next_event and next_event.time <= now:
+                self.apply_event(next_event, pending)
+                next_event = next(events, None)
+            free_slots = max_builds - len(running)
+            if free_slots <= 0:
+                continue
+            if not batch:
+                free_slots = 1
+            for package_id in self.get_candidates(now, threshold, free_slots):
+                build, state = self.submit_build(package_id, now)
+                duration = self.duration_model.sample(package_id, rng)
+                running[build.id] = now + duration, state
+                result.submitted += 1
+                if package_id in pending:
+                    result.latencies.append(now - pending.pop(package_id))
+                else:
+                    result.wasted += 1
+        result.pending = len(pending)
+        return result
+
+    def get_candidates(self, now, threshold, limit):
+        """
+        Returns ids of at most `limit` packages with the highest priority above the
+        threshold at given time, in descending order of priority.
+        """
+        priority_expr = Package.current_priority_expression(
+            collection=Collection,
+            last_build=Build,
+            now=literal(now, DateTime),
+        )
+        return self.db.query(Package.id)\
+            .join(Package.collection)\
+            .join(Package.last_build)\
+            .filter(priority_expr >= threshold)\
+            .order_by(priority_expr.desc())\
+            .limit(limit)\
+            .all_flat()
+
+    def submit_build(self, package_id, now):
+        """
+        Inserts a running build of given package, as the scheduler would.
+
+        :return: a tuple of (build, state the build will finish with). The state is the
+                 same as the state of the previous build.
+        """
+        package = self.db.query(Package).get(package_id)
+        last_build = package.last_build
+        build = Build(
+            package_id=package_id,
+            state=Build.RUNNING,
+            # distinguishes simulated builds from the real ones
+            task_id=-1,
+            started=now,
+            epoch=last_build.epoch,
+            version=last_build.version,
+            release=last_build.release,
+            repo_id=package.collection.latest_repo_id or last_build.repo_id,
+        )
+        self.db.add(build)
+        package.manual_priority = 0
+        package.scheduler_skip_reason = None
+        self.db.flush()
+        self.db.expire(package)
+        return build, last_build.state
+
+    def finish_build(self, build_id, finished, state):
+        """
+        Finishes a running build and resets priorities of its package, as polling
+        would.
+        """
+        build = self.db.query(Build).get(build_id)
+        package = build.package
+        clear_priority_data(self.session, [package])
+        build.state = state
+        build.finished = finished
+        if build.repo_id is None:
+            build.repo_id = (package.collection.latest_repo_id or
+                             package.last_complete_build.repo_id)
+        self.db.flush()
+        self.db.expire(package)
+
+    def apply_event(self, event, pending):
+        """
+        Applies an event replayed from history.
+
+        :param pending: dict of packages with changes waiting for a build, updated
+                        by the event
+        """
+        package = self.db.query(Package).get(event.package_id)
+        if event.kind == 'real_build':
+            # real builds reset priorities, same as in register_real_builds
+            self.db.add(Build(
+                package_id=event.package_id,
+                real=True,
+                started=event.time,
+                finished=event.time,
+                **event.data
+            ))
+            clear_priority_data(self.session, [package])
+            pending.pop(event.package_id, None)
+        elif event.kind == 'resolution':
+            if not package.skip_resolution:
+                package.resolved = event.data
+        elif event.kind == 'dependency':
+            # same as in repo_resolver
+            update_weight = get_config('priorities.package_update')
+            package.dependency_priority += int(sum(
+                update_weight / (distance or 8) for distance in event.data
+            ))
+            pending.setdefault(event.package_id, event.time)
+        self.db.flush()
+        self.db.expire(package)
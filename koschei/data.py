@@ -285,9 +285,16 @@ def copy_collection(session, source, copy, minimal=False):
         """.format(copy=copy, minimal=minimal),
     )
 
-    deepcopy_table(KojiTask)
+    # partitioning keys referencing the parents are copied as they are
+    deepcopy_table(
+        KojiTask,
+        foreign_keys=KojiTask.__table__.c.build_id.foreign_keys,
+    )
     deepcopy_table(ResolutionChange)
-    deepcopy_table(ResolutionProblem)
+    deepcopy_table(
+        ResolutionProblem,
+        foreign_keys=ResolutionProblem.__table__.c.resolution_id.foreign_keys,
+    )
     deepcopy_table(
         AppliedChange,
         foreign_keys=AppliedChange.__table__.c.build_id.foreign_keys,
@@ -18,19 +18,25 @@
 
 # pylint:disable=no-self-argument
 
+import io
 import re
 import os
 import struct
+import threading
+import time
 import zlib
 
+from contextlib import contextmanager
+
 import sqlalchemy
 
-from sqlalchemy import create_engine, Table, DDL
+from sqlalchemy import create_engine, Table, DDL, text
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import sessionmaker, evaluator, CompositeProperty
 from sqlalchemy.engine import Engine
 from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.event import listen
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql import func, column, operators, literal_column
@@ -72,6 +78,15 @@ class Query(sqlalchemy.orm.Query):
             .with_for_update()\
             .all()
 
+    def from_prepared(self, statement, **params):
+        """
+        Loads query entities from the result of a prepared statement (see
+        `PreparedStatement`). The statement has to return all columns of the
+        entity table.
+        """
+        self.session.prepare(statement)
+        return self.from_statement(statement.execute_clause).params(**params)
+
     def all_flat(self, ctor=list):
         return ctor(x for [x] in self)
 
@@ -93,6 +108,48 @@ class Query(sqlalchemy.orm.Query):
         )
 
 
+def _copy_escape(value):
+    if value is None:
+        return '\\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+class PreparedStatement(object):
+    """
+    Named server-side prepared statement for queries executed many times per
+    cycle, which would otherwise be planned anew on each execution.
+    Statements are prepared lazily, once per database connection, and executed
+    using `KoscheiDbSession.execute_prepared` or `Query.from_prepared`.
+
+    :param: name Statement name, unique in the whole application
+    :param: sql SQL of the statement with named parameters in the `:param` form
+    """
+    def __init__(self, name, sql):
+        self.name = name
+        self.params = []
+
+        def replace_param(match):
+            if match.group(1) not in self.params:
+                self.params.append(match.group(1))
+            return '${}'.format(self.params.index(match.group(1)) + 1)
+
+        self.sql = re.sub(r'(?<![:\w]):(\w+)', replace_param, sql)
+        self.execute_clause = text('EXECUTE {}{}'.format(
+            name,
+            '({})'.format(', '.join(':' + p for p in self.params))
+            if self.params else '',
+        ))
+
+    def __repr__(self):
+        return 'PreparedStatement({})'.format(self.name)
+
+
 class KoscheiDbSession(sqlalchemy.orm.session.Session):
     def __init__(self, bind, binds=None, **kwargs):
         assert binds is None, "binds argument not supported"
@@ -114,6 +171,68 @@ class KoscheiDbSession(sqlalchemy.orm.session.Session):
             self.__connection.close()
             self.__connection = None
 
+    def prepare(self, statement):
+        """
+        Prepares given statement on the current connection, unless it was already
+        prepared on it. Prepared statements persist across transactions, so the
+        names of prepared statements are remembered in connection's info
+        dictionary, together with their execution counts.
+
+        :param: statement PreparedStatement
+        """
+        prepared = self.connection().info.setdefault('prepared_statements', {})
+        if statement.name not in prepared:
+            exists = self.execute(
+                "SELECT 1 FROM pg_prepared_statements WHERE name = :name",
+                dict(name=statement.name),
+            ).scalar()
+            if not exists:
+                self.execute(text('PREPARE {} AS {}'.format(
+                    statement.name, statement.sql,
+                )))
+            prepared[statement.name] = 0
+        prepared[statement.name] += 1
+
+    def execute_prepared(self, statement, **params):
+        """
+        Executes given prepared statement, preparing it first if necessary.
+
+        :param: statement PreparedStatement
+        :param: params Values of statement parameters
+        :return: ResultProxy
+        """
+        self.prepare(statement)
+        try:
+            return self.execute(statement.execute_clause, params)
+        except DBAPIError as e:
+            # prepared statement was deallocated behind our back
+            if getattr(e.orig, 'pgcode', None) == '26000':
+                self.connection().info['prepared_statements'].pop(statement.name)
+            raise
+
+    def log_prepared_statements(self, log):
+        """
+        Logs execution counts and planning statistics of statements prepared on the
+        current connection. Generic and custom plan counts are only reported by
+        PostgreSQL 14 and newer.
+
+        :param: log Logger to log into
+        """
+        prepared = self.connection().info.get('prepared_statements')
+        if not prepared:
+            return
+        for row in self.execute(
+                "SELECT * FROM pg_prepared_statements WHERE name = ANY(:names)",
+                dict(names=list(prepared.keys())),
+        ):
+            row = dict(row)
+            log.info(
+                "Prepared statement %s: executions=%d, generic_plans=%s, "
+                "custom_plans=%s",
+                row['name'], prepared[row['name']],
+                row.get('generic_plans', 'n/a'), row.get('custom_plans', 'n/a'),
+            )
+
     def bulk_insert(self, objects):
         """
         Inserts ORM objects using sqla-core bulk insert. Only handles simple flat
@@ -140,6 +259,71 @@ class KoscheiDbSession(sqlalchemy.orm.session.Session):
                 obj.id = obj_id
             self.expire_all()
 
+    def bulk_copy(self, objects):
+        """
+        Inserts ORM objects using COPY. Faster and less memory demanding than
+        `bulk_insert` for large amounts of objects. Has the same restrictions as
+        `bulk_insert`. IDs are reserved from the primary key sequence beforehand and
+        set on the objects, other objects in the session are not expired.
+
+        :param: objects List of ORM objects to be persisted. All objects must be of
+                        the same type. Column list is determined from first object.
+        """
+        # pylint:disable=unidiomatic-typecheck
+        if objects:
+            cls = type(objects[0])
+            table = cls.__table__
+            cols = [col for col in objects[0].__dict__.keys() if not
+                    col.startswith('_') and col != 'id']
+            # COPY doesn't apply client side defaults
+            defaults = {
+                col.name: col.default.arg for col in table.columns
+                if col.default is not None and col.default.is_scalar and
+                col.name not in cols and col.name != 'id'
+            }
+            self.flush()
+            ids = self.execute(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                "FROM generate_series(1, :count)",
+                dict(table=table.name, count=len(objects)),
+            ).fetchall()
+            rows = []
+            for obj, (obj_id,) in zip(objects, ids):
+                assert type(obj) == cls
+                obj.id = obj_id
+                rows.append(
+                    [obj_id] +
+                    [getattr(obj, col) for col in cols] +
+                    list(defaults.values())
+                )
+            self.copy_rows(table.name, ['id'] + cols + list(defaults.keys()), rows)
+
+    def copy_rows(self, table, columns, rows):
+        """
+        Loads rows into a table using COPY, which is considerably faster than
+        INSERT for large amounts of rows. Intended mainly for filling temporary
+        tables.
+
+        :param: table Name of the table
+        :param: columns List of column names
+        :param: rows Iterable of tuples of values in the same order as columns.
+                     Values are converted to text by str, None is loaded as NULL.
+        """
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(_copy_escape(value) for value in row))
+            data.write('\n')
+        data.seek(0)
+        self.flush()
+        cursor = self.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)),
+                data,
+            )
+        finally:
+            cursor.close()
+
     def commit_no_expire(self):
         """
         The same as commit, but avoids marking ORM objects as expired.
@@ -161,6 +345,7 @@ class KoscheiDbSession(sqlalchemy.orm.session.Session):
 
 
 __engine = None
+__replica_engine = None
 __sessionmaker = None
 
 
@@ -173,6 +358,25 @@ def get_engine():
     return __engine
 
 
+def get_replica_engine():
+    """
+    Returns engine connected to the read-only replica of the database, or None if no
+    replica is configured. Connections are checked before they are taken from the
+    pool, so that a restarted replica doesn't cause errors.
+    """
+    global __replica_engine
+    if __replica_engine:
+        return __replica_engine
+    db_url = get_config('replica_db_url', None)
+    if not db_url and get_config('replica_database_config', None):
+        db_url = URL(**get_config('replica_database_config'))
+    if not db_url:
+        return None
+    __replica_engine = create_engine(db_url, echo=False, pool_size=10,
+                                     pool_pre_ping=True)
+    return __replica_engine
+
+
 def get_sessionmaker():
     global __sessionmaker
     if __sessionmaker:
@@ -238,7 +442,7 @@ class CompressedKeyArray(TypeDecorator):
 
 
 def load_ddl():
-    for script in ('triggers.sql', 'rpmvercmp.sql'):
+    for script in ('triggers.sql', 'rpmvercmp.sql', 'partitions.sql'):
         with open(os.path.join(get_config('directories.datadir'), script)) as ddl_script:
             ddl = DDL(ddl_script.read())
         listen(Base.metadata, 'after_create', ddl.execute_if(dialect='postgresql'))
@@ -258,6 +462,125 @@ def grant_db_access(_, conn, *args, **kwargs):
 listen(Table, 'after_create', grant_db_access)
 
 
+# literals and bind parameter placeholders, in this order
+SQL_PARAMETER_RE = re.compile(
+    r"'(?:[^']|'')*'|%\(\w+\)s|%s|\$\d+|(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])"
+)
+SQL_PARAMETER_LIST_RE = re.compile(r'\(\?(?:, \?)+\)')
+
+
+def normalize_sql(statement):
+    """
+    Normalizes SQL statement for grouping in statistics. Literals and parameters are
+    replaced by "?", lists of them by "(?, ...)" and whitespace is collapsed.
+    """
+    statement = ' '.join(SQL_PARAMETER_RE.sub('?', statement).split())
+    return SQL_PARAMETER_LIST_RE.sub('(?, ...)', statement)
+
+
+class SqlStats(object):
+    """
+    Statistics of SQL statements executed during a unit of work, such as a frontend
+    request or an iteration of a service. Statements are grouped by normalized text.
+
+    Statements are recorded by engine event listeners, for the thread in which the
+    stats are being collected (see `collect`). COPY is not recorded.
+    """
+    current = threading.local()
+
+    def __init__(self):
+        self.statements = 0
+        self.time = 0.0
+        self.rows = 0
+        # normalized statement -> [count, time, rows]
+        self.by_statement = {}
+
+    def record(self, statement, duration, rows):
+        self.statements += 1
+        self.time += duration
+        self.rows += rows
+        stats = self.by_statement.setdefault(normalize_sql(statement), [0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] += rows
+
+    def merge(self, other):
+        """
+        Adds statistics from other SqlStats object.
+        """
+        self.statements += other.statements
+        self.time += other.time
+        self.rows += other.rows
+        for statement, (count, duration, rows) in other.by_statement.items():
+            stats = self.by_statement.setdefault(statement, [0, 0.0, 0])
+            stats[0] += count
+            stats[1] += duration
+            stats[2] += rows
+
+    def start(self):
+        """
+        Starts collecting statements executed by the current thread. Collection by
+        other SqlStats in the thread is stopped.
+        """
+        SqlStats.current.stats = self
+
+    def stop(self):
+        if getattr(SqlStats.current, 'stats', None) is self:
+            SqlStats.current.stats = None
+
+    @contextmanager
+    def collect(self):
+        """
+        Context manager collecting statements executed by the current thread within
+        the context.
+        """
+        previous = getattr(SqlStats.current, 'stats', None)
+        self.start()
+        try:
+            yield self
+        finally:
+            SqlStats.current.stats = previous
+
+    def top_statements(self, count):
+        """
+        :return: list of (statement, count, time, rows) tuples of given number of
+                 statements with the highest total time
+        """
+        items = sorted(self.by_statement.items(), key=lambda item: item[1][1],
+                       reverse=True)
+        return [(statement,) + tuple(stats) for statement, stats in items[:count]]
+
+    def summary(self):
+        return "statements={}, time={:.3f}s, rows={}"\
+            .format(self.statements, self.time, self.rows)
+
+    def log_summary(self, log, description, top=10):
+        """
+        Logs the summary and statements with the highest total time.
+        """
+        log.info("SQL statements of {}: {}".format(description, self.summary()))
+        for statement, count, duration, rows in self.top_statements(top):
+            log.info("SQL statement executed {}x, time={:.3f}s, rows={}: {}"
+                     .format(count, duration, rows, statement))
+
+
+def _sql_stats_before_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+    SqlStats.current.started = time.time()
+
+
+def _sql_stats_after_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+    stats = getattr(SqlStats.current, 'stats', None)
+    if stats is not None:
+        stats.record(statement, time.time() - SqlStats.current.started,
+                     max(cursor.rowcount, 0))
+
+
+listen(Engine, 'before_cursor_execute', _sql_stats_before_execute)
+listen(Engine, 'after_cursor_execute', _sql_stats_after_execute)
+
+
 def create_all():
     conn = get_engine().connect()
     try:
@@ -385,23 +708,29 @@ class Evaluator(evaluator.EvaluatorCompiler):
     """
 
     def visit_unary(self, clause):
-
-        def evaluate(obj):
-            if clause.operator is operators.isfalse:
-                return self.process(clause.element)(obj) is False
-            if clause.operator is operators.istrue:
-                return self.process(clause.element)(obj) is True
-            return super(Evaluator, self).visit_unary(clause)(obj)
-
-        return evaluate
+        if clause.operator is operators.isfalse:
+            eval_element = self.process(clause.element)
+            return lambda obj: eval_element(obj) is False
+        if clause.operator is operators.istrue:
+            eval_element = self.process(clause.element)
+            return lambda obj: eval_element(obj) is True
+        return super(Evaluator, self).visit_unary(clause)
 
     def visit_case(self, clause):
+        eval_whens = [
+            (self.process(condition), self.process(result))
+            for condition, result in clause.whens
+        ]
+        eval_else = (
+            self.process(clause.else_) if clause.else_ is not None
+            else lambda obj: None
+        )
 
         def evaluate(obj):
-            for when in clause.whens:
-                if self.process(when[0])(obj):
-                    return self.process(when[1])(obj)
-            return self.process(clause.else_)(obj)
+            for eval_condition, eval_result in eval_whens:
+                if eval_condition(obj):
+                    return eval_result(obj)
+            return eval_else(obj)
 
         return evaluate
 
@@ -416,9 +745,15 @@ class sql_property(hybrid_property):
     expression. When the property is accessed on an instance, it evaluates the
     expression in python without making a database query, using the instance as
     the bind parameter.
+    The expression is compiled into a Python function only once per class.
     """
 
     def __get__(self, instance, owner):
         if instance is None:
             return self.fget(owner)
-        return Evaluator(owner).process(self.fget(owner))(instance)
+        evaluators = self.__dict__.setdefault('_evaluators', {})
+        evaluate = evaluators.get(owner)
+        if evaluate is None:
+            evaluate = Evaluator(owner).process(self.fget(owner))
+            evaluators[owner] = evaluate
+        return evaluate(instance)
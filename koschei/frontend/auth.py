@@ -31,7 +31,7 @@ from flask import abort, request, session, redirect, url_for, g
 
 import koschei.models as m
 from koschei.config import get_config
-from koschei.frontend.base import app, db
+from koschei.frontend.base import app, db, primary_db
 from koschei.frontend.util import flash_info, flash_ack
 
 bypass_login = get_config('bypass_login', None)
@@ -41,6 +41,7 @@ user_re = re.compile('^{}$'.format(user_re))
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@primary_db
 def login():
     """
     Acknowledge the logged in user by adding it's name to session.
@@ -22,13 +22,17 @@ global resources, such as the Flask app or the database.
 """
 
 import logging
+import time
 
-from flask import Flask, abort, request, g
+from flask import Flask, abort, request, g, has_request_context
+from flask import session as http_session
 from flask_sqlalchemy import BaseQuery, Pagination
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
+from sqlalchemy.sql import text
 
 from koschei.config import get_config
-from koschei.db import Query, get_engine
+from koschei.db import Query, SqlStats, get_engine, get_replica_engine
 from koschei.models import LogEntry, Collection, Package, Build, ResolutionChange
 from koschei.session import KoscheiSession
 
@@ -71,9 +75,21 @@ class FrontendQuery(Query, BaseQuery):
         return Pagination(self, page, items_per_page, total, items)
 
 
+class FrontendDbSession(Session):
+    """
+    Database session that reads from the read-only replica, if the current request
+    was chosen to be served from it (see `choose_database`). Flushes always go to the
+    primary database.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and g.get('db_replica') and not self._flushing:
+            return get_replica_engine()
+        return super().get_bind(mapper, clause)
+
+
 # Thread-local database session
 db = scoped_session(sessionmaker(autocommit=False, bind=get_engine(),
-                                 query_cls=FrontendQuery))
+                                 query_cls=FrontendQuery, class_=FrontendDbSession))
 
 
 class KoscheiFrontendSession(KoscheiSession):
@@ -98,6 +114,115 @@ def shutdown_session(exception=None):
     db.remove()
 
 
+@app.before_request
+def start_sql_stats():
+    """
+    Starts collecting statistics of SQL statements executed during the request into
+    g.sql_stats. Registered before other before_request functions, so that their
+    statements are included.
+    """
+    g.sql_stats = SqlStats()
+    g.sql_stats.start()
+
+
+@app.after_request
+def report_sql_stats(response):
+    """
+    Reports statistics of SQL statements executed during the request, as specified by
+    `frontend.sql_stats` configuration.
+    """
+    sql_stats = g.get('sql_stats')
+    if sql_stats is None or request.endpoint == 'static':
+        return response
+    stats_config = frontend_config['sql_stats']
+    if stats_config['header']:
+        response.headers['X-Koschei-SQL-Stats'] = sql_stats.summary()
+    threshold = stats_config['log_threshold']
+    if threshold is not None and sql_stats.time > threshold:
+        sql_stats.log_summary(session.log, "request {} {}"
+                              .format(request.method, request.full_path))
+    return response
+
+
+@app.teardown_request
+def stop_sql_stats(exception=None):
+    sql_stats = g.get('sql_stats')
+    if sql_stats is not None:
+        sql_stats.stop()
+
+
+# Replication lag in seconds, zero when the replica replayed everything it received.
+# NULL when the database is not a replica
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE extract(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+           END
+""")
+
+# Time until which the replica is not used, because the connection to it failed
+replica_failed_until = 0
+
+
+def primary_db(view):
+    """
+    Decorates endpoint function that writes to the database even on GET requests, so
+    that it's always served from the primary database.
+    """
+    view.primary_db = True
+    return view
+
+
+def replica_usable():
+    """
+    Checks whether the replica can be used for the current request. It can't be used
+    when the connection to it fails or when it lags behind the primary too much.
+    Connection failures are remembered for a while, so that requests don't wait for
+    connection timeouts.
+    """
+    global replica_failed_until
+    replica_config = frontend_config['replica']
+    if time.time() < replica_failed_until:
+        return False
+    try:
+        lag = db.connection(bind=get_replica_engine())\
+            .execute(REPLICA_LAG_QUERY)\
+            .scalar()
+    except DBAPIError:
+        session.log.warning("Replica database is not available, using primary",
+                            exc_info=True)
+        replica_failed_until = time.time() + replica_config['retry_interval']
+        db.rollback()
+        return False
+    max_lag = replica_config['max_lag']
+    if lag is not None and max_lag is not None and lag > max_lag:
+        session.log.warning("Replica database lags behind by {:.0f}s, using primary"
+                            .format(lag))
+        return False
+    return True
+
+
+@app.before_request
+def choose_database():
+    """
+    Decides whether the request is served from the read-only replica, setting
+    g.db_replica. Only GET and HEAD requests can be served from it. Requests of users
+    who submitted a change recently (including GET requests of `primary_db` views)
+    are served from the primary, so that they see their change even if the replica
+    lags behind.
+    """
+    g.db_replica = False
+    if request.endpoint == 'static' or not get_replica_engine():
+        return
+    view = app.view_functions.get(request.endpoint)
+    if request.method not in ('GET', 'HEAD') or getattr(view, 'primary_db', False):
+        http_session['db_primary_until'] = \
+            time.time() + frontend_config['replica']['primary_after_write']
+        return
+    if http_session.get('db_primary_until', 0) > time.time():
+        return
+    g.db_replica = replica_usable()
+
+
 @app.context_processor
 def inject_fedmenu():
     # TODO move to global vars
@@ -157,6 +282,7 @@ app.jinja_env.globals.update(
     primary_koji_url=get_config('koji_config.weburl'),
     secondary_koji_url=secondary_koji_url,
     fedora_assets_url=frontend_config['fedora_assets_url'],
+    sql_stats_footer=frontend_config['sql_stats']['footer'],
     # builtin python functions
     inext=next, iter=iter, min=min, max=max,
     # model classes
@@ -912,10 +912,10 @@ def affected_by(dep_name):
 def statistics():
     """
     Show global and per-package statistics about build times etc.
-    Uses materialized views that are refreshed by backend's polling.
+    Uses statistics tables that are maintained by database triggers.
     """
     now = db.query(func.now()).scalar()
-    scalar_stats = db.query(ScalarStats).one()
+    scalar_stats = ScalarStats.current(db)
     resource_query = db.query(ResourceConsumptionStats)\
         .order_by(ResourceConsumptionStats.time.desc().nullslast())\
         .paginate(20)
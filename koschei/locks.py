@@ -23,6 +23,7 @@ from sqlalchemy.sql import func
 
 LOCK_REPO_RESOLVER = 1
 LOCK_BUILD_RESOLVER = 2
+LOCK_STATS = 3
 
 
 class Locked(Exception):
@@ -30,13 +30,14 @@ import math
 
 from sqlalchemy import (
     Column, Integer, String, Boolean, ForeignKey, DateTime, Index, Float,
-    CheckConstraint, UniqueConstraint, Enum, Interval,
+    CheckConstraint, UniqueConstraint, Enum, Interval, FetchedValue,
+    PrimaryKeyConstraint, ForeignKeyConstraint,
 )
 from sqlalchemy.sql.expression import (
     func, select, join, false, true, extract, case, null, cast,
 )
 from sqlalchemy.orm import (
-    relationship, column_property, configure_mappers, deferred, composite,
+    relationship, column_property, configure_mappers, deferred, composite, foreign,
 )
 from sqlalchemy.dialects.postgresql import ARRAY
 
@@ -45,6 +46,7 @@ from koschei.db import (
     Base, MaterializedView, CompressedKeyArray, RpmEVR, RpmEVRComparator,
     sql_property,
 )
+from koschei.locks import pg_lock, LOCK_STATS
 
 
 class User(Base):
@@ -143,6 +145,15 @@ class Collection(Base):
     # whether to poll builds also for untracked packages
     poll_untracked = Column(Boolean, nullable=False, server_default=true())
 
+    # Koji event ID at which the package list was last refreshed from Koji and the
+    # time of the last full refresh. Used by polling to refresh the package list
+    # incrementally, using Koji history since the event.
+    packages_event_id = Column(Integer)
+    packages_full_refresh = Column(DateTime)
+    # The same for latest builds tagged in dest_tag
+    latest_builds_event_id = Column(Integer)
+    latest_builds_full_refresh = Column(DateTime)
+
     # all package in the collection
     packages = relationship('Package', backref='collection', passive_deletes=True)
 
@@ -253,27 +264,12 @@ class Package(Base):
     # still considered resolved by scheduler or frontend.
     skip_resolution = Column(Boolean, nullable=False, server_default=false())
 
-    # denormalized fields, updated by trigger on insert/update (no delete)
-    last_complete_build_id = Column(
-        ForeignKey(
-            'build.id',
-            use_alter=True,
-            name='fkey_package_last_complete_build_id',
-        ),
-        nullable=True,
-    )
+    # denormalized fields, updated by trigger on insert/update/delete of builds
+    # There are no foreign keys, because the primary key of partitioned build table
+    # includes started. The builds are kept by partition retention.
+    last_complete_build_id = Column(Integer, nullable=True)
     last_complete_build_state = Column(Integer)
-    last_build_id = Column(
-        ForeignKey(
-            'build.id',
-            use_alter=True,
-            name='fkey_package_last_build_id',
-            # it's first updated by trigger, this is fallback, when there's
-            # nothing to update it to
-            ondelete='SET NULL',
-        ),
-        nullable=True,
-    )
+    last_build_id = Column(Integer, nullable=True)
     # Whether all package dependencies were installable suring latest repo_resolver run.
     # May be None if resolution was not attempted yet.
     # When False, installation problems are stored in ResolutionProblem table.
@@ -289,6 +285,14 @@ class Package(Base):
     build_priority = Column(Integer, nullable=False, server_default='0')
     # priority based on dependency changes since last build
     dependency_priority = Column(Integer, nullable=False, server_default='0')
+    # Time-independent part of current priority (see current_priority_expression), or
+    # NULL if the package is not schedulable (not considering collection state).
+    # Updated by trigger, used by scheduler to select candidates using an index
+    precomputed_priority = Column(
+        Float,
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+    )
 
     # Whether Koschei "tracks" a package. It means that builds are scheduled for the
     # package and it is shown in the frontend and its dependencies are periodically tested
@@ -308,7 +312,27 @@ class Package(Base):
     scheduler_skip_reason = Column(Integer)
 
     @classmethod
-    def current_priority_expression(cls, collection, last_build):
+    def time_priority_expression(cls, last_build, now=None):
+        """
+        Return priority based on the time elapsed since package's last build was
+        started, before application of collection's priority coefficient.
+
+        :param: last_build package's last complete build. Either Build class object or
+                           particular build object.
+        :param: now time at which the priority is evaluated. Current time by default.
+
+        :returns: SQLA expression that, when evaluated in the DB, returns the priority
+        """
+        if now is None:
+            now = func.clock_timestamp()
+        seconds = extract('EPOCH', now - last_build.started)
+        a, b = TIME_PRIORITY.inputs
+        # avoid zero/negative values, when time difference too small
+        log_arg = func.greatest(0.000001, seconds / 3600)
+        return func.greatest(a * func.log(log_arg) + b, -30)
+
+    @classmethod
+    def current_priority_expression(cls, collection, last_build, now=None):
         """
         Return computed value for packages priority or None if package is not
         schedulable.
@@ -322,6 +346,7 @@ class Package(Base):
         :param: last_build package's last complete build.
                            As with the previous argument, should be either Build class
                            object or particular last complete build object.
+        :param: now time at which the priority is evaluated. Current time by default.
 
         :returns: SQLA expression that, when evaluated in the DB, returns the priority
         """
@@ -333,12 +358,7 @@ class Package(Base):
 
         dynamic_priority = cls.dependency_priority + cls.build_priority
 
-        # compute time priority
-        seconds = extract('EPOCH', func.clock_timestamp() - last_build.started)
-        a, b = TIME_PRIORITY.inputs
-        # avoid zero/negative values, when time difference too small
-        log_arg = func.greatest(0.000001, seconds / 3600)
-        dynamic_priority += func.greatest(a * func.log(log_arg) + b, -30)
+        dynamic_priority += cls.time_priority_expression(last_build, now=now)
 
         # dynamic priority is affected by coefficient
         dynamic_priority *= collection.priority_coefficient
@@ -353,7 +373,7 @@ class Package(Base):
                     # WHEN blocked OR untracked
                     cls.blocked | ~cls.tracked |
                     # OR has running build
-                    (cls.last_complete_build_id != cls.last_build_id) |
+                    cls.last_complete_build_id.is_distinct_from(cls.last_build_id) |
                     # OR is unresolved
                     (cls.resolved == False) |
                     # OR resolution is not yet done
@@ -449,22 +469,52 @@ class Package(Base):
         return '{0.id} (name={0.name})'.format(self)
 
 
+def _build_started_default(context):
+    """
+    Default for partitioning keys of tables referencing builds. Looks up start time of
+    the build. Bulk insertions should rather set the key explicitly.
+    """
+    build_id = context.get_current_parameters()['build_id']
+    return context.connection.scalar(
+        select([Build.started]).where(Build.id == build_id)
+    )
+
+
+def _resolution_timestamp_default(context):
+    """
+    Default for partitioning key of ResolutionProblem. Looks up timestamp of the
+    resolution change.
+    """
+    resolution_id = context.get_current_parameters()['resolution_id']
+    return context.connection.scalar(
+        select([ResolutionChange.timestamp])
+        .where(ResolutionChange.id == resolution_id)
+    )
+
+
 class KojiTask(Base):
     """
     A Koji `buildArch` subtask of the `build` task. A Build has many KojiTasks.
     Usually there's a single task for `noarch` builds and tasks for each arch for archful
     builds.
+
+    Partitioned by month together with builds (see `koschei.partitions`).
     """
     __table_args__ = (
+        PrimaryKeyConstraint('id', 'build_started'),
+        ForeignKeyConstraint(
+            ['build_id', 'build_started'],
+            ['build.id', 'build.started'],
+            ondelete='CASCADE',
+        ),
         CheckConstraint('state BETWEEN 0 AND 5', name='koji_task_state_check'),
+        {'postgresql_partition_by': 'RANGE (build_started)'},
     )
 
-    id = Column(Integer, primary_key=True)
-    build_id = Column(
-        ForeignKey('build.id', ondelete='CASCADE'),
-        nullable=False,
-        index=True,
-    )
+    id = Column(Integer, autoincrement=True)
+    build_id = Column(Integer, nullable=False, index=True)
+    # Denormalized start time of the build, used as partitioning key
+    build_started = Column(DateTime, nullable=False, default=_build_started_default)
     # Koji task ID
     task_id = Column(Integer, nullable=False)
     # Architecture in Koji's format
@@ -476,6 +526,9 @@ class KojiTask(Base):
     # Time of task finish. May be None. Unused.
     finished = Column(DateTime)
 
+    # build_started is part of the primary key only because of partitioning
+    __mapper_args__ = {'primary_key': [id]}
+
     @property
     def state_string(self):
         """
@@ -597,14 +650,17 @@ class Build(Base):
     "real" builds.
 
     Canceled builds are deleted.
-    Old builds can be deleted by `koschei-admin cleanup` (run from cron).
+    The table is partitioned by month of `started`, old partitions are dropped by
+    `koschei-admin cleanup` (run from cron), see `koschei.partitions`.
     """
     __table_args__ = (
+        PrimaryKeyConstraint('id', 'started'),
         CheckConstraint('state IN (2, 3, 5)', name='build_state_check'),
         CheckConstraint('state = 2 OR repo_id IS NOT NULL', name='build_repo_id_check'),
         CheckConstraint('state = 2 OR version IS NOT NULL', name='build_version_check'),
         CheckConstraint('state = 2 OR release IS NOT NULL', name='build_release_check'),
         CheckConstraint('NOT real OR state <> 2', name='build_real_complete_check'),
+        {'postgresql_partition_by': 'RANGE (started)'},
     )
 
     STATE_MAP = {
@@ -625,7 +681,7 @@ class Build(Base):
         'FAILED': FAILED,
     }
 
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, autoincrement=True)
     package_id = Column(ForeignKey('package.id', ondelete='CASCADE'))
     package = None  # backref
     # Build state as an integer. Can be either 2 (running), 3 (complete) or 5 (failed).
@@ -633,6 +689,7 @@ class Build(Base):
     # Koji task ID
     task_id = Column(Integer, nullable=False)
     # Task creation time. Used for ordering builds and relating them to ResolutionChanges
+    # Partitioning key
     started = Column(DateTime, nullable=False)
     # Task finish time. May be null
     finished = Column(DateTime)
@@ -683,6 +740,9 @@ class Build(Base):
     # Used only by resolver. Deferred = not fetched from DB by default.
     dependency_keys = deferred(Column(CompressedKeyArray))
 
+    # started is part of the primary key only because of partitioning
+    __mapper_args__ = {'primary_key': [id]}
+
     @property
     def state_string(self):
         """
@@ -741,11 +801,19 @@ class ResolutionChange(Base):
     frontend to show past changes. The use-case is that without this feature, people
     often saw a fedmsg that a package failed to resolve, but by the time they opened
     Koschei, it had already been resolved again and they had no idea what had been wrong.
+
+    Partitioned by month of `timestamp`, see `koschei.partitions`.
     """
-    id = Column(Integer, primary_key=True)
+    __table_args__ = (
+        PrimaryKeyConstraint('id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE ("timestamp")'},
+    )
+
+    id = Column(Integer, autoincrement=True)
     # Whether package's dependencies were installable or not
     resolved = Column(Boolean, nullable=False)
     # Timestamp of the resolution, used to order them and relate them to builds
+    # Partitioning key
     timestamp = Column(DateTime, nullable=False, server_default=func.clock_timestamp())
     package_id = Column(
         ForeignKey(Package.id, ondelete='CASCADE'),
@@ -753,21 +821,42 @@ class ResolutionChange(Base):
         index=True,
     )
 
+    # timestamp is part of the primary key only because of partitioning, it's
+    # fetched after insert, because ResolutionProblems need it
+    __mapper_args__ = {'primary_key': [id], 'eager_defaults': True}
+
 
 class ResolutionProblem(Base):
     """
     A string representation of a problem in dependency installation. Produced by resolver
     straight from hawkey/libdnf output.
+
+    Partitioned by month together with resolution changes.
     """
-    id = Column(Integer, primary_key=True)
-    resolution_id = Column(
-        ForeignKey(ResolutionChange.id, ondelete='CASCADE'),
+    __table_args__ = (
+        PrimaryKeyConstraint('id', 'resolution_timestamp'),
+        ForeignKeyConstraint(
+            ['resolution_id', 'resolution_timestamp'],
+            ['resolution_change.id', 'resolution_change.timestamp'],
+            ondelete='CASCADE',
+        ),
+        {'postgresql_partition_by': 'RANGE (resolution_timestamp)'},
+    )
+
+    id = Column(Integer, autoincrement=True)
+    resolution_id = Column(Integer, nullable=False, index=True)
+    # Denormalized timestamp of the resolution change, used as partitioning key
+    resolution_timestamp = Column(
+        DateTime,
         nullable=False,
-        index=True,
+        default=_resolution_timestamp_default,
     )
 
     problem = Column(String, nullable=False)
 
+    # resolution_timestamp is part of the primary key only because of partitioning
+    __mapper_args__ = {'primary_key': [id]}
+
     def __str__(self):
         return self.problem
 
@@ -815,20 +904,27 @@ class AppliedChange(Base):
     dependency or another transaction dependency (scriptlet).
 
     Generated by build_resolver for each build. Displayed by frontend.
+
+    Partitioned by month together with builds (see `koschei.partitions`).
     """
     __table_args__ = (
+        PrimaryKeyConstraint('id', 'build_started'),
+        ForeignKeyConstraint(
+            ['build_id', 'build_started'],
+            ['build.id', 'build.started'],
+            ondelete='CASCADE',
+        ),
         CheckConstraint(
             'COALESCE(prev_dep_id, 0) <> COALESCE(curr_dep_id, 0)',
             name='applied_change_dep_id_check'
         ),
+        {'postgresql_partition_by': 'RANGE (build_started)'},
     )
 
-    id = Column(Integer, primary_key=True)
-    build_id = Column(
-        ForeignKey('build.id', ondelete='CASCADE'),
-        index=True,
-        nullable=False,
-    )
+    id = Column(Integer, autoincrement=True)
+    build_id = Column(Integer, index=True, nullable=False)
+    # Denormalized start time of the build, used as partitioning key
+    build_started = Column(DateTime, nullable=False, default=_build_started_default)
     prev_dep_id = Column(ForeignKey('dependency.id'), index=True)
     prev_dep = relationship(
         Dependency,
@@ -846,6 +942,9 @@ class AppliedChange(Base):
     distance = Column(Integer)
     build = None  # backref
 
+    # build_started is part of the primary key only because of partitioning
+    __mapper_args__ = {'primary_key': [id]}
+
     @property
     def dep_name(self):
         return self.curr_dep.name if self.curr_dep else self.prev_dep.name
@@ -1127,7 +1226,10 @@ def count_query(entity):
 
 class ScalarStats(MaterializedView):
     """
-    Materialized view for statistics page. Regenerated by polling.
+    Materialized view for statistics page. Triggers record changes in
+    ScalarStatsDelta, use `current` to get up-to-date values. The changes are
+    folded in frequently by `fold_deltas`, the view is fully regenerated less
+    often. Both are done by polling.
 
     Contains global statistics.
     """
@@ -1139,6 +1241,8 @@ class ScalarStats(MaterializedView):
         count_query(Build).label('builds'),
         count_query(Build).where(Build.real).label('real_builds'),
         count_query(Build).where(~Build.real).label('scratch_builds'),
+        select([func.sum(KojiTask.finished - KojiTask.started)])
+        .select_from(KojiTask).label('total_time'),
     ))
     refresh_time = Column(DateTime, primary_key=True)
     packages = Column(Integer, nullable=False)
@@ -1147,18 +1251,114 @@ class ScalarStats(MaterializedView):
     builds = Column(Integer, nullable=False)
     real_builds = Column(Integer, nullable=False)
     scratch_builds = Column(Integer, nullable=False)
+    # sum of time of all Koji tasks
+    total_time = Column(Interval)
+
+    COUNTERS = (
+        'packages', 'tracked_packages', 'blocked_packages',
+        'builds', 'real_builds', 'scratch_builds',
+    )
+
+    @classmethod
+    def refresh(cls, db):
+        # the lock prevents a concurrent fold from updating the deleted row
+        pg_lock(db, LOCK_STATS, 0, transaction=True)
+        # pending deltas are deleted in the same statement that recomputes the
+        # statistics, so that concurrently committed changes are counted once
+        db.execute('DELETE FROM "{0}"'.format(cls.__tablename__))
+        db.execute('WITH delta AS (DELETE FROM scalar_stats_delta) '
+                   'INSERT INTO "{0}" ({1})'.format(cls.__tablename__, cls._view_sql))
+
+    @classmethod
+    def fold_deltas(cls, db):
+        """
+        Adds changes recorded in ScalarStatsDelta to ScalarStats and deletes them,
+        so that the deltas don't accumulate between full refreshes. Much cheaper
+        than `refresh`.
+        """
+        pg_lock(db, LOCK_STATS, 0, transaction=True)
+        # deltas are kept if there's no row to fold them into yet
+        db.execute("""
+            WITH deleted AS (
+                DELETE FROM scalar_stats_delta
+                WHERE EXISTS (SELECT 1 FROM "{0}")
+                RETURNING *
+            )
+            UPDATE "{0}" SET
+                refresh_time = greatest(
+                    "{0}".refresh_time, delta.refresh_time
+                ),
+                {1},
+                total_time = coalesce(
+                    "{0}".total_time + delta.total_time,
+                    "{0}".total_time,
+                    delta.total_time
+                )
+            FROM (
+                SELECT max("timestamp") AS refresh_time, {2},
+                       sum(total_time) AS total_time
+                FROM deleted
+            ) AS delta
+        """.format(
+            cls.__tablename__,
+            ', '.join('{0} = "{1}".{0} + delta.{0}'.format(name, cls.__tablename__)
+                      for name in cls.COUNTERS),
+            ', '.join('coalesce(sum({0}), 0) AS {0}'.format(name)
+                      for name in cls.COUNTERS),
+        ))
+
+    @classmethod
+    def current(cls, db):
+        """
+        Returns current statistics, including changes recorded by triggers in
+        ScalarStatsDelta since the last refresh. The returned row has the same
+        attributes as ScalarStats.
+        """
+        delta = select(
+            [func.max(ScalarStatsDelta.timestamp).label('refresh_time')] +
+            [func.coalesce(func.sum(getattr(ScalarStatsDelta, name)), 0).label(name)
+             for name in cls.COUNTERS] +
+            [func.sum(ScalarStatsDelta.total_time).label('total_time')]
+        ).alias('delta')
+        return db.query(
+            func.greatest(cls.refresh_time, delta.c.refresh_time).label('refresh_time'),
+            *[(getattr(cls, name) + delta.c[name]).label(name) for name in cls.COUNTERS],
+            sum_intervals(cls.total_time, delta.c.total_time).label('total_time'),
+        ).one()
+
+
+class ScalarStatsDelta(Base):
+    """
+    Changes of ScalarStats recorded by triggers. Insert-only, so that writing
+    transactions don't contend for the single ScalarStats row. Folded into
+    ScalarStats on read (see `ScalarStats.current`), periodically by
+    `ScalarStats.fold_deltas` and by its refresh.
+    """
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime, nullable=False, server_default=func.now())
+    packages = Column(Integer, nullable=False, server_default='0')
+    tracked_packages = Column(Integer, nullable=False, server_default='0')
+    blocked_packages = Column(Integer, nullable=False, server_default='0')
+    builds = Column(Integer, nullable=False, server_default='0')
+    real_builds = Column(Integer, nullable=False, server_default='0')
+    scratch_builds = Column(Integer, nullable=False, server_default='0')
+    total_time = Column(Interval)
+
+
+def sum_intervals(*intervals):
+    """
+    Sum of nullable intervals, which is NULL only if all of them are NULL.
+    """
+    return func.coalesce(sum(intervals[1:], intervals[0]), *intervals)
 
 
 def _resource_consumption_stats_view():
     time_difference_expr = func.sum(KojiTask.finished - KojiTask.started)
-    time_difference = extract('EPOCH', time_difference_expr)
-    time_difference_all = select([time_difference]).select_from(KojiTask)
     return (
         select([
             Package.name,
             KojiTask.arch,
             time_difference_expr.label('time'),
-            cast(time_difference / time_difference_all, Float).label('time_percentage'),
         ])
         .select_from(
             join(
@@ -1172,7 +1372,8 @@ def _resource_consumption_stats_view():
 
 class ResourceConsumptionStats(MaterializedView):
     """
-    Materialized view for statistics page. Regenerated by polling.
+    Materialized view for statistics page. Kept up to date by triggers, fully
+    regenerated periodically by polling.
 
     Contains per-package statistics.
     """
@@ -1180,7 +1381,19 @@ class ResourceConsumptionStats(MaterializedView):
     name = Column(String, primary_key=True)
     arch = Column(String, primary_key=True)
     time = Column(Interval, index=True)
-    time_percentage = Column(Float)
+    # computed on read, so that the triggers don't need to update all rows when
+    # the total time changes
+    time_percentage = column_property(cast(
+        extract('EPOCH', time) /
+        func.nullif(
+            extract('EPOCH', select([sum_intervals(
+                ScalarStats.total_time,
+                select([func.sum(ScalarStatsDelta.total_time)]).as_scalar(),
+            )]).as_scalar()),
+            0,
+        ),
+        Float,
+    ))
 
 
 # Indices
@@ -1217,17 +1430,27 @@ Index(
     Build.task_id,
     postgresql_where=(Build.last_complete),
 )
+Index(
+    'ix_builds_last_complete_started',
+    Build.started,
+    postgresql_where=(Build.last_complete),
+)
+Index(
+    'ix_package_precomputed_priority',
+    Package.precomputed_priority.desc(),
+    postgresql_where=(Package.precomputed_priority.isnot(None)),
+)
 
 
 # Relationships
 Package.last_complete_build = relationship(
     Build,
-    primaryjoin=(Build.id == Package.last_complete_build_id),
+    primaryjoin=(Build.id == foreign(Package.last_complete_build_id)),
     uselist=False,
 )
 Package.last_build = relationship(
     Build,
-    primaryjoin=(Build.id == Package.last_build_id),
+    primaryjoin=(Build.id == foreign(Package.last_build_id)),
     uselist=False,
 )
 Package.all_builds = relationship(
@@ -1245,7 +1468,10 @@ Package.unapplied_changes = relationship(
 Build.dependency_changes = relationship(
     AppliedChange,
     backref='build',
-    primaryjoin=(Build.id == AppliedChange.build_id),
+    primaryjoin=(
+        (Build.id == AppliedChange.build_id) &
+        (Build.started == AppliedChange.build_started)
+    ),
     order_by=AppliedChange.distance.nullslast(),
     passive_deletes=True,
 )
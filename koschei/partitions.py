@@ -0,0 +1,86 @@
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Management of monthly partitions of build, koji_task, applied_change,
+resolution_change and resolution_problem tables. The partitioning functions
+themselves are defined in partitions.sql.
+
+Builds are partitioned by `started`, their tasks and dependency changes are
+partitioned by the same value (`build_started`), so that all of them can be dropped
+at once. The same holds for resolution changes and problems.
+"""
+
+from datetime import date
+
+from sqlalchemy.sql import text
+
+
+def get_partition_months(db, table='build'):
+    """
+    Returns months of existing monthly partitions of given table.
+
+    :param: db Database session
+    :param: table Name of the partitioned table
+    :return: Sorted list of dates of first days of the months
+    """
+    names = db.execute(text("""
+        SELECT child.relname
+            FROM pg_inherits JOIN pg_class AS child ON child.oid = inhrelid
+            WHERE inhparent = CAST(:table AS regclass)
+    """), dict(table=table)).fetchall()
+    months = []
+    for (name,) in names:
+        suffix = name[len(table):]
+        if suffix != '_default':
+            year, month = suffix[1:].split('_')
+            months.append(date(int(year), int(month), 1))
+    return sorted(months)
+
+
+def create_partitions(db, months_ahead):
+    """
+    Creates monthly partitions for the current month and given number of following
+    months, if they don't exist yet. Partitions have to exist before the rows are
+    inserted, otherwise the rows end up in the default partition.
+
+    :param: db Database session
+    :param: months_ahead Number of months following the current one
+    """
+    db.execute(text("""
+        SELECT create_month_partitions((now() + make_interval(months => m))::date)
+            FROM generate_series(0, :months_ahead) AS m
+    """), dict(months_ahead=months_ahead))
+
+
+def drop_partitions(db, older_than):
+    """
+    Drops monthly partitions that contain only rows older than given number of
+    months. Builds that are still the last or last complete builds of some package
+    are kept, together with their tasks and dependency changes, in the default
+    partitions. Statistics maintained by triggers are not updated.
+
+    :param: db Database session
+    :param: older_than Number of months
+    :return: List of months whose partitions were dropped
+    """
+    cutoff = db.execute(text("""
+        SELECT date_trunc('month', now() - make_interval(months => :older_than))::date
+    """), dict(older_than=older_than)).scalar()
+    months = [month for month in get_partition_months(db) if month < cutoff]
+    for month in months:
+        db.execute(text("SELECT drop_month_partitions(:month)"), dict(month=month))
+    return months
@@ -17,15 +17,91 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
+import threading
+import time
+
+from collections import OrderedDict
+
 import fedora_messaging.api as fedmsg
+import koji
+
+from sqlalchemy.orm import joinedload
 
-from koschei import plugin, backend
+from koschei import plugin, backend, util
 from koschei.config import get_config
+from koschei.backend import koji_util
 from koschei.backend.service import Service
-from koschei.models import Build, Package
+from koschei.models import Build, Collection, Package
+
+
+class MessageBatch(object):
+    """
+    Buffer of messages received from the message bus, so that they can be
+    processed in batches. Only the last received message with each key is kept.
+    Thread-safe.
+
+    :param window: How long (in seconds) can messages wait in the buffer
+    :param max_size: Number of buffered messages after which the batch is processed
+                     without waiting for the window to elapse
+    """
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        self.items = OrderedDict()
+        self.first_added = None
+
+    def add(self, key, value):
+        with self.condition:
+            if not self.items:
+                self.first_added = time.time()
+            self.items[key] = value
+            self.condition.notify()
+
+    def take(self):
+        """
+        Waits until the batch is due and returns the buffered messages.
+
+        :return: OrderedDict of key -> message
+        """
+        with self.condition:
+            while True:
+                timeout = None
+                if self.items:
+                    timeout = self.first_added + self.window - time.time()
+                    if timeout <= 0 or len(self.items) >= self.max_size:
+                        items = self.items
+                        self.items = OrderedDict()
+                        return items
+                self.condition.wait(timeout)
 
 
 class Watcher(Service):
+    """
+    Consumes Koji messages from the message bus.
+
+    With `batch_window` configured, task state changes and tag messages are not
+    processed immediately, but buffered and processed in batches in separate threads
+    with their own sessions. Batches of one task are processed in order, so the last
+    state of a task is never overwritten by an older one. Messages buffered when the
+    service stops are lost, but running builds and latest builds are also checked by
+    polling.
+    """
+    def __init__(self, session):
+        super(Watcher, self).__init__(session)
+        self.batch = None
+        self.tag_batch = None
+        if self.service_config.get('batch_window'):
+            self.batch = MessageBatch(
+                self.service_config['batch_window'],
+                self.service_config.get('batch_size', 100),
+            )
+            self.tag_batch = MessageBatch(
+                self.service_config['batch_window'],
+                self.service_config.get('batch_size', 100),
+            )
+        self.memory_checked = 0
+
     def get_topic(self, name):
         return '{}.{}'.format(get_config('fedmsg.topic'), name)
 
@@ -41,23 +117,159 @@ class Watcher(Service):
     def update_build_state(self, msg):
         assert msg['attribute'] == 'state'
         task_id = msg['id']
+        if self.batch:
+            self.batch.add(task_id, msg['new'])
+            return
         build = self.db.query(Build).filter_by(task_id=task_id).first()
         if build:
             state = msg['new']
             backend.update_build_state(self.session, build, state)
 
+    def update_build_states(self, session, states):
+        """
+        Processes a batch of task state changes.
+
+        :param session: Session used exclusively by the batch processing thread
+        :param states: dict of task_id -> Koji task state name
+        """
+        try:
+            builds = session.db.query(Build)\
+                .filter(Build.task_id.in_(states.keys()))\
+                .filter_by(state=Build.RUNNING)\
+                .all()
+            self.log.info("Processing {} state changes of {} running builds"
+                          .format(len(states), len(builds)))
+            backend.update_build_states(
+                session,
+                [(build, states[build.task_id]) for build in builds],
+            )
+        finally:
+            session.db.rollback()
+
     def register_real_build(self, msg):
-        pkg = self.db.query(Package).filter_by(name=msg['name']).first()
-        if pkg:
-            newer_build = backend.get_newer_build_if_exists(self.session, pkg)
-            if newer_build:
+        if self.tag_batch:
+            self.tag_batch.add((msg['build_id'], msg['tag']), msg)
+            return
+        self.register_real_builds(self.session, [msg])
+
+    def get_tag_collections(self, session, tags):
+        """
+        Maps Koji tags to collections whose destination tag inherits from them.
+        Collections in secondary mode are skipped, because their builds are not
+        tagged in the Koji instance the messages come from.
+
+        :param session: Session used for the queries
+        :param tags: set of Koji tag names
+        :return: dict of tag name -> list of collections
+        """
+        koji_session = session.koji('primary')
+        tag_collections = {}
+        for collection in session.db.query(Collection).filter_by(secondary_mode=False):
+            inheritance = koji_util.get_tag_inheritance_cached(
+                session, koji_session, collection.dest_tag,
+            )
+            for tag in tags.intersection(inheritance):
+                tag_collections.setdefault(tag, []).append(collection)
+        return tag_collections
+
+    def register_real_builds(self, session, msgs):
+        """
+        Registers real builds announced by a batch of tag messages, with one
+        registration per collection.
+
+        Tag messages carry only name, version and release of the build, which is
+        used to skip builds that are not newer than the last build of the package.
+        The rest of build information (epoch, state, task ID) is obtained with one
+        Koji multicall for the whole batch.
+
+        :param session: Session used for the processing
+        :param msgs: iterable of tag message bodies
+        """
+        try:
+            msgs = list(msgs)
+            tag_collections = self.get_tag_collections(
+                session, {msg['tag'] for msg in msgs},
+            )
+            collection_msgs = OrderedDict()
+            for msg in msgs:
+                for collection in tag_collections.get(msg['tag'], ()):
+                    collection_msgs.setdefault(collection, []).append(msg)
+            # format: [(collection, package, build_id)]
+            candidates = []
+            for collection, tag_msgs in collection_msgs.items():
+                query = session.db.query(Package)\
+                    .options(joinedload(Package.last_build))\
+                    .filter_by(collection_id=collection.id)\
+                    .filter(Package.name.in_({msg['name'] for msg in tag_msgs}))
+                if not collection.poll_untracked:
+                    query = query.filter_by(tracked=True)
+                packages = {package.name: package for package in query}
+                for msg in tag_msgs:
+                    package = packages.get(msg['name'])
+                    # epoch is not part of the message, assume it didn't change
+                    if package and util.is_build_newer(package.last_build, {
+                            'epoch': getattr(package.last_build, 'epoch', None),
+                            'version': msg['version'],
+                            'release': msg['release'],
+                    }):
+                        candidates.append((collection, package, msg['build_id']))
+            if not candidates:
+                return
+            build_infos = koji_util.itercall(
+                session.koji('primary'),
+                [build_id for _, _, build_id in candidates],
+                lambda k, build_id: k.getBuild(build_id),
+            )
+            # format: {collection: {package_id: build_info}}
+            new_builds = OrderedDict()
+            for (collection, package, _), info in zip(candidates, build_infos):
+                if (
+                        info and
+                        info['state'] == koji.BUILD_STATES['COMPLETE'] and
+                        info['task_id'] and
+                        util.is_build_newer(package.last_build, info)
+                ):
+                    package_builds = new_builds.setdefault(collection, {})
+                    if util.is_build_newer(package_builds.get(package.id), info):
+                        package_builds[package.id] = info
+            for collection, package_builds in new_builds.items():
+                self.log.info("Registering {} real builds in {}"
+                              .format(len(package_builds), collection))
                 backend.register_real_builds(
-                    self.session,
-                    pkg.collection,
-                    [(pkg.id, newer_build)],
+                    session,
+                    collection,
+                    list(package_builds.items()),
                 )
+        finally:
+            session.db.rollback()
+
+    def process_batches(self, session, batch, process, description):
+        while True:
+            items = batch.take()
+            try:
+                process(session, items)
+            except Exception:
+                # the builds will be updated by polling
+                self.log.exception("Processing of {} failed".format(description))
 
     def main(self):
+        if self.batch:
+            for name, batch, process, description in (
+                    ('watcher-batches', self.batch, self.update_build_states,
+                     "task state changes"),
+                    ('watcher-tag-batches', self.tag_batch,
+                     lambda session, msgs: self.register_real_builds(
+                         session, msgs.values(),
+                     ), "tag messages"),
+            ):
+                thread = threading.Thread(
+                    target=self.process_batches,
+                    args=(self.create_session(), batch, process, description),
+                    name=name,
+                )
+                thread.daemon = True
+                thread.start()
+
         def callback(message):
             self.notify_watchdog()
             topic = message.topic
@@ -68,5 +280,11 @@ class Watcher(Service):
                 plugin.dispatch_event('fedmsg_event', self.session, topic, msg)
             finally:
                 self.db.rollback()
-            self.memory_check()
+            # in batch mode, memory is checked at most once per batch window
+            if (
+                    not self.batch or
+                    time.time() - self.memory_checked >= self.batch.window
+            ):
+                self.memory_check()
+                self.memory_checked = time.time()
         fedmsg.consume(callback)
@@ -0,0 +1,105 @@
+-- Monthly range partitioning of build, koji_task, applied_change,
+-- resolution_change and resolution_problem. Partitions are named
+-- <table>_YYYY_MM, rows that don't belong to any monthly partition are stored
+-- in <table>_default. See koschei/partitions.py
+-- Note: the file is executed as SQLAlchemy DDL, percent signs would need escaping
+
+CREATE OR REPLACE FUNCTION create_month_partitions(month date)
+    RETURNS void AS $$
+DECLARE lower_bound date := date_trunc('month', month);
+        upper_bound date := date_trunc('month', month) + interval '1 month';
+        suffix text := to_char(month, '_YYYY_MM');
+        part record;
+        conflict boolean;
+BEGIN
+    FOR part IN SELECT * FROM (VALUES
+            ('build', 'started'),
+            ('koji_task', 'build_started'),
+            ('applied_change', 'build_started'),
+            ('resolution_change', 'timestamp'),
+            ('resolution_problem', 'resolution_timestamp')
+        ) AS p(parent, key) LOOP
+        CONTINUE WHEN to_regclass(part.parent || suffix) IS NOT NULL;
+        -- rows already stored in the default partition would violate the new
+        -- partition's constraint, they stay in the default partition
+        EXECUTE 'SELECT EXISTS (SELECT 1 FROM '
+                || quote_ident(part.parent || '_default') || ' WHERE '
+                || quote_ident(part.key) || ' >= ' || quote_literal(lower_bound)
+                || ' AND ' || quote_ident(part.key) || ' < '
+                || quote_literal(upper_bound) || ')'
+            INTO conflict;
+        IF conflict THEN
+            RAISE WARNING USING MESSAGE = 'Not creating partition ' || part.parent
+                || suffix || ', default partition contains rows in its range';
+            CONTINUE;
+        END IF;
+        EXECUTE 'CREATE TABLE ' || quote_ident(part.parent || suffix)
+                || ' PARTITION OF ' || quote_ident(part.parent)
+                || ' FOR VALUES FROM (' || quote_literal(lower_bound)
+                || ') TO (' || quote_literal(upper_bound) || ')';
+    END LOOP;
+END $$ LANGUAGE plpgsql;
+
+-- Drops monthly partitions of given month. Builds that are still last builds or
+-- last complete builds of some package are kept together with their tasks and
+-- dependency changes, they are moved to the default partitions.
+CREATE OR REPLACE FUNCTION drop_month_partitions(month date)
+    RETURNS void AS $$
+DECLARE lower_bound date := date_trunc('month', month);
+        upper_bound date := date_trunc('month', month) + interval '1 month';
+        suffix text := to_char(month, '_YYYY_MM');
+        part record;
+BEGIN
+    IF to_regclass('build' || suffix) IS NULL THEN
+        RETURN;
+    END IF;
+    CREATE TEMPORARY TABLE kept_build AS
+        SELECT * FROM build
+            WHERE started >= lower_bound AND started < upper_bound
+              AND id IN (SELECT last_build_id FROM package
+                         UNION
+                         SELECT last_complete_build_id FROM package);
+    CREATE TEMPORARY TABLE kept_koji_task AS
+        SELECT * FROM koji_task
+            WHERE build_started >= lower_bound AND build_started < upper_bound
+              AND build_id IN (SELECT id FROM kept_build);
+    CREATE TEMPORARY TABLE kept_applied_change AS
+        SELECT * FROM applied_change
+            WHERE build_started >= lower_bound AND build_started < upper_bound
+              AND build_id IN (SELECT id FROM kept_build);
+    -- referencing tables first, detaching a partition of a referenced table
+    -- requires that there are no referencing rows
+    FOR part IN SELECT * FROM (VALUES
+            ('resolution_problem', 'resolution_timestamp'),
+            ('resolution_change', 'timestamp'),
+            ('applied_change', 'build_started'),
+            ('koji_task', 'build_started'),
+            ('build', 'started')
+        ) AS p(parent, key) LOOP
+        IF to_regclass(part.parent || suffix) IS NOT NULL THEN
+            EXECUTE 'ALTER TABLE ' || quote_ident(part.parent)
+                    || ' DETACH PARTITION ' || quote_ident(part.parent || suffix);
+            EXECUTE 'DROP TABLE ' || quote_ident(part.parent || suffix);
+        END IF;
+        -- rows of the month that ended up in the default partition
+        EXECUTE 'DELETE FROM ' || quote_ident(part.parent) || ' WHERE '
+                || quote_ident(part.key) || ' >= ' || quote_literal(lower_bound)
+                || ' AND ' || quote_ident(part.key) || ' < '
+                || quote_literal(upper_bound);
+    END LOOP;
+    INSERT INTO build SELECT * FROM kept_build;
+    INSERT INTO koji_task SELECT * FROM kept_koji_task;
+    INSERT INTO applied_change SELECT * FROM kept_applied_change;
+    DROP TABLE kept_build, kept_koji_task, kept_applied_change;
+END $$ LANGUAGE plpgsql;
+
+CREATE TABLE IF NOT EXISTS build_default PARTITION OF build DEFAULT;
+CREATE TABLE IF NOT EXISTS koji_task_default PARTITION OF koji_task DEFAULT;
+CREATE TABLE IF NOT EXISTS applied_change_default PARTITION OF applied_change DEFAULT;
+CREATE TABLE IF NOT EXISTS resolution_change_default
+    PARTITION OF resolution_change DEFAULT;
+CREATE TABLE IF NOT EXISTS resolution_problem_default
+    PARTITION OF resolution_problem DEFAULT;
+
+SELECT create_month_partitions((now() + make_interval(months => m))::date)
+    FROM generate_series(0, 2) AS m;
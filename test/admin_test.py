@@ -18,15 +18,17 @@
 
 import shlex
 
-from datetime import datetime
+from datetime import date, datetime
 from tempfile import NamedTemporaryFile
 from mock import patch
 
 from sqlalchemy.exc import InvalidRequestError
 
 from test.common import DBTest, KoscheiMockSessionMixin, with_koji_cassette
+from koschei import partitions
 from koschei.models import (
     AdminNotice, Build, PackageGroup, Collection, Package, CollectionGroup,
+    ResolutionChange, ResolutionProblem,
 )
 from koschei.admin import main, KoscheiAdminSession
 
@@ -65,6 +67,36 @@ class AdminTest(DBTest):
         self.assertIs(None, b1)
         self.assertIsNot(None, b2)
 
+    def test_cleanup_partitions(self):
+        self.db.execute("SELECT create_month_partitions('2016-01-01')")
+        old_build_id = self.prepare_build('rnv', state=True, started='2016-1-1').id
+        last_build = self.prepare_build('rnv', state=False, started='2016-1-2')
+        self.prepare_task(last_build)
+        self.prepare_depchange('foo', None, '1', '1', None, '2', '1',
+                               last_build.id, 1)
+        last_build_id = last_build.id
+        resolution_change = ResolutionChange(
+            package_id=self.prepare_package('eclipse').id,
+            resolved=False,
+            timestamp=datetime(2016, 1, 1),
+        )
+        self.db.add(resolution_change)
+        self.db.flush()
+        self.db.add(ResolutionProblem(resolution_id=resolution_change.id,
+                                      problem='problem'))
+        self.call_command('cleanup')
+        self.assertNotIn(date(2016, 1, 1), partitions.get_partition_months(self.db))
+        self.assertIs(None, self.db.query(Build).get(old_build_id))
+        last_build = self.db.query(Build).get(last_build_id)
+        self.assertIsNot(None, last_build)
+        self.assertEqual(1, len(last_build.build_arch_tasks))
+        self.assertEqual(1, len(last_build.dependency_changes))
+        rnv = self.db.query(Package).filter_by(name='rnv').one()
+        self.assertEqual(last_build_id, rnv.last_build_id)
+        self.assertEqual(last_build_id, rnv.last_complete_build_id)
+        self.assertTrue(last_build.last_complete)
+        self.assertEqual(0, self.db.query(ResolutionChange).count())
+
     def test_add_pkg(self):
         rnv = self.prepare_package('rnv', tracked=False)
         eclipse = self.prepare_package('eclipse', tracked=False)
@@ -16,14 +16,23 @@
 #
 # Author: Michael Simacek <msimacek@redhat.com>
 
+import dbm
 import koji
+import os
 
 from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
 
-from test.common import DBTest, with_koji_cassette
-from mock import Mock, patch
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import text
+
+from test.common import DBTest, with_koji_cassette, patch_config
+from mock import Mock, patch, call
 from koschei import plugin, backend
-from koschei.models import Package, Build, KojiTask
+from koschei.backend import koji_util
+from koschei.db import get_engine
+from koschei.models import Package, Build, KojiTask, RepoMapping
 
 # pylint: disable=unbalanced-tuple-unpacking,blacklisted-name
 
@@ -148,6 +157,32 @@ class BackendTest(DBTest):
             self.assertEqual(koji.TASK_STATES['CLOSED'], tasks[2].state)
             self.assertEqual('x86_64', tasks[2].arch)
 
+    @with_koji_cassette('BackendTest/test_update_state')
+    def test_update_state_running_existing_task(self):
+        collection = self.prepare_collection('f29')
+        package = self.prepare_package('rnv', collection=collection)
+        started = datetime.now().replace(microsecond=0)
+        build = self.prepare_build(package, 'running', task_id=9107738,
+                                   started=started)
+        koji_task = KojiTask(
+            task_id=9107739,
+            arch='armhfp',
+            state=koji.TASK_STATES['OPEN'],
+            started=datetime.fromtimestamp(123),
+            build=build,
+        )
+        self.db.add(koji_task)
+        self.db.commit()
+        # started is referenced by the existing task, re-sync must not change it
+        backend.update_build_state(self.session, build, 'OPEN')
+        self.assertEqual('running', build.state_string)
+        self.assertEqual(started, build.started)
+        self.assertEqual(3, len(build.build_arch_tasks))
+        self.assertEqual(
+            {started},
+            {task.build_started for task in build.build_arch_tasks},
+        )
+
     # Regression test for https://github.com/fedora-infra/koschei/issues/27
     @with_koji_cassette
     def test_update_state_inconsistent(self):
@@ -160,6 +195,48 @@ class BackendTest(DBTest):
             self.assertEqual('ok', package.state_string)
             self.assertFalse(event.called)
 
+    @with_koji_cassette('BackendTest/test_update_state')
+    def test_register_real_builds_prefetch_arch_headers(self):
+        collection = self.prepare_collection('f29')
+        package = self.prepare_package('rnv', collection=collection)
+        build_info = {
+            'state': koji.BUILD_STATES['COMPLETE'],
+            'task_id': 9107738,
+            'epoch': None,
+            'version': '1.7.11',
+            'release': '7.fc22',
+        }
+        headers = {'BUILDARCHS': [], 'EXCLUDEARCH': [], 'EXCLUSIVEARCH': ['x86_64']}
+        with TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, 'srpm-arch-headers-cache.dbm')
+            cache_config = {
+                'backend': 'dogpile.cache.dbm',
+                'expiration_time': None,
+                'arguments': {'filename': cache_file},
+            }
+            with patch_config('prefetch_srpm_arch_headers', True), \
+                    patch_config('caching.srpm_arch_headers', cache_config), \
+                    patch('koschei.backend.koji_util.get_srpm_arch_headers',
+                          return_value=[headers]) as get_headers_mock:
+                backend.register_real_builds(
+                    self.session, collection, [(package.id, build_info)],
+                )
+                get_headers_mock.assert_called_once_with(
+                    self.session.koji('primary'),
+                    [{'name': 'rnv', 'version': '1.7.11', 'release': '7.fc22',
+                      'arch': 'src'}],
+                )
+                with dbm.open(cache_file, 'r') as cache_db:
+                    self.assertEqual(1, len(cache_db.keys()))
+                # scheduler gets the headers from the cache
+                self.assertEqual([headers], koji_util.get_srpm_arch_headers_cached(
+                    self.session, self.session.koji('primary'),
+                    [{'name': 'rnv', 'version': '1.7.11', 'release': '7.fc22',
+                      'arch': 'src'}],
+                ))
+                self.assertEqual(1, get_headers_mock.call_count)
+        self.assertEqual(9107738, package.last_build.task_id)
+
     @with_koji_cassette
     def test_refresh_latest_builds(self):
         self.db.delete(self.collection)
@@ -237,6 +314,44 @@ class BackendTest(DBTest):
         self.assertIs(False, log4j_build.untagged)
         self.assertIs(log4j_build, log4j.last_build)
 
+    @with_koji_cassette
+    def test_refresh_latest_builds_incremental(self):
+        self.db.delete(self.collection)
+        collection = self.prepare_collection(
+            'f29',
+            latest_builds_event_id=31800000,
+            latest_builds_full_refresh=datetime.now(),
+        )
+        # eclipse has a new build in koji, but there were no tag changes since the
+        # last refresh, it's not queried
+        eclipse = self.prepare_package('eclipse', collection=collection)
+        eclipse_build = self.prepare_build(
+            eclipse, 'complete', real=True, version='4.7.2', release='2.fc28',
+            task_id=24736744, started='2018-02-05 20:42:27',
+        )
+        # maven was retagged, no new build
+        maven = self.prepare_package('maven', collection=collection)
+        maven_build = self.prepare_build(
+            maven, 'complete', real=True, version='3.5.3', release='1.fc29',
+            task_id=25725733, started='2018-03-15 14:13:38',
+        )
+        # log4j was tagged back
+        log4j = self.prepare_package('log4j', collection=collection)
+        log4j_build = self.prepare_build(
+            log4j, 'complete', real=True, version='2.9.1', release='2.fc28',
+            untagged=True, task_id=22416320, started='2017-10-13 08:35:09',
+        )
+
+        with patch('koschei.backend.dispatch_event'):
+            backend.refresh_latest_builds(self.session)
+            self.db.commit()
+
+        self.assertIs(eclipse_build, eclipse.last_build)
+        self.assertIs(maven_build, maven.last_build)
+        self.assertIs(False, log4j_build.untagged)
+        self.assertIs(log4j_build, log4j.last_build)
+        self.assertEqual(31900000, collection.latest_builds_event_id)
+
     # regression test for #263
     @with_koji_cassette
     def test_refresh_latest_builds_latest_no_repo_id(self):
@@ -281,6 +396,100 @@ class BackendTest(DBTest):
         backend.update_build_state(self.session, running_build, 'ASSIGNED')
         self.assertEqual(0, self.db.query(Build).count())
 
+    @with_koji_cassette('BackendTest/test_update_state',
+                        'BackendTest/test_update_state_failed')
+    def test_update_states(self):
+        collection = self.prepare_collection('f29')
+        rnv = self.prepare_package('rnv', collection=collection)
+        self.prepare_build(rnv, 'failed')
+        rnv_build = self.prepare_build(rnv, 'running', task_id=9107738)
+        eclipse = self.prepare_package('eclipse', collection=collection)
+        self.prepare_build(eclipse, 'complete')
+        eclipse_build = self.prepare_build(eclipse, 'running', task_id=14503213)
+        with patch('koschei.backend.dispatch_event') as event:
+            backend.update_build_states(
+                self.session,
+                [(rnv_build, 'CLOSED'), (eclipse_build, 'FAILED')],
+            )
+            self.assertEqual('complete', rnv_build.state_string)
+            self.assertEqual('ok', rnv.state_string)
+            self.assertEqual(0, rnv.build_priority)
+            self.assertEqual(3, len(rnv_build.build_arch_tasks))
+            self.assertEqual('failed', eclipse_build.state_string)
+            self.assertEqual('failing', eclipse.state_string)
+            self.assertEqual(200, eclipse.build_priority)
+            event.assert_has_calls(
+                [
+                    call('package_state_change', session=self.session,
+                         package=rnv, prev_state='failing', new_state='ok'),
+                    call('package_state_change', session=self.session,
+                         package=eclipse, prev_state='ok', new_state='failing'),
+                ],
+                any_order=True,
+            )
+
+    @with_koji_cassette('BackendTest/test_update_state_failed')
+    def test_update_states_finished_concurrently(self):
+        collection = self.prepare_collection('f29')
+        package = self.prepare_package('eclipse', collection=collection)
+        self.prepare_build(package, 'complete')
+        build = self.prepare_build(package, 'running', task_id=14503213)
+        build_id = build.id
+
+        def finish_concurrently(_, task_ids):
+            # another process finishes the build while Koji is being queried
+            with get_engine().begin() as conn:
+                conn.execute(text("UPDATE build SET state = :state WHERE id = :id"),
+                             state=Build.COMPLETE, id=build_id)
+            return [False] * len(task_ids)
+
+        with patch('koschei.backend.koji_util.get_koji_faults',
+                   side_effect=finish_concurrently), \
+                patch('koschei.backend.dispatch_event') as event:
+            backend.update_build_states(self.session, [(build, 'FAILED')])
+        self.db.expire_all()
+        build = self.db.query(Build).get(build_id)
+        self.assertEqual('complete', build.state_string)
+        self.assertEqual([], build.build_arch_tasks)
+        self.assertFalse(event.called)
+
+    @with_koji_cassette('BackendTest/test_update_state')
+    def test_update_states_secondary_no_flush_before_lock(self):
+        # self.collection is in secondary mode, repo_id is mapped using RepoMapping
+        self.db.add(RepoMapping(secondary_id=123, primary_id=460889, task_id=1))
+        package = self.prepare_package('rnv')
+        build = self.prepare_build(package, 'running', task_id=9107738)
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', record_statement)
+        try:
+            with patch('koschei.backend.dispatch_event'):
+                backend.update_build_states(self.session, [(build, 'CLOSED')])
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record_statement)
+        lock = next(i for i, statement in enumerate(statements)
+                    if 'FOR UPDATE' in statement)
+        self.assertFalse([statement for statement in statements[:lock]
+                          if statement.startswith('UPDATE build')])
+        self.assertEqual('complete', build.state_string)
+        self.assertEqual(123, build.repo_id)
+
+    @with_koji_cassette('BackendTest/test_cancel')
+    def test_update_states_cancel(self):
+        self.prepare_packages('rnv', 'eclipse')
+        running_build = self.prepare_build('rnv', task_id=25561246)
+        running_build.cancel_requested = True
+        canceled_build = self.prepare_build('eclipse', task_id=25561247)
+        self.db.commit()
+        backend.update_build_states(
+            self.session,
+            [(running_build, 'ASSIGNED'), (canceled_build, 'CANCELED')],
+        )
+        self.assertEqual(0, self.db.query(Build).count())
+
     @with_koji_cassette
     def test_refresh_packages(self):
         # XXX there should not be global collection
@@ -294,6 +503,29 @@ class BackendTest(DBTest):
         self.assertFalse(rnv.blocked)
         self.assertTrue(tools.blocked)
         self.assertEqual(9, self.db.query(Package).count())
+        self.assertEqual(30000000, collection.packages_event_id)
+        self.assertIsNotNone(collection.packages_full_refresh)
+
+    @with_koji_cassette
+    def test_refresh_packages_incremental(self):
+        self.db.delete(self.collection)
+        collection = self.prepare_collection(
+            'f29',
+            packages_event_id=30000100,
+            packages_full_refresh=datetime.now(),
+        )
+        eclipse = self.prepare_package('eclipse', collection=collection)
+        rnv = self.prepare_package('rnv', collection=collection)
+        maven = self.prepare_package('maven', collection=collection, blocked=True)
+        backend.refresh_packages(self.session)
+        self.assertFalse(eclipse.blocked)
+        self.assertTrue(rnv.blocked)
+        self.assertFalse(maven.blocked)
+        tools = self.db.query(Package).filter_by(name='maven-doxia-tools').one()
+        self.assertFalse(tools.blocked)
+        self.assertFalse(tools.tracked)
+        self.assertEqual(4, self.db.query(Package).count())
+        self.assertEqual(30000105, collection.packages_event_id)
 
     @with_koji_cassette
     def test_submit_build(self):
@@ -18,6 +18,8 @@
 
 import koji
 
+from mock import patch
+
 from test.common import AbstractTest, my_vcr, with_koji_cassette
 from koschei.backend import koji_util
 
@@ -48,6 +50,32 @@ class KojiUtilLoadTest(AbstractTest):
         load = koji_util.get_koji_load(self.session, self.all_arches, ['armv7hl'])
         self.assertAlmostEqual(0.8958, load, 4)
 
+    @my_vcr.use_cassette('koji_load_all')
+    def test_koji_load_snapshot(self):
+        snapshot = koji_util.get_koji_load_snapshot(self.session, self.all_arches)
+        self.assertCountEqual(['i386', 'x86_64', 'armhfp'], snapshot['arches'].keys())
+        load = koji_util.get_koji_load(self.session, self.all_arches, ['i686', 'x86_64'],
+                                       snapshot=snapshot)
+        self.assertAlmostEqual(0.5119, load, 4)
+        load = koji_util.get_koji_load(self.session, self.all_arches, ['noarch'],
+                                       snapshot=snapshot)
+        self.assertAlmostEqual(0.4305, load, 4)
+
+    def test_add_koji_load(self):
+        snapshot = {'arches': {
+            'i386': {'capacity': 10, 'task_load': 5},
+            'x86_64': {'capacity': 10, 'task_load': 2},
+            'armhfp': {'capacity': 10, 'task_load': 1},
+        }}
+        koji_util.add_koji_load(snapshot, self.all_arches, {'i686', 'x86_64'}, 1.5)
+        self.assertEqual(6.5, snapshot['arches']['i386']['task_load'])
+        self.assertEqual(3.5, snapshot['arches']['x86_64']['task_load'])
+        self.assertEqual(1, snapshot['arches']['armhfp']['task_load'])
+        # noarch goes to the least loaded arch
+        koji_util.add_koji_load(snapshot, self.all_arches, {'noarch'}, 1.5)
+        self.assertEqual(2.5, snapshot['arches']['armhfp']['task_load'])
+        self.assertEqual(3.5, snapshot['arches']['x86_64']['task_load'])
+
 
 class KojiArchesTest(AbstractTest):
     def setUp(self):
@@ -142,6 +170,17 @@ class KojiArchesTest(AbstractTest):
                                       build_arches=self.all_arches),
         )
 
+    def test_get_srpm_arches_prefetched_headers(self):
+        nvra = {'arch': 'src', 'name': 'rnv', 'release': '11.fc26',
+                'version': '1.7.11'}
+        headers = {'BUILDARCHS': [], 'EXCLUDEARCH': [], 'EXCLUSIVEARCH': ['x86_64']}
+        # no cassette - Koji must not be queried
+        self.assertEqual(
+            {'x86_64'},
+            koji_util.get_srpm_arches(self.session, self.all_arches, nvra,
+                                      headers=headers),
+        )
+
 
 class KojiUtilOtherTest(AbstractTest):
     @with_koji_cassette
@@ -186,3 +225,90 @@ class KojiUtilOtherTest(AbstractTest):
         self.assertTrue(koji_util.is_koji_fault(koji_sesion, 32738401))
         # Failed buildArch task due to HTTPError: HTTP Error 503: Backend fetch failed
         self.assertTrue(koji_util.is_koji_fault(koji_sesion, 32738626))
+
+
+class FakeClientSession(object):
+    """
+    Mimics how koji.ClientSession dispatches calls through its internal methods.
+    """
+    def __init__(self, *args):
+        self.multicall = False
+        self._calls = []
+
+    def _sendCall(self, handler, headers, request):
+        return 'result'
+
+    def _callMethod(self, name, args, kwargs=None):
+        if self.multicall:
+            self._calls.append(name)
+            return None
+        if name == 'multiCall':
+            return [['result'] for _ in args[0]]
+        # the first attempt of getFlaky "fails" and is retried
+        for _ in range(2 if name == 'getFlaky' else 1):
+            result = self._sendCall('', {}, 'request')
+        return result
+
+    def multiCall(self):
+        self.multicall = False
+        calls, self._calls = self._calls, []
+        return self._callMethod('multiCall', (calls,), {})
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self._callMethod(name, args, kwargs)
+
+
+class KojiCallStatsTest(AbstractTest):
+    def setUp(self):
+        super(KojiCallStatsTest, self).setUp()
+        koji_util.koji_call_stats.reset()
+        with patch('koji.ClientSession', FakeClientSession):
+            self.koji_session = koji_util.KojiSession()
+
+    def get_stats(self, method):
+        return koji_util.koji_call_stats.methods[('primary', method)]
+
+    def test_direct_calls(self):
+        self.assertEqual('result', self.koji_session.getTaskInfo(1))
+        self.koji_session.getTaskInfo(2)
+        stats = self.get_stats('getTaskInfo')
+        self.assertEqual(2, stats.calls)
+        self.assertEqual(0, stats.batched_calls)
+        self.assertEqual(0, stats.retries)
+        self.assertEqual(2 * len('request'), stats.request_bytes)
+        self.assertEqual(2, stats.duration.count)
+
+    def test_retries(self):
+        self.koji_session.getFlaky()
+        stats = self.get_stats('getFlaky')
+        self.assertEqual(1, stats.calls)
+        self.assertEqual(1, stats.retries)
+
+    def test_multicall(self):
+        results = list(koji_util.itercall(
+            self.koji_session, [1, 2, 3],
+            lambda k, task_id: k.getTaskInfo(task_id),
+            chunk_size=2,
+        ))
+        self.assertEqual(['result'] * 3, results)
+        self.assertEqual(0, self.get_stats('getTaskInfo').calls)
+        self.assertEqual(3, self.get_stats('getTaskInfo').batched_calls)
+        multicall_stats = self.get_stats('multiCall')
+        self.assertEqual(2, multicall_stats.calls)
+        self.assertEqual(2, multicall_stats.multicall_size.count)
+        self.assertEqual(3, multicall_stats.multicall_size.sum)
+
+    def test_prometheus(self):
+        self.koji_session.getTaskInfo(1)
+        text = koji_util.koji_call_stats.to_prometheus(service='polling')
+        self.assertIn(
+            'koschei_koji_calls_total'
+            '{koji_id="primary",method="getTaskInfo",service="polling"} 1\n',
+            text,
+        )
+        self.assertIn(
+            'koschei_koji_call_duration_seconds_count'
+            '{koji_id="primary",method="getTaskInfo",service="polling"} 1\n',
+            text,
+        )
+        self.assertIn('# TYPE koschei_koji_call_duration_seconds histogram\n', text)
@@ -73,10 +73,16 @@ class KojiMock(object):
 
     def multiCall(self):
         self.__multicall = False
-        result = [
-            [getattr(self, method)(*args, **kwargs)]
-            for method, args, kwargs in self.__mcall_list
-        ]
+        result = []
+        for method, args, kwargs in self.__mcall_list:
+            try:
+                result.append([getattr(self, method)(*args, **kwargs)])
+            except Exception as e:
+                # Koji reports exceptions of individual calls as fault dicts
+                result.append({
+                    'faultCode': getattr(e, 'faultCode', 1),
+                    'faultString': getattr(e, 'faultString', str(e)),
+                })
         self.__mcall_list = []
         return result
 
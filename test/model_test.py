@@ -17,13 +17,14 @@
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
 from mock import patch
-from sqlalchemy import literal_column
+from sqlalchemy import inspect, literal_column
 from datetime import datetime, timedelta
 
 from koschei.models import (
     Package, Collection, Build, ResourceConsumptionStats, ScalarStats, KojiTask,
-    PackageGroup,
+    PackageGroup, BasePackage,
 )
+from koschei.db import PreparedStatement, SqlStats, normalize_sql
 from test.common import DBTest
 
 
@@ -155,6 +156,15 @@ class PackageStateStringTest(DBTest):
         self.verify_state_string('unknown', resolved=True,
                                  last_complete_build_state=None)
 
+    def test_state_string_compiled_once(self):
+        pkg = self.prepare_package(blocked=True)
+        self.assertEqual('blocked', pkg.state_string)
+        with patch('koschei.db.Evaluator.process') as process_mock:
+            pkg.blocked = False
+            pkg.tracked = False
+            self.assertEqual('untracked', pkg.state_string)
+            self.assertFalse(process_mock.called)
+
 
 @patch('sqlalchemy.sql.expression.func.clock_timestamp',
        return_value=literal_column("'2017-10-10 10:00:00'"))
@@ -270,10 +280,7 @@ class StatsTest(DBTest):
         rnv = self.prepare_build('rnv')
         self.add_task(rnv, 'x86_64', 123, 456)
         self.add_task(rnv, 'aarch64', 125, 666)
-        # Before refresh MV should be empty
-        self.assertEqual(0, self.db.query(ResourceConsumptionStats).count())
-        # After refresh it should contain some entries
-        self.db.refresh_materialized_view(ResourceConsumptionStats)
+        # Statistics are maintained by triggers, no refresh needed
         self.assertEqual(2, self.db.query(ResourceConsumptionStats).count())
         # Now add more data
         self.add_task(rnv, 'x86_64', 1000, 1100)
@@ -281,9 +288,12 @@ class StatsTest(DBTest):
         self.add_task(rnv, 'x86_64', 5000, None)
         self.add_task(self.prepare_build('xpp3'), 'x86_64', 111, 444)
         self.add_task(self.prepare_build('junit'), 'noarch', 24, 42)
-        # Until it's refreshed again, MV should still contain only 2 rows
-        self.assertEqual(2, self.db.query(ResourceConsumptionStats).count())
-        self.db.refresh_materialized_view(ResourceConsumptionStats)
+        self.assert_time_consumption()
+        # Full refresh gives the same results
+        self.db.refresh_materialized_view(ResourceConsumptionStats, ScalarStats)
+        self.assert_time_consumption()
+
+    def assert_time_consumption(self):
         self.assertEqual(4, self.db.query(ResourceConsumptionStats).count())
         stats = self.db.query(ResourceConsumptionStats).order_by(ResourceConsumptionStats.time).all()
         self.assertEqual('junit', stats[0].name)
@@ -303,6 +313,16 @@ class StatsTest(DBTest):
         self.assertEqual(timedelta(0, 333 + 100 + 500), stats[3].time)
         self.assertAlmostEqual(0.5112, stats[3].time_percentage, 4)
 
+    def test_time_consumption_task_finished(self):
+        rnv = self.prepare_build('rnv')
+        self.add_task(rnv, 'x86_64', 123, None)
+        task = self.db.query(KojiTask).one()
+        task.finished = datetime.fromtimestamp(456)
+        self.db.commit()
+        stats = self.db.query(ResourceConsumptionStats).one()
+        self.assertEqual(timedelta(0, 333), stats.time)
+        self.assertEqual(timedelta(0, 333), ScalarStats.current(self.db).total_time)
+
     def test_time_consumption_only_running(self):
         rnv = self.prepare_build('rnv')
         self.add_task(rnv, 'x86_64', 123, None)
@@ -339,3 +359,103 @@ class StatsTest(DBTest):
         self.assertEqual(16, stats.builds)
         self.assertEqual(7, stats.real_builds)
         self.assertEqual(9, stats.scratch_builds)
+
+
+class CopyRowsTest(DBTest):
+    def test_copy_rows(self):
+        self.db.execute("""
+            CREATE TEMPORARY TABLE copy_test (name VARCHAR, epoch INTEGER)
+        """)
+        rows = [('rnv', None), ('tab\there', 1), ('back\\slash\nnewline', 2)]
+        self.db.copy_rows('copy_test', ['name', 'epoch'], rows)
+        self.assertCountEqual(
+            rows,
+            [tuple(row) for row in self.db.execute("SELECT name, epoch FROM copy_test")],
+        )
+
+    def test_bulk_copy(self):
+        existing = self.prepare_package('rnv')
+        bases = [BasePackage(name='eclipse'), BasePackage(name='maven')]
+        self.db.bulk_copy(bases)
+        packages = [
+            Package(name=base.name, base_id=base.id, collection_id=self.collection.id,
+                    tracked=False, blocked=name == 'maven')
+            for name, base in zip(['eclipse', 'maven'], bases)
+        ]
+        self.db.bulk_copy(packages)
+        self.assertTrue(all(package.id for package in packages))
+        self.assertNotEqual(existing.id, packages[0].id)
+        # the session is not expired
+        self.assertFalse(inspect(existing).expired_attributes)
+        self.db.commit()
+        maven = self.db.query(Package).get(packages[1].id)
+        self.assertEqual('maven', maven.name)
+        self.assertTrue(maven.blocked)
+        self.assertFalse(maven.tracked)
+        self.assertEqual(bases[1].id, maven.base_id)
+
+
+class PreparedStatementTest(DBTest):
+    def test_parameters(self):
+        statement = PreparedStatement('test_parameters', """
+            SELECT * FROM package WHERE name = :name OR base_id::text = :name
+                AND collection_id = :collection_id
+        """)
+        self.assertEqual(['name', 'collection_id'], statement.params)
+        self.assertIn('base_id::text = $1', statement.sql)
+        self.assertIn('collection_id = $2', statement.sql)
+
+    def test_execute(self):
+        package = self.prepare_package('rnv')
+        statement = PreparedStatement('test_execute', """
+            SELECT * FROM package WHERE name = :name
+        """)
+        for _ in range(2):
+            # prepared statement survives the transaction
+            self.assertEqual(
+                [package.id],
+                [row.id for row in self.db.execute_prepared(statement, name='rnv')],
+            )
+            self.db.rollback()
+        self.assertIs(
+            package,
+            self.db.query(Package).from_prepared(statement, name='rnv').one(),
+        )
+        self.assertEqual(
+            3,
+            self.db.connection().info['prepared_statements']['test_execute'],
+        )
+
+
+class SqlStatsTest(DBTest):
+    def test_normalize(self):
+        self.assertEqual(
+            "SELECT * FROM package WHERE name = ? AND id IN (?, ...) LIMIT ?",
+            normalize_sql("""
+                SELECT * FROM package
+                    WHERE name = 'it''s' AND id IN (%(id_1)s, %(id_2)s) LIMIT 10
+            """),
+        )
+
+    def test_collect(self):
+        self.prepare_packages('rnv', 'eclipse')
+        stats = SqlStats()
+        with stats.collect():
+            for name in ('rnv', 'eclipse'):
+                self.db.query(Package).filter_by(name=name).one()
+        self.db.query(Package).all()
+        self.assertEqual(2, stats.statements)
+        self.assertEqual(2, stats.rows)
+        [(statement, count, _, rows)] = stats.top_statements(10)
+        self.assertIn("WHERE package.name = ?", statement)
+        self.assertEqual((2, 2), (count, rows))
+
+    def test_merge(self):
+        stats = SqlStats()
+        stats.record("SELECT 1", 0.5, 1)
+        other = SqlStats()
+        other.record("SELECT 2", 1.0, 1)
+        other.record("SELECT 3", 2.0, 0)
+        stats.merge(other)
+        self.assertEqual("statements=3, time=3.500s, rows=2", stats.summary())
+        self.assertEqual([("SELECT ?", 3, 3.5, 2)], stats.top_statements(1))
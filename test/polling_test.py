@@ -17,11 +17,15 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
-from mock import patch, call
+import time
 
-from test.common import DBTest, with_koji_cassette
+from datetime import date
+from mock import patch
+
+from test.common import DBTest, with_koji_cassette, with_config
+from koschei import partitions
 from koschei.models import Build
-from koschei.backend.services.polling import Polling
+from koschei.backend.services.polling import Polling, PollingTask
 
 
 class PollingTest(DBTest):
@@ -29,23 +33,23 @@ class PollingTest(DBTest):
     def test_poll_none(self):
         self.prepare_build('rnv', 'complete')
         self.prepare_build('eclipse', 'failed')
-        with patch('koschei.backend.update_build_state') as update_mock:
+        with patch('koschei.backend.update_build_states') as update_mock:
             polling = Polling(self.session)
             polling.poll_builds()
-            self.assertFalse(update_mock.called)
+            update_mock.assert_called_once_with(self.session, [])
 
     @with_koji_cassette
     def test_poll_multiple(self):
         rnv_build = self.prepare_build('rnv', 'running', task_id=26033406)
         eclipse_build = self.prepare_build('eclipse', 'running', task_id=26151873)
         self.prepare_build('maven', 'complete', task_id=26035462)
-        with patch('koschei.backend.update_build_state') as update_mock:
+        with patch('koschei.backend.update_build_states') as update_mock:
             polling = Polling(self.session)
             polling.poll_builds()
-            update_mock.assert_has_calls(
-                [call(self.session, rnv_build, 'CLOSED'),
-                 call(self.session, eclipse_build, 'CLOSED')],
-                any_order=True,
+            update_mock.assert_called_once()
+            self.assertCountEqual(
+                [(rnv_build, 'CLOSED'), (eclipse_build, 'CLOSED')],
+                update_mock.call_args[0][1],
             )
 
     @with_koji_cassette
@@ -64,3 +68,43 @@ class PollingTest(DBTest):
         build = self.db.query(Build).one()
         self.assertEqual(build.state, Build.FAILED)
         self.assertEqual(build.repo_id, 1344909)
+
+    @with_config('services.polling.tasks.stats.interval', None)
+    def test_tasks(self):
+        tasks = Polling(self.session).get_tasks()
+        self.assertEqual(
+            ['builds', 'packages', 'polling_event', 'latest_builds', 'stats_deltas',
+             'partitions'],
+            [task.name for task in tasks],
+        )
+
+    @with_config('services.polling.partition_months_ahead', 4)
+    def test_create_partitions(self):
+        Polling(self.session).create_partitions()
+        this_month = date.today().replace(day=1)
+        for table in ('build', 'resolution_problem'):
+            months = partitions.get_partition_months(self.db, table)
+            self.assertEqual(5, len([m for m in months if m >= this_month]))
+            self.assertIn(this_month, months)
+
+    def test_main(self):
+        polling = Polling(self.session)
+        called = []
+        for _, method in Polling.TASKS:
+            setattr(polling, method, lambda method=method: called.append(method))
+        tasks = polling.get_tasks()
+        with patch.object(Polling, 'get_tasks', return_value=tasks):
+            polling.main()
+        self.assertEqual([method for _, method in Polling.TASKS], called)
+        for task in tasks:
+            self.assertEqual(1, task.duration.count)
+            self.assertIsNotNone(task.last_duration)
+            self.assertIsNone(task.started)
+
+    def test_task_timeout(self):
+        task = PollingTask('builds', 'poll_builds', interval=60, timeout=10)
+        self.assertFalse(task.is_overdue())
+        task.started = time.time() - 5
+        self.assertFalse(task.is_overdue())
+        task.started = time.time() - 20
+        self.assertTrue(task.is_overdue())
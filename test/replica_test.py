@@ -0,0 +1,93 @@
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+
+from flask import g
+from mock import patch
+from sqlalchemy import create_engine
+
+from koschei.db import get_engine
+from koschei.frontend import app
+from koschei.frontend import base
+from koschei.frontend.base import db
+from test.frontend_common import FrontendTest
+
+
+class ReplicaTest(FrontendTest):
+    def setUp(self):
+        super(ReplicaTest, self).setUp()
+        # the test database is its own replica
+        self.replica = create_engine(get_engine().url)
+        patcher = patch('koschei.frontend.base.get_replica_engine',
+                        return_value=self.replica)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.replica.dispose)
+
+    def preprocess_request(self, path, method='GET'):
+        with app.test_request_context(path, method=method):
+            app.preprocess_request()
+            return g.db_replica, db.get_bind()
+
+    def test_get(self):
+        self.assertEqual((True, self.replica), self.preprocess_request('/'))
+
+    def test_api(self):
+        self.assertEqual(
+            (True, self.replica),
+            self.preprocess_request('/api/v1/packages'),
+        )
+
+    def test_post(self):
+        self.assertEqual(
+            (False, get_engine()),
+            self.preprocess_request('/build/1/cancel', method='POST'),
+        )
+
+    def test_login(self):
+        self.assertEqual((False, get_engine()), self.preprocess_request('/login'))
+
+    def test_page_content(self):
+        self.prepare_package('rnv')
+        reply = self.client.get('/package/rnv')
+        self.assertEqual(200, reply.status_code)
+        self.assertIn('rnv', reply.data.decode('utf-8'))
+
+    def test_primary_after_write(self):
+        with app.test_client() as client:
+            client.post('/build/1/cancel')
+            client.get('/')
+            self.assertFalse(g.db_replica)
+
+    def test_primary_after_login(self):
+        with app.test_client() as client:
+            client.get('/login')
+            client.get('/')
+            self.assertFalse(g.db_replica)
+
+    @patch('koschei.frontend.base.replica_failed_until', 0)
+    def test_unavailable(self):
+        self.replica = create_engine('postgresql:///koschei?host=/nonexistent')
+        with patch('koschei.frontend.base.get_replica_engine',
+                   return_value=self.replica):
+            self.assertEqual((False, get_engine()), self.preprocess_request('/'))
+            # not retried until retry interval elapses
+            self.assertGreater(base.replica_failed_until, time.time())
+
+    def test_lagging(self):
+        with patch('koschei.frontend.base.REPLICA_LAG_QUERY', 'SELECT 3600'):
+            self.assertEqual((False, get_engine()), self.preprocess_request('/'))
@@ -17,6 +17,8 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
+import os
+
 from unittest import skipIf
 
 import hawkey
@@ -25,10 +27,11 @@ from fedora_messaging.api import Message
 from contextlib import contextmanager
 from mock import Mock, patch
 
+from test import testdir
 from test.common import DBTest, RepoCacheMock, rpmvercmp
 from koschei import plugin
 from koschei.db import RpmEVR
-from koschei.backend import koji_util
+from koschei.backend import koji_util, repo_util
 from koschei.backend.services.repo_resolver import RepoResolver
 from koschei.backend.services.build_resolver import BuildResolver
 from koschei.models import (
@@ -420,6 +423,33 @@ class ResolverTest(DBTest):
         koji_mock.getRPMDeps.assert_called_once_with(inp, koji.DEP_REQUIRE)
         self.assertEqual(res, [['maven-local', 'jetty-toolchain']])
 
+    def test_buildrequires_from_repo(self):
+        res = repo_util.parse_srpm_requires(
+            os.path.join(testdir, 'data', 'srpm_primary.xml')
+        )
+        self.assertEqual(
+            {
+                ('foo', '4', '1.fc22'): ['A', 'F >= 1.2', 'C = 2:1-3.fc22', 'D < 5-1'],
+                ('bar', '2', '1.fc22'): [],
+            },
+            res,
+        )
+
+    def test_buildrequires_from_repo_fallback(self):
+        repo_requires = {('foo', '4', '1.fc22'): ['A', 'F']}
+        nvras = [
+            dict(name='bar', version='2', release='1.fc22', arch='src'),
+            dict(name='foo', version='4', release='1.fc22', arch='src'),
+        ]
+        koji_session = self.koji('secondary')
+        with patch('koschei.backend.koji_util.get_rpm_requires',
+                   return_value=[['B']]) as koji_mock:
+            res = koji_util.get_rpm_requires_from_repo(
+                self.session, koji_session, repo_requires, nvras,
+            )
+            koji_mock.assert_called_once_with(koji_session, (nvras[0],))
+        self.assertEqual([['B'], ['A', 'F']], res)
+
     def test_virtual_file_provides(self):
         with self.mocks():
             sack = get_sack()
@@ -20,10 +20,15 @@ from mock import Mock, patch
 from sqlalchemy import literal_column
 from datetime import datetime
 
-from test.common import DBTest, with_koji_cassette
+from test.common import DBTest, with_koji_cassette, with_config
 from koschei.models import Build, Package
 from koschei.backend.services.scheduler import Scheduler
 
+SRPM_RES = (
+    {'epoch': None, 'version': '1', 'release': '1.fc29'},
+    'packages/foo/1/1.fc29/src/foo-1-1.fc29.src.rpm',
+)
+
 
 # pylint:disable = too-many-public-methods, unbalanced-tuple-unpacking
 class SchedulerTest(DBTest):
@@ -73,11 +78,22 @@ class SchedulerTest(DBTest):
                 self.task_id_counter += 1
         self.db.commit()
 
-    def assert_scheduled(self, scheduled, koji_load=0.3):
+    def run_scheduler(self, koji_load=0.3, missing_srpms=()):
+        def get_last_srpms(_koji_session, _tag, names, **_kwargs):
+            return [
+                None if name in missing_srpms else SRPM_RES for name in names
+            ]
+
         with patch('koschei.backend.koji_util.get_koji_load',
                    Mock(return_value=koji_load)), \
              patch('koschei.backend.koji_util.get_srpm_arches',
                    Mock(return_value=['x86_64'])), \
+             patch('koschei.backend.koji_util.get_srpm_arch_headers_cached',
+                   Mock(side_effect=lambda _s, _k, nvras: [{}] * len(nvras))), \
+             patch('koschei.backend.koji_util.get_last_srpms',
+                   Mock(side_effect=get_last_srpms)), \
+             patch('koschei.backend.koji_util.get_koji_load_snapshot_cached',
+                   Mock(return_value={'arches': {}})), \
              patch('koschei.backend.koji_util.get_koji_arches_cached',
                    Mock(return_value=['x86_64'])):
             sched = self.get_scheduler()
@@ -85,12 +101,102 @@ class SchedulerTest(DBTest):
                        return_value=literal_column("'2017-10-10 10:50:00'")):
                 with patch('koschei.backend.submit_build') as submit_mock:
                     sched.main()
-                    if scheduled:
-                        pkg = self.db.query(Package).filter_by(name=scheduled).one()
-                        submit_mock.assert_called_once_with(self.session, pkg,
-                                                            arch_override=['x86_64'])
-                    else:
-                        self.assertFalse(submit_mock.called)
+                    return submit_mock
+
+    def assert_scheduled(self, scheduled, koji_load=0.3):
+        submit_mock = self.run_scheduler(koji_load)
+        if scheduled:
+            pkg = self.db.query(Package).filter_by(name=scheduled).one()
+            submit_mock.assert_called_once_with(self.session, pkg,
+                                                arch_override=['x86_64'],
+                                                srpm_res=SRPM_RES)
+        else:
+            self.assertFalse(submit_mock.called)
+
+    def get_priority_order(self):
+        with patch('sqlalchemy.sql.expression.func.clock_timestamp',
+                   return_value=literal_column("'2017-10-10 10:50:00'")):
+            return [
+                self.db.query(Package).get(package_id).name
+                for package_id, _ in self.get_scheduler().get_priorities()
+            ]
+
+    def test_priority_order(self):
+        self.prepare_priorities(rnv=300, eclipse=280, expat=270, maven=10)
+        self.assertEqual(
+            ['rnv', 'eclipse', 'expat', 'maven'],
+            self.get_priority_order(),
+        )
+
+    @with_config('priorities.scheduler_candidates', 1)
+    def test_priority_order_candidates_exhausted(self):
+        # bound (300) is above threshold, all priorities need to be computed
+        self.prepare_priorities(rnv=300, eclipse=280, expat=270, maven=10)
+        self.assertEqual(
+            ['rnv', 'eclipse', 'expat', 'maven'],
+            self.get_priority_order(),
+        )
+
+    @with_config('priorities.scheduler_candidates', 1)
+    def test_priority_order_bound_below_threshold(self):
+        # bound (100) is below threshold, other packages don't need to be considered
+        self.prepare_priorities(rnv=100, eclipse=50)
+        self.assertEqual(['rnv'], self.get_priority_order())
+
+    @with_config('services.scheduler.batch', True)
+    def test_batch(self):
+        # max_builds is 2
+        self.prepare_priorities(eclipse=280, rnv=300, expat=270, maven=10)
+        submit_mock = self.run_scheduler()
+        self.assertEqual(
+            ['rnv', 'eclipse'],
+            [call[0][1].name for call in submit_mock.call_args_list],
+        )
+
+    @with_config('services.scheduler.batch', True)
+    def test_batch_running(self):
+        self.prepare_priorities(eclipse=280, rnv=300, rnv_build=Build.RUNNING,
+                                expat=270)
+        submit_mock = self.run_scheduler()
+        self.assertEqual(
+            ['eclipse'],
+            [call[0][1].name for call in submit_mock.call_args_list],
+        )
+
+    @with_config('services.scheduler.batch', True)
+    def test_batch_missing_srpm(self):
+        self.prepare_priorities(eclipse=280, rnv=300, expat=270)
+        submit_mock = self.run_scheduler(missing_srpms=['rnv'])
+        self.assertEqual(
+            ['eclipse', 'expat'],
+            [call[0][1].name for call in submit_mock.call_args_list],
+        )
+        rnv = self.db.query(Package).filter_by(name='rnv').one()
+        self.assertEqual(Package.SKIPPED_NO_SRPM, rnv.scheduler_skip_reason)
+
+    def test_prefetch_window(self):
+        self.prepare_priorities(eclipse=280, rnv=300, expat=270, maven=10)
+        with patch('koschei.backend.koji_util.get_last_srpms',
+                   Mock(side_effect=lambda _k, _t, names, **_: [None] * len(names))) \
+                as get_last_srpms_mock, \
+                patch('koschei.backend.koji_util.get_srpm_arch_headers_cached',
+                      Mock(side_effect=lambda _s, _k, nvras: [{}] * len(nvras))), \
+                patch('sqlalchemy.sql.expression.func.clock_timestamp',
+                      return_value=literal_column("'2017-10-10 10:50:00'")):
+            candidates = [
+                (package.name, srpm_res)
+                for package, _, srpm_res, _ in
+                self.get_scheduler().get_prefetched_candidates(2)
+            ]
+        self.assertEqual(
+            [('rnv', None), ('eclipse', None), ('expat', None), ('maven', None)],
+            candidates,
+        )
+        # maven is below the threshold and is not prefetched
+        self.assertEqual(
+            [['rnv', 'eclipse'], ['expat']],
+            [call[0][2] for call in get_last_srpms_mock.call_args_list],
+        )
 
     def test_low(self):
         self.prepare_priorities(rnv=10)
@@ -0,0 +1,78 @@
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from datetime import datetime, timedelta
+
+from test.common import DBTest, with_config
+from koschei.models import Build
+from koschei.backend.simulator import Simulator
+
+T = datetime(2017, 10, 10, 12, 0)
+
+
+class SimulatorTest(DBTest):
+    def prepare_history(self):
+        rnv = self.prepare_package('rnv', resolved=True)
+        self.prepare_timed_build(rnv, T - timedelta(hours=36))
+        eclipse = self.prepare_package('eclipse', resolved=True)
+        # dependency change observed by a build in the replayed window
+        build = self.prepare_timed_build(eclipse, T - timedelta(hours=12))
+        self.prepare_depchange('maven', None, '1', '1', None, '2', '1',
+                               build_id=build.id, distance=1)
+        self.prepare_timed_build(eclipse, T)
+
+    def prepare_timed_build(self, package, started):
+        build = self.prepare_build(package, 'complete', started=started)
+        task = self.prepare_task(build, started=started)
+        task.finished = started + timedelta(hours=1)
+        self.db.commit()
+        return build
+
+    def get_simulator(self):
+        return Simulator(self.session, window=timedelta(days=1),
+                         tick=timedelta(minutes=10))
+
+    @with_config('priorities.package_update', 256)
+    def test_dependency_change(self):
+        self.prepare_history()
+        result = self.get_simulator().run()
+        self.assertEqual(1, result.submitted)
+        self.assertEqual(1, result.completed)
+        self.assertEqual(0, result.wasted)
+        self.assertEqual([timedelta(0)], result.latencies)
+        self.assertEqual(0, result.pending)
+        # simulation is rolled back
+        self.assertEqual(3, self.db.query(Build).count())
+
+    @with_config('priorities.package_update', 256)
+    def test_overrides(self):
+        self.prepare_history()
+        simulator = self.get_simulator()
+        result = simulator.run('low threshold', {'priorities.build_threshold': 100})
+        self.assertEqual(2, result.submitted)
+        self.assertEqual(1, result.wasted)
+        self.assertEqual(1, len(result.latencies))
+        self.assertEqual(3, self.db.query(Build).count())
+        # configuration is restored
+        self.assertEqual(1, simulator.run().submitted)
+
+    def test_no_changes(self):
+        self.prepare_history()
+        result = self.get_simulator().run()
+        self.assertEqual(0, result.submitted)
+        self.assertEqual(1, result.pending)
+        self.assertIsNone(result.latency_percentile(50))
+        self.assertIn('wasted builds: 0', result.format())
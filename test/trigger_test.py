@@ -16,8 +16,12 @@
 #
 # Author: Michael Simacek <msimacek@redhat.com>
 
+from datetime import datetime
+
 from test.common import DBTest
-from koschei.models import Build
+from koschei.models import (
+    BasePackage, Build, Package, ScalarStats, ScalarStatsDelta,
+)
 
 
 # pylint:disable = unbalanced-tuple-unpacking
@@ -95,6 +99,82 @@ class TriggerTest(DBTest):
         self.db.commit()
         self.assertEqual(b2.id, e.last_build_id)
 
+    def bulk_builds(self, *package_states):
+        builds = [
+            Build(package_id=package.id, state=state, version='1', release='1.fc25',
+                  repo_id=1, task_id=1000 + i, deps_resolved=True,
+                  started=datetime.fromtimestamp(1000 + i),
+                  real=False, untagged=False)
+            for i, (package, state) in enumerate(package_states)
+        ]
+        self.db.bulk_insert(builds)
+        self.db.commit()
+        return [self.db.query(Build).get(build.id) for build in builds]
+
+    def test_insert_multiple(self):
+        [p, e, m] = self.prepare_packages('rnv', 'eclipse', 'maven')
+        [bp1, bp2, be1, be2] = self.bulk_builds(
+            (p, Build.FAILED),
+            (p, Build.COMPLETE),
+            (e, Build.COMPLETE),
+            (e, Build.RUNNING),
+        )
+        self.assertEqual(bp2.id, p.last_build_id)
+        self.assertEqual(bp2.id, p.last_complete_build_id)
+        self.assertEqual(Build.COMPLETE, p.last_complete_build_state)
+        self.assertEqual(be2.id, e.last_build_id)
+        self.assertEqual(be1.id, e.last_complete_build_id)
+        self.assertEqual(Build.COMPLETE, e.last_complete_build_state)
+        self.assertIsNone(m.last_build_id)
+        self.assertEqual(
+            [False, True, True, False],
+            [b.last_complete for b in (bp1, bp2, be1, be2)],
+        )
+
+    def test_update_multiple(self):
+        [p, e] = self.prepare_packages('rnv', 'eclipse')
+        bp1 = self.prepare_build('rnv', True)
+        bp2 = self.prepare_build('rnv', None)
+        be = self.prepare_build('eclipse', None)
+        self.db.query(Build)\
+            .filter(Build.id.in_([bp2.id, be.id]))\
+            .update({'state': Build.FAILED}, synchronize_session=False)
+        self.db.commit()
+        self.assertEqual(bp2.id, p.last_complete_build_id)
+        self.assertEqual(Build.FAILED, p.last_complete_build_state)
+        self.assertFalse(bp1.last_complete)
+        self.assertTrue(bp2.last_complete)
+        self.assertEqual(be.id, e.last_complete_build_id)
+        self.assertTrue(be.last_complete)
+
+    def test_untag(self):
+        [p] = self.prepare_packages('rnv')
+        b1 = self.prepare_build('rnv', True)
+        b2 = self.prepare_build('rnv', False)
+        b2.untagged = True
+        self.db.commit()
+        self.assertEqual(b1.id, p.last_build_id)
+        self.assertEqual(b1.id, p.last_complete_build_id)
+        self.assertTrue(b1.last_complete)
+        self.assertFalse(b2.last_complete)
+
+    def test_delete_multiple(self):
+        [p, e] = self.prepare_packages('rnv', 'eclipse')
+        bp1 = self.prepare_build('rnv', True)
+        bp2 = self.prepare_build('rnv', False)
+        be1 = self.prepare_build('eclipse', False)
+        be2 = self.prepare_build('eclipse', True)
+        self.db.query(Build)\
+            .filter(Build.id.in_([bp2.id, be1.id, be2.id]))\
+            .delete(synchronize_session=False)
+        self.db.commit()
+        self.assertEqual(bp1.id, p.last_build_id)
+        self.assertEqual(bp1.id, p.last_complete_build_id)
+        self.assertTrue(bp1.last_complete)
+        self.assertIsNone(e.last_build_id)
+        self.assertIsNone(e.last_complete_build_id)
+        self.assertIsNone(e.last_complete_build_state)
+
     def test_all_blocked_insert(self):
         [p, e] = self.prepare_packages('rnv', 'eclipse')
         self.assertFalse(p.base.all_blocked)
@@ -105,3 +185,128 @@ class TriggerTest(DBTest):
         e.blocked = True
         self.db.commit()
         self.assertTrue(e.base.all_blocked)
+
+    def test_all_blocked_multiple_collections(self):
+        collection = self.prepare_collection(
+            name="new", display_name="New",
+            target="foo", dest_tag="tag2", build_tag="build_tag2",
+        )
+        [p1] = self.prepare_packages('rnv')
+        p2 = self.prepare_package('rnv', collection=collection)
+        p1.blocked = True
+        self.db.commit()
+        self.assertFalse(p1.base.all_blocked)
+        self.db.delete(p2)
+        self.db.commit()
+        self.assertTrue(p1.base.all_blocked)
+
+    def test_all_blocked_only_affected(self):
+        [p] = self.prepare_packages('rnv')
+        # deliberately inconsistent, must not be touched by changes of other bases
+        p.base.all_blocked = True
+        bases = [BasePackage(name=name) for name in ('eclipse', 'maven')]
+        self.db.add_all(bases)
+        self.db.commit()
+        self.db.bulk_insert([
+            Package(name=base.name, base_id=base.id, collection_id=self.collection.id,
+                    blocked=blocked, tracked=True)
+            for base, blocked in zip(bases, (True, False))
+        ])
+        self.db.commit()
+        self.assertEqual(
+            [True, True, False],
+            [b.all_blocked for b in [p.base] + bases],
+        )
+
+    def test_precomputed_priority(self):
+        p = self.prepare_package('rnv', resolved=True, static_priority=10,
+                                 manual_priority=20, dependency_priority=30,
+                                 build_priority=40)
+        self.assertIsNone(p.precomputed_priority)
+        self.prepare_build('rnv', True)
+        self.assertEqual(100, p.precomputed_priority)
+        self.collection.priority_coefficient = 0.5
+        self.db.commit()
+        self.assertEqual(65, p.precomputed_priority)
+        p.dependency_priority = 0
+        self.db.commit()
+        self.assertEqual(50, p.precomputed_priority)
+
+    def test_precomputed_priority_only_build_running(self):
+        p = self.prepare_package('rnv', resolved=True, static_priority=10)
+        self.prepare_build('rnv', None)
+        self.assertIsNone(p.last_complete_build_id)
+        self.assertIsNone(p.precomputed_priority)
+
+    def test_precomputed_priority_unschedulable(self):
+        p = self.prepare_package('rnv', resolved=True)
+        self.prepare_build('rnv', True)
+        self.assertEqual(0, p.precomputed_priority)
+        b = self.prepare_build('rnv', None)
+        self.assertIsNone(p.precomputed_priority)
+        b.state = Build.COMPLETE
+        self.db.commit()
+        self.assertEqual(0, p.precomputed_priority)
+        p.resolved = False
+        self.db.commit()
+        self.assertIsNone(p.precomputed_priority)
+        p.resolved = True
+        p.blocked = True
+        self.db.commit()
+        self.assertIsNone(p.precomputed_priority)
+
+    def get_stats(self):
+        return ScalarStats.current(self.db)
+
+    def test_stats_packages(self):
+        [p, e, _] = self.prepare_packages('rnv', 'eclipse', 'maven')
+        self.assertEqual(3, self.get_stats().packages)
+        self.assertEqual(3, self.get_stats().tracked_packages)
+        p.tracked = False
+        e.blocked = True
+        self.db.commit()
+        self.assertEqual(2, self.get_stats().tracked_packages)
+        self.assertEqual(1, self.get_stats().blocked_packages)
+        self.db.delete(e)
+        self.db.commit()
+        self.assertEqual(2, self.get_stats().packages)
+        self.assertEqual(0, self.get_stats().blocked_packages)
+
+    def test_stats_builds(self):
+        self.prepare_build('rnv', True)
+        b = self.prepare_build('rnv', None)
+        self.assertEqual(2, self.get_stats().builds)
+        self.assertEqual(2, self.get_stats().scratch_builds)
+        b.real = True
+        self.db.commit()
+        self.assertEqual(1, self.get_stats().real_builds)
+        self.assertEqual(1, self.get_stats().scratch_builds)
+        self.db.delete(b)
+        self.db.commit()
+        self.assertEqual(1, self.get_stats().builds)
+        self.assertEqual(0, self.get_stats().real_builds)
+
+    def test_stats_refresh_folds_deltas(self):
+        self.prepare_packages('rnv', 'eclipse')
+        self.prepare_build('rnv', True)
+        self.assertEqual(0, self.db.query(ScalarStats).one().packages)
+        self.assertLess(0, self.db.query(ScalarStatsDelta).count())
+        self.db.refresh_materialized_view(ScalarStats)
+        self.db.commit()
+        self.assertEqual(0, self.db.query(ScalarStatsDelta).count())
+        stats = self.db.query(ScalarStats).one()
+        self.assertEqual((2, 1), (stats.packages, stats.builds))
+        self.assertEqual(2, self.get_stats().packages)
+
+    def test_stats_fold_deltas(self):
+        self.prepare_packages('rnv', 'eclipse')
+        self.prepare_build('rnv', True)
+        ScalarStats.fold_deltas(self.db)
+        self.db.commit()
+        self.assertEqual(0, self.db.query(ScalarStatsDelta).count())
+        stats = self.db.query(ScalarStats).one()
+        self.assertEqual((2, 1), (stats.packages, stats.builds))
+        self.assertEqual(2, self.get_stats().packages)
+        # nothing to fold
+        ScalarStats.fold_deltas(self.db)
+        self.assertEqual(2, self.db.query(ScalarStats).one().packages)
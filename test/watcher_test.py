@@ -18,7 +18,7 @@
 
 from mock import patch
 
-from test.common import DBTest, service_ctor, with_koji_cassette
+from test.common import DBTest, service_ctor, with_koji_cassette, with_config
 
 test_topic = 'org.fedoraproject.test.buildsys'
 
@@ -37,6 +37,22 @@ def generate_state_change(instance='primary', task_id=666, old='OPEN', new='CLOS
     }
 
 
+def generate_tag(build_id=1046486, tag='f29', release='15.fc28'):
+    return {
+        'msg': {
+            "build_id": build_id,
+            "name": "rnv",
+            "tag_id": 3418,
+            "instance": "primary",
+            "tag": tag,
+            "user": "mohanboddu",
+            "version": "1.7.11",
+            "owner": "msimacek",
+            "release": release,
+        }
+    }
+
+
 class WatcherTest(DBTest):
     def test_ignored_topic(self):
         topic = 'org.fedoraproject.prod.buildsys.task.state.change'
@@ -56,6 +72,26 @@ class WatcherTest(DBTest):
             Watcher(self.session).consume(topic, msg)
             update_mock.assert_called_once_with(self.session, build, 'CLOSED')
 
+    @with_config('services.watcher.batch_window', 60)
+    @with_config('services.watcher.batch_size', 2)
+    def test_batched_task_completed(self):
+        topic = test_topic + '.task.state.change'
+        _, build = self.prepare_basic_data()
+        self.prepare_build('eclipse', 'complete', task_id=667)
+        watcher = Watcher(self.session)
+        with patch('koschei.backend.update_build_state') as update_mock:
+            watcher.consume(topic, generate_state_change(old='FREE', new='OPEN'))
+            watcher.consume(topic, generate_state_change(old='OPEN', new='CLOSED'))
+            watcher.consume(topic, generate_state_change(task_id=667))
+            self.assertFalse(update_mock.called)
+        # the batch is full, doesn't wait for the window
+        states = watcher.batch.take()
+        self.assertEqual({666: 'CLOSED', 667: 'CLOSED'}, states)
+        with patch('koschei.backend.update_build_states') as update_mock:
+            watcher.update_build_states(self.session, states)
+            # only running builds are updated
+            update_mock.assert_called_once_with(self.session, [(build, 'CLOSED')])
+
     @with_koji_cassette
     def test_real_build(self):
         collection = self.prepare_collection('f29')
@@ -64,23 +100,45 @@ class WatcherTest(DBTest):
             package, 'failed', version='1.7.11', release='14.fc28',
             task_id=25038558, started='2018-02-14 11:16:55',
         )
-        msg = {
-            'msg': {
-                "build_id": 1046486,
-                "name": "rnv",
-                "tag_id": 3418,
-                "instance": "primary",
-                "tag": "f29",
-                "user": "mohanboddu",
-                "version": "1.7.11",
-                "owner": "msimacek",
-                "release": "15.fc28"
-            }
-        }
         topic = test_topic + '.tag'
-        Watcher(self.session).consume(topic, msg)
+        Watcher(self.session).consume(topic, generate_tag())
         self.assertEqual('ok', package.state_string)
         self.assertIsNot(build, package.last_complete_build)
         self.assertEqual(859626, package.last_complete_build.repo_id)
         self.assertEqual(25162638, package.last_complete_build.task_id)
         self.assertEqual(7, len(package.last_complete_build.build_arch_tasks))
+
+    @with_koji_cassette('WatcherTest/test_real_build')
+    def test_real_build_unrelated_tag(self):
+        collection = self.prepare_collection('f29')
+        self.prepare_package('rnv', collection=collection)
+        topic = test_topic + '.tag'
+        with patch('koschei.backend.register_real_builds') as register_mock:
+            Watcher(self.session).consume(topic, generate_tag(tag='f29-signing-pending'))
+            self.assertFalse(register_mock.called)
+
+    @with_koji_cassette('WatcherTest/test_real_build')
+    def test_real_build_not_newer(self):
+        collection = self.prepare_collection('f29')
+        package = self.prepare_package('rnv', collection=collection)
+        self.prepare_build(package, 'complete', version='1.7.11', release='15.fc28')
+        topic = test_topic + '.tag'
+        with patch('koschei.backend.register_real_builds') as register_mock:
+            Watcher(self.session).consume(topic, generate_tag())
+            # decided from the message, without querying the build
+            self.assertFalse(register_mock.called)
+
+    @with_config('services.watcher.batch_window', 60)
+    @with_config('services.watcher.batch_size', 2)
+    def test_batched_real_build(self):
+        topic = test_topic + '.tag'
+        watcher = Watcher(self.session)
+        with patch.object(watcher, 'register_real_builds') as register_mock:
+            watcher.consume(topic, generate_tag(release='14.fc28'))
+            watcher.consume(topic, generate_tag())
+            watcher.consume(topic, generate_tag(build_id=1046487, release='16.fc28'))
+            self.assertFalse(register_mock.called)
+        # the batch is full, doesn't wait for the window
+        msgs = watcher.tag_batch.take()
+        self.assertEqual([(1046486, 'f29'), (1046487, 'f29')], list(msgs.keys()))
+        self.assertEqual('15.fc28', msgs[(1046486, 'f29')]['release'])
@@ -21,6 +21,9 @@ import re
 from textwrap import dedent
 from urllib.parse import urlparse, parse_qs
 
+from mock import patch
+
+from koschei.frontend.base import frontend_config
 from koschei.models import PackageGroup
 from test.common import my_vcr
 from test.frontend_common import FrontendTest, authenticate, authenticate_admin
@@ -50,6 +53,15 @@ class WebTest(FrontendTest):
         self.assertIn('Packages from 1 to 0 from total 0', normalized_data)
         self.assertIn('Package summary', normalized_data)
 
+    @patch.dict(frontend_config['sql_stats'], header=True)
+    def test_sql_stats_header(self):
+        reply = self.client.get('/')
+        self.assertEqual(200, reply.status_code)
+        self.assertRegex(
+            reply.headers['X-Koschei-SQL-Stats'],
+            r'^statements=[1-9]\d*, time=\d+\.\d{3}s, rows=\d+$',
+        )
+
     def test_package_detail(self):
         rnv = self.prepare_package('rnv')
         build = self.prepare_build(rnv, 'complete')
@@ -1,96 +1,357 @@
 -- trigger functions
-CREATE OR REPLACE FUNCTION update_last_build(pkg_id integer)
+-- recomputes last builds of given packages, in a few set-based statements
+CREATE OR REPLACE FUNCTION update_last_builds(pkg_ids integer[])
     RETURNS void AS $$
-DECLARE pkg record;
-        lb record;
-        lcb record;
 BEGIN
-    SELECT INTO pkg * FROM package WHERE id = pkg_id;
-    SELECT INTO lb * FROM build
-        WHERE package_id = pkg_id
-          AND NOT untagged
-        ORDER BY started DESC
-        LIMIT 1;
-    IF lb.state = 2 THEN
-        SELECT INTO lcb * FROM build
-            WHERE package_id = pkg_id
-              AND (state = 3 OR state = 5)
-              AND NOT untagged
-            ORDER BY started DESC
-            LIMIT 1;
-    ELSE
-        lcb := lb;
-    END IF;
-    IF pkg.last_build_id IS DISTINCT FROM lb.id THEN
-        UPDATE package
-            SET last_build_id = lb.id
-            WHERE package.id = pkg_id;
+    IF cardinality(pkg_ids) = 0 THEN
+        RETURN;
     END IF;
-    IF pkg.last_complete_build_id IS DISTINCT FROM lcb.id THEN
+    WITH new AS (
+        SELECT package.id AS package_id,
+               lb.id AS last_build_id,
+               CASE WHEN lb.state = 2 THEN lcb.id ELSE lb.id END
+                   AS last_complete_build_id,
+               CASE WHEN lb.state = 2 THEN lcb.state ELSE lb.state END
+                   AS last_complete_build_state,
+               package.last_complete_build_id IS DISTINCT FROM
+                   CASE WHEN lb.state = 2 THEN lcb.id ELSE lb.id END
+                   AS last_complete_changed
+            FROM package
+                 LEFT JOIN LATERAL (
+                    SELECT id, state FROM build
+                        WHERE package_id = package.id
+                          AND NOT untagged
+                        ORDER BY started DESC
+                        LIMIT 1
+                 ) AS lb ON TRUE
+                 LEFT JOIN LATERAL (
+                    SELECT id, state FROM build
+                        WHERE package_id = package.id
+                          AND (state = 3 OR state = 5)
+                          AND NOT untagged
+                        ORDER BY started DESC
+                        LIMIT 1
+                 ) AS lcb ON lb.state = 2
+            WHERE package.id = ANY(pkg_ids)
+    ), updated AS (
         UPDATE package
-            SET last_complete_build_id = lcb.id,
-                last_complete_build_state = lcb.state
-            WHERE id = pkg_id;
-        UPDATE build
-            SET last_complete = FALSE
-            WHERE last_complete AND package_id = pkg_id;
-        UPDATE build
-            SET last_complete = TRUE
-            WHERE id = lcb.id;
-    END IF;
+            SET last_build_id = new.last_build_id,
+                last_complete_build_id = new.last_complete_build_id,
+                last_complete_build_state = CASE WHEN new.last_complete_changed
+                    THEN new.last_complete_build_state
+                    ELSE package.last_complete_build_state
+                END
+            FROM new
+            WHERE package.id = new.package_id
+              AND (package.last_build_id IS DISTINCT FROM new.last_build_id
+                   OR new.last_complete_changed)
+            RETURNING new.package_id, new.last_complete_build_id,
+                      new.last_complete_changed
+    )
+    UPDATE build
+        SET last_complete = build.id IS NOT DISTINCT FROM
+                            updated.last_complete_build_id
+        FROM updated
+        WHERE updated.last_complete_changed
+          AND build.package_id = updated.package_id
+          AND (build.last_complete OR build.id = updated.last_complete_build_id);
 END $$ LANGUAGE plpgsql;
 
+-- insert, update and delete triggers on build are statement-level, changed_rows
+-- contains the inserted or deleted rows, old_rows and new_rows the updated rows
 CREATE OR REPLACE FUNCTION update_last_build_trigger()
     RETURNS TRIGGER AS $$
 BEGIN
-    PERFORM update_last_build(NEW.package_id);
-    RETURN NEW;
+    PERFORM update_last_builds(ARRAY(
+        SELECT DISTINCT package_id FROM changed_rows
+    ));
+    RETURN NULL;
 END $$ LANGUAGE plpgsql;
 
-CREATE OR REPLACE FUNCTION update_last_build_del()
+CREATE OR REPLACE FUNCTION update_last_build_up()
     RETURNS TRIGGER AS $$
 BEGIN
-    -- try to avoid running more queries than necessary
-    -- there's a SET NULL trigger, so if this was the last build then last_build is null
-    IF EXISTS (
-            SELECT 1 FROM package
-                WHERE id = OLD.package_id
-                  AND last_build_id IS NULL
-    ) THEN
-        PERFORM update_last_build(OLD.package_id);
-    END IF;
-    RETURN OLD;
+    -- transition tables cannot be used together with column list or WHEN
+    -- condition. Updates of last_complete made by update_last_builds itself end
+    -- up here as well, with no changed rows
+    PERFORM update_last_builds(ARRAY(
+        SELECT DISTINCT new_rows.package_id
+            FROM new_rows JOIN old_rows ON old_rows.id = new_rows.id
+            WHERE old_rows.state != new_rows.state
+               OR old_rows.untagged != new_rows.untagged
+    ));
+    RETURN NULL;
 END $$ LANGUAGE plpgsql;
 
-CREATE OR REPLACE FUNCTION update_all_blocked()
+CREATE OR REPLACE FUNCTION update_last_build_del()
     RETURNS TRIGGER AS $$
 BEGIN
+    -- package has no foreign keys to build (it's partitioned), so the package
+    -- needs to be updated only if it still points to a deleted build
+    PERFORM update_last_builds(ARRAY(
+        SELECT DISTINCT package.id
+            FROM package JOIN changed_rows ON changed_rows.package_id = package.id
+            WHERE package.last_build_id = changed_rows.id
+               OR package.last_complete_build_id = changed_rows.id
+    ));
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- recomputes all_blocked of given base packages
+CREATE OR REPLACE FUNCTION update_base_all_blocked(base_ids integer[])
+    RETURNS void AS $$
+BEGIN
+    IF cardinality(base_ids) = 0 THEN
+        RETURN;
+    END IF;
     UPDATE base_package
     SET all_blocked = q.all_blocked
     FROM (SELECT base_id, BOOL_AND(blocked) AS all_blocked
           FROM package
+          WHERE base_id = ANY(base_ids)
           GROUP BY base_id) AS q
     WHERE id = q.base_id
         AND base_package.all_blocked IS DISTINCT FROM q.all_blocked;
+END $$ LANGUAGE plpgsql;
+
+-- insert and delete triggers are statement-level, changed_rows contains the
+-- inserted or deleted rows
+CREATE OR REPLACE FUNCTION update_all_blocked()
+    RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM update_base_all_blocked(ARRAY(
+        SELECT DISTINCT base_id FROM changed_rows
+    ));
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- update trigger is row-level, transition tables cannot be used together with
+-- column list and package is updated often, mostly without changing blocked
+CREATE OR REPLACE FUNCTION update_all_blocked_up()
+    RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM update_base_all_blocked(ARRAY[OLD.base_id, NEW.base_id]);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_precomputed_priority()
+    RETURNS TRIGGER AS $$
+BEGIN
+    -- keep in sync with Package.current_priority_expression
+    IF NEW.blocked OR NOT NEW.tracked
+            OR NEW.last_build_id IS NULL
+            OR NEW.last_complete_build_id IS DISTINCT FROM NEW.last_build_id
+            OR NEW.resolved = FALSE
+            OR (NEW.resolved IS NULL AND NOT NEW.skip_resolution) THEN
+        NEW.precomputed_priority := NULL;
+    ELSE
+        NEW.precomputed_priority := NEW.manual_priority + NEW.static_priority +
+            (NEW.dependency_priority + NEW.build_priority) *
+            (SELECT priority_coefficient FROM collection
+                WHERE id = NEW.collection_id);
+    END IF;
+    RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_collection_precomputed_priority()
+    RETURNS TRIGGER AS $$
+BEGIN
+    -- no-op update, makes update_precomputed_priority_trigger use the new coefficient
+    UPDATE package
+        SET collection_id = collection_id
+        WHERE collection_id = NEW.id;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- incrementally maintained statistics (ScalarStats, ResourceConsumptionStats)
+-- counters are not updated in place, the triggers append changes to
+-- scalar_stats_delta, which is folded in on read and by full refresh. Updating
+-- the single scalar_stats row would serialize all writing transactions
+-- insert and delete triggers are statement-level, changed_rows contains the
+-- inserted or deleted rows
+CREATE OR REPLACE FUNCTION update_package_stats()
+    RETURNS TRIGGER AS $$
+DECLARE sign integer := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    INSERT INTO scalar_stats_delta (packages, tracked_packages, blocked_packages)
+        SELECT sign * count(*),
+               sign * count(*) FILTER (WHERE tracked),
+               sign * count(*) FILTER (WHERE blocked)
+            FROM changed_rows
+            HAVING count(*) > 0;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_package_stats_up()
+    RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO scalar_stats_delta (tracked_packages, blocked_packages)
+        VALUES (NEW.tracked::int - OLD.tracked::int,
+                NEW.blocked::int - OLD.blocked::int);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_build_stats()
+    RETURNS TRIGGER AS $$
+DECLARE sign integer := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    INSERT INTO scalar_stats_delta (builds, real_builds, scratch_builds)
+        SELECT sign * count(*),
+               sign * count(*) FILTER (WHERE real),
+               sign * count(*) FILTER (WHERE NOT real)
+            FROM changed_rows
+            HAVING count(*) > 0;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_build_stats_up()
+    RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO scalar_stats_delta (real_builds, scratch_builds)
+        VALUES (NEW.real::int - OLD.real::int, OLD.real::int - NEW.real::int);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- time of deleted tasks is not subtracted, it's dropped by the periodic full
+-- refresh. Tasks are deleted only together with their builds, which are not
+-- visible to the trigger anymore
+-- resource_consumption_stats rows are upserted in (name, arch) order, so that
+-- concurrent statements lock them in the same order
+CREATE OR REPLACE FUNCTION update_resource_consumption_stats()
+    RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO resource_consumption_stats AS s (name, arch, time)
+        SELECT package.name, changed_rows.arch,
+               sum(changed_rows.finished - changed_rows.started)
+            FROM changed_rows
+                 JOIN build ON build.id = changed_rows.build_id
+                 JOIN package ON package.id = build.package_id
+            GROUP BY package.name, changed_rows.arch
+            ORDER BY package.name, changed_rows.arch
+        ON CONFLICT (name, arch) DO UPDATE
+            SET time = COALESCE(s.time + EXCLUDED.time, s.time, EXCLUDED.time);
+    INSERT INTO scalar_stats_delta (total_time)
+        SELECT sum(finished - started)
+            FROM changed_rows
+            HAVING sum(finished - started) IS NOT NULL;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_resource_consumption_stats_up()
+    RETURNS TRIGGER AS $$
+DECLARE delta interval := COALESCE(NEW.finished - NEW.started, '0') -
+                          COALESCE(OLD.finished - OLD.started, '0');
+BEGIN
+    IF NEW.finished IS NULL AND OLD.finished IS NULL THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO resource_consumption_stats AS s (name, arch, time)
+        SELECT package.name, NEW.arch, delta
+            FROM build JOIN package ON package.id = build.package_id
+            WHERE build.id = NEW.build_id
+        ON CONFLICT (name, arch) DO UPDATE
+            SET time = COALESCE(s.time + EXCLUDED.time, EXCLUDED.time);
+    INSERT INTO scalar_stats_delta (total_time) VALUES (delta);
     RETURN NULL;
 END $$ LANGUAGE plpgsql;
 
 -- triggers
 DROP TRIGGER IF EXISTS update_last_build_trigger ON build;
 CREATE TRIGGER update_last_build_trigger
-    AFTER INSERT ON build FOR EACH ROW
+    AFTER INSERT ON build
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT
     EXECUTE PROCEDURE update_last_build_trigger();
 DROP TRIGGER IF EXISTS update_last_build_trigger_up ON build;
 CREATE TRIGGER update_last_build_trigger_up
-    AFTER UPDATE ON build FOR EACH ROW
-    WHEN (OLD.state != NEW.state OR OLD.untagged != NEW.untagged)
-    EXECUTE PROCEDURE update_last_build_trigger();
+    AFTER UPDATE ON build
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_last_build_up();
 DROP TRIGGER IF EXISTS update_last_build_trigger_del ON build;
 CREATE TRIGGER update_last_build_trigger_del
-    AFTER DELETE ON build FOR EACH ROW
+    AFTER DELETE ON build
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT
     EXECUTE PROCEDURE update_last_build_del();
 DROP TRIGGER IF EXISTS update_all_blocked_trigger ON package;
 CREATE TRIGGER update_all_blocked_trigger
-    AFTER INSERT OR DELETE OR UPDATE OF blocked ON package
+    AFTER INSERT ON package
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_all_blocked();
+DROP TRIGGER IF EXISTS update_all_blocked_trigger_del ON package;
+CREATE TRIGGER update_all_blocked_trigger_del
+    AFTER DELETE ON package
+    REFERENCING OLD TABLE AS changed_rows
     FOR EACH STATEMENT
     EXECUTE PROCEDURE update_all_blocked();
+DROP TRIGGER IF EXISTS update_all_blocked_trigger_up ON package;
+CREATE TRIGGER update_all_blocked_trigger_up
+    AFTER UPDATE OF blocked, base_id ON package
+    FOR EACH ROW
+    WHEN (OLD.blocked != NEW.blocked OR OLD.base_id != NEW.base_id)
+    EXECUTE PROCEDURE update_all_blocked_up();
+DROP TRIGGER IF EXISTS update_precomputed_priority_trigger ON package;
+CREATE TRIGGER update_precomputed_priority_trigger
+    BEFORE INSERT OR UPDATE OF collection_id, blocked, tracked, last_build_id,
+        last_complete_build_id, resolved, skip_resolution, manual_priority,
+        static_priority, dependency_priority, build_priority
+    ON package
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_precomputed_priority();
+DROP TRIGGER IF EXISTS update_collection_precomputed_priority_trigger ON collection;
+CREATE TRIGGER update_collection_precomputed_priority_trigger
+    AFTER UPDATE OF priority_coefficient ON collection
+    FOR EACH ROW
+    WHEN (OLD.priority_coefficient IS DISTINCT FROM NEW.priority_coefficient)
+    EXECUTE PROCEDURE update_collection_precomputed_priority();
+DROP TRIGGER IF EXISTS update_package_stats_trigger_ins ON package;
+CREATE TRIGGER update_package_stats_trigger_ins
+    AFTER INSERT ON package
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_package_stats();
+DROP TRIGGER IF EXISTS update_package_stats_trigger_del ON package;
+CREATE TRIGGER update_package_stats_trigger_del
+    AFTER DELETE ON package
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_package_stats();
+DROP TRIGGER IF EXISTS update_package_stats_trigger_up ON package;
+CREATE TRIGGER update_package_stats_trigger_up
+    AFTER UPDATE OF tracked, blocked ON package
+    FOR EACH ROW
+    WHEN (OLD.tracked != NEW.tracked OR OLD.blocked != NEW.blocked)
+    EXECUTE PROCEDURE update_package_stats_up();
+DROP TRIGGER IF EXISTS update_build_stats_trigger_ins ON build;
+CREATE TRIGGER update_build_stats_trigger_ins
+    AFTER INSERT ON build
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_build_stats();
+DROP TRIGGER IF EXISTS update_build_stats_trigger_del ON build;
+CREATE TRIGGER update_build_stats_trigger_del
+    AFTER DELETE ON build
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_build_stats();
+DROP TRIGGER IF EXISTS update_build_stats_trigger_up ON build;
+CREATE TRIGGER update_build_stats_trigger_up
+    AFTER UPDATE OF real ON build
+    FOR EACH ROW
+    WHEN (OLD.real != NEW.real)
+    EXECUTE PROCEDURE update_build_stats_up();
+DROP TRIGGER IF EXISTS update_resource_consumption_stats_trigger ON koji_task;
+CREATE TRIGGER update_resource_consumption_stats_trigger
+    AFTER INSERT ON koji_task
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE update_resource_consumption_stats();
+DROP TRIGGER IF EXISTS update_resource_consumption_stats_trigger_up ON koji_task;
+CREATE TRIGGER update_resource_consumption_stats_trigger_up
+    AFTER UPDATE OF started, finished ON koji_task
+    FOR EACH ROW
+    WHEN (OLD.started IS DISTINCT FROM NEW.started
+          OR OLD.finished IS DISTINCT FROM NEW.finished)
+    EXECUTE PROCEDURE update_resource_consumption_stats_up();